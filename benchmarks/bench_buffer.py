@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Measures how long HttpProtocol takes to receive a large POST body that arrives
+in small reads.
+
+    python3 benchmarks/bench_buffer.py [body-size] [chunk-size]
+
+The defaults feed a 1 MB body in 1 KB chunks.  Only the protocol's buffering
+and parsing is measured: the request is not dispatched to a handler.
+"""
+
+from os.path import abspath, dirname
+import sys
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import asyncio
+from time import perf_counter
+from servant.connection import HttpProtocol
+
+
+class Transport:
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 50000)
+
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        pass
+
+
+class Protocol(HttpProtocol):
+    def handle_request(self, body):
+        self.received = body
+
+
+async def run(body_size, chunk_size):
+    body = b'x' * body_size
+    data = (b'POST /upload HTTP/1.1\r\n'
+            b'Host: localhost\r\n'
+            b'Content-Type: application/octet-stream\r\n'
+            b'Content-Length: ' + bytes(str(body_size), 'ascii') + b'\r\n'
+            b'\r\n') + body
+
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    p = Protocol()
+    p.connection_made(Transport())
+
+    start = perf_counter()
+    for chunk in chunks:
+        p.data_received(chunk)
+    elapsed = perf_counter() - start
+
+    assert p.received == body
+    return elapsed, len(chunks)
+
+
+def main():
+    body_size  = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+
+    best = None
+    for _ in range(5):
+        elapsed, count = asyncio.run(run(body_size, chunk_size))
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('body={} bytes chunks={} x {} bytes best={:.6f}s ({:.2f} us/chunk)'.format(
+        body_size, count, chunk_size, best, best / count * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Measures the cost and benefit of compressing JSON responses at each level.
+
+    python3 benchmarks/bench_compression.py
+
+Responses used to be compressed with gzip.compress, which uses level 9.  Each
+coding available (see compression.compressors) is timed at several levels on
+JSON bodies of about 10KB and 200KB, printing the time per body and the
+compressed size as a percentage of the original.
+"""
+
+from os.path import abspath, dirname
+import sys
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import gzip, json
+from timeit import timeit
+from servant import compression
+
+
+def body(count):
+    return json.dumps([{
+        'id'      : i,
+        'name'    : 'customer {}'.format(i),
+        'email'   : 'customer{}@example.com'.format(i * 7919 % 100003),
+        'balance' : round(i * 13.37 % 1000, 2),
+        'active'  : i % 3 != 0,
+        'tags'    : ['retail', 'priority'] if i % 5 else [],
+    } for i in range(count)]).encode('utf8')
+
+
+def main():
+    cases = [
+        ('gzip.compress', None, lambda data, level: gzip.compress(data)),
+    ]
+    for coding, func in compression.compressors.items():
+        for level in sorted({1, compression.levels[coding], compression.max_levels[coding]}):
+            cases.append((coding, level, func))
+
+    for count in (80, 1600):
+        data = body(count)
+        number = max(2000000 // len(data), 5)
+        print('{} bytes: microseconds per body, size'.format(len(data)))
+        for label, level, func in cases:
+            size = len(func(data, level))
+            t = timeit(lambda: func(data, level), number=number) / number * 1e6
+            print('  {:14} {:>3} {:10.1f} {:6.1f}%'.format(label, '' if level is None else level, t,
+                                                          size * 100.0 / len(data)))
+
+if __name__ == '__main__':
+    main()
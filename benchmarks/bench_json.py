@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Measures JSON encoding of responses and decoding of request bodies.
+
+    python3 benchmarks/bench_json.py
+
+The payload is a list of records like an API would return, each with a
+datetime.  "old" is how responses and requests used to be handled: json.dumps
+and json.loads with a single encode hook and an object hook called for every
+object.  "json" and "orjson" are the codecs configured with the same
+conversions registered in `encoders` and `decoders` (orjson is skipped if it
+isn't installed).  The "no dates" rows decode a body without any datetimes,
+which the codecs decode without an object hook.
+"""
+
+from os.path import abspath, dirname
+import sys
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import json
+from datetime import datetime
+from timeit import timeit
+from servant.codec import create_codec, orjson
+
+
+def encode_hook(obj):
+    if type(obj) is datetime:
+        return { '__dt': obj.timestamp() * 1000 }
+    raise TypeError()
+
+def object_hook(d):
+    n = d.get('__dt')
+    if type(n) in (int, float):
+        return datetime.fromtimestamp(n / 1000)
+    return d
+
+ENCODERS = { datetime: lambda dt: { '__dt': dt.timestamp() * 1000 } }
+DECODERS = { '__dt': lambda n: datetime.fromtimestamp(n / 1000) }
+
+
+def records(count, dates=True):
+    return [{
+        'id'      : i,
+        'name'    : 'item {}'.format(i),
+        'price'   : i * 1.25,
+        'tags'    : ['a', 'b', 'c'],
+        'owner'   : { 'id': i % 7, 'name': 'owner' },
+        'created' : datetime(2020, 1, 1, 12, i % 60) if dates else '2020-01-01T12:00:00',
+    } for i in range(count)]
+
+
+def main():
+    number = 2000
+
+    codecs = [('json', create_codec('json', encoders=ENCODERS, decoders=DECODERS))]
+    if orjson:
+        codecs.append(('orjson', create_codec('orjson', encoders=ENCODERS, decoders=DECODERS)))
+
+    def old_encode(obj):
+        return json.dumps(obj, default=encode_hook).encode('utf8')
+
+    def old_decode(data):
+        return json.loads(data.decode('UTF-8'), object_hook=object_hook)
+
+    print('microseconds per call')
+    print('{:20} {:>8} {:>8} {:>8}'.format('', 'old', *[name for (name, codec) in codecs]))
+
+    for count in (10, 100):
+        obj = records(count)
+        row = [timeit(lambda: old_encode(obj), number=number)]
+        row += [timeit(lambda: codec.encode(obj), number=number) for (name, codec) in codecs]
+        print('{:20} '.format('encode {}'.format(count)) + ' '.join('{:8.1f}'.format(t / number * 1e6) for t in row))
+
+        for label, dates in (('decode {}', True), ('decode {} no dates', False)):
+            data = old_encode(records(count, dates))
+            for name, codec in codecs:
+                assert codec.decode(data) == old_decode(data), name
+            row = [timeit(lambda: old_decode(data), number=number)]
+            row += [timeit(lambda: codec.decode(data), number=number) for (name, codec) in codecs]
+            print('{:20} '.format(label.format(count)) + ' '.join('{:8.1f}'.format(t / number * 1e6) for t in row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Measures the peak memory used to encode and gzip a large list response.
+
+    python3 benchmarks/bench_jsonstream.py
+
+"whole" is how a list is normally sent: encoded into one bytes object and then
+compressed into another.  "streamed" is a route registered with
+stream_json="json", whose items are encoded and compressed in chunks.  The
+items are produced by a generator so only the encoding is measured, and the
+peak is the most memory allocated at once (using tracemalloc) beyond what was
+allocated at the start.
+"""
+
+from os.path import abspath, dirname
+import sys
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import asyncio, tracemalloc
+from time import perf_counter
+from servant import jsonstream, compression
+from servant.responses import Response
+
+
+def items(count):
+    for i in range(count):
+        yield { 'id': i, 'name': 'customer {}'.format(i), 'balance': i * 1.5, 'tags': ['a', 'b'] }
+
+
+def whole(count):
+    body = Response._codec.encode(list(items(count)))
+    return len(compression.compressors['gzip'](body, compression.levels['gzip']))
+
+
+def streamed(count):
+    async def consume():
+        size = 0
+        body = jsonstream._compress(jsonstream._encode(items(count), 'json'),
+                                    compression.compressobj('gzip', compression.levels['gzip']))
+        async for chunk in body:
+            size += len(chunk)
+        return size
+    return asyncio.run(consume())
+
+
+def measure(func, count):
+    tracemalloc.start()
+    start = perf_counter()
+    size = func(count)
+    elapsed = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, peak, elapsed
+
+
+def main():
+    print('{:>8} {:>10} {:>12} {:>12} {:>10} {:>10}'.format('items', 'gzipped', 'whole peak', 'stream peak',
+                                                             'whole s', 'stream s'))
+    for count in (10000, 100000, 400000):
+        size, whole_peak, whole_time = measure(whole, count)
+        streamed_size, stream_peak, stream_time = measure(streamed, count)
+        print('{:8} {:10} {:11.1f}M {:11.1f}M {:10.2f} {:10.2f}'.format(
+            count, size, whole_peak / 1e6, stream_peak / 1e6, whole_time, stream_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Measures how long routing.get takes to find a route among many.
+
+    python3 benchmarks/bench_routing.py [route-count]
+
+The default registers 1,000 routes: a third with no variables
+("/api/r17/items"), a third with one ("/api/r17/items/{id}") and a third with
+two ("/api/r17/items/{id}/parts/{part}").  Each kind of lookup is timed for
+routes registered first, in the middle and last, plus a URL that matches
+nothing.  The same lookups are timed with a linear scan of one regular
+expression per route, which is how routes used to be found, for comparison.
+
+The "cached" column is routing.resolve for a URL in the route cache.
+"uncached" is routing.get plus parsing the query string, which is what resolve
+does on a miss for a route that takes form variables.  (These routes don't, so
+resolve leaves the query string for the handler to parse if it needs it.)
+"""
+
+from os.path import abspath, dirname
+import sys
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import re
+from timeit import timeit
+from servant import routing
+from servant.routing import route
+from servant.requests import parse_query
+
+
+def register(count):
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            pattern = '/api/r{}/items'.format(i)
+            func = lambda ctx: None
+        elif kind == 1:
+            pattern = '/api/r{}/items/{{id}}'.format(i)
+            func = lambda ctx, id: None
+        else:
+            pattern = '/api/r{}/items/{{id}}/parts/{{part}}'.format(i)
+            func = lambda ctx, id, part: None
+        route(pattern)(func)
+
+
+def regexp(r):
+    """
+    Returns the regular expression routes used to be matched with.
+    """
+    parts = [(re.escape(segment) if isinstance(segment, str) else '([^/]+)') for segment in r.segments]
+    return re.compile('^/' + '/'.join(parts) + '/?$')
+
+
+def linear_get(table, path):
+    for r, pattern in table:
+        match = pattern.match(path)
+        if match:
+            return (r, match)
+    return (None, None)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    register(count)
+
+    table = [(r, regexp(r)) for r in routing._routes]
+
+    def url(i):
+        kind = i % 3
+        if kind == 0:
+            return '/api/r{}/items'.format(i)
+        if kind == 1:
+            return '/api/r{}/items/42'.format(i)
+        return '/api/r{}/items/42/parts/7'.format(i)
+
+    def last(kind):
+        return max(i for i in range(count) if i % 3 == kind)
+
+    urls = [
+        ('static first',    url(0)),
+        ('static last',     url(last(0))),
+        ('1 var middle',    url(count // 2 // 3 * 3 + 1)),
+        ('2 vars last',     url(last(2))),
+        ('2 vars first, qs', url(2) + '?q=1&r=2'),
+        ('not found',       '/api/nothing/here'),
+    ]
+
+    number = 20000
+    print('{} routes, microseconds per lookup'.format(count))
+    print('{:16} {:>8} {:>8} {:>8} {:>8}'.format('', 'tree', 'linear', 'cached', 'uncached'))
+    for label, u in urls:
+        path = u.partition('?')[0]
+        found, values = routing.get(u)
+        expected, match = linear_get(table, path)
+        assert found is expected, (u, found, expected)
+        assert values == (match.groups() if match else None), (u, values)
+
+        assert routing.resolve('GET', u)[:2] == (found, values)
+
+        tree     = timeit(lambda: routing.get(u), number=number) / number * 1e6
+        linear   = timeit(lambda: linear_get(table, path), number=number // 10) / (number // 10) * 1e6
+        cached   = timeit(lambda: routing.resolve('GET', u), number=number) / number * 1e6
+        uncached = timeit(lambda: (routing.get(u), parse_query(u)), number=number) / number * 1e6
+        print('{:16} {:8.2f} {:8.2f} {:8.2f} {:8.2f}'.format(label, tree, linear, cached, uncached))
+
+if __name__ == '__main__':
+    main()
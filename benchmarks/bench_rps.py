@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Measures requests per second for a trivial JSON handler.
+
+    python3 benchmarks/bench_rps.py [--connections N] [--seconds N] [--event-loop asyncio|uvloop]
+
+The server runs in a forked child process and the clients in this one.  Each
+client connection sends one keep-alive GET at a time.  Compare runs on
+different commits or event loops to see the effect of a change.
+"""
+
+from os.path import abspath, dirname
+import sys
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import os, signal, time, argparse, asyncio
+from servant import route, serve, register_middleware
+from servant.middleware.response import ResponseMiddleware
+
+PORT = 8765
+
+@route('/hello')
+def hello(ctx):
+    return {'hello': 'world'}
+
+@route('/hello-async')
+async def hello_async(ctx):
+    return {'hello': 'world'}
+
+
+async def client(url, deadline, counts):
+    r, w = await asyncio.open_connection('127.0.0.1', PORT)
+    request = 'GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(url).encode('ascii')
+    while time.monotonic() < deadline:
+        w.write(request)
+        headers = await r.readuntil(b'\r\n\r\n')
+        length = int(headers.lower().split(b'content-length: ')[1].split(b'\r\n')[0])
+        await r.readexactly(length)
+        counts[0] += 1
+    w.close()
+
+
+async def run(url, connections, seconds):
+    counts = [0]
+    deadline = time.monotonic() + seconds
+    start = time.monotonic()
+    await asyncio.gather(*[client(url, deadline, counts) for _ in range(connections)])
+    return counts[0] / (time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--event-loop', default='asyncio')
+    parser.add_argument('--url', default='/hello')
+    args = parser.parse_args()
+
+    register_middleware(ResponseMiddleware())
+
+    pid = os.fork()
+    if pid == 0:
+        serve('127.0.0.1', PORT, workers=1, event_loop=args.event_loop)
+        os._exit(0)
+
+    try:
+        time.sleep(0.5)
+        rps = asyncio.run(run(args.url, args.connections, args.seconds))
+        print('{} loop={} connections={}: {:.0f} requests/second'.format(args.url, args.event_loop, args.connections, rps))
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import sys
 sys.path.insert(0, dirname(root))
 
 import asyncio
-from servant import HttpProtocol, staticfiles, register_middleware
+from servant import HttpProtocol, staticfiles, register_middleware, drain
 
 from datetime import datetime
 
@@ -25,7 +25,7 @@ def main():
     staticfiles.serve_prefix('/generated', join(root, 'generated'))
 
     from servant import configuration
-    configuration.config(decode_hook=_json_load_object_hook, encode_hook=_json_save_hook)
+    configuration.config(encoders={ datetime: _encode_datetime }, decoders={ '__dt': _decode_datetime })
 
     import e1handlers
 
@@ -39,22 +39,20 @@ def main():
     except KeyboardInterrupt:
         pass
 
-    server.close()
-    loop.run_until_complete(server.wait_closed())
+    # Let the requests already received finish before closing.
+    abandoned = loop.run_until_complete(drain(server, timeout=10))
+    if abandoned:
+        print('abandoned', abandoned, 'requests')
     loop.close()
 
 
-def _json_load_object_hook(d):
-    n = d.get('__dt')
-    if type(n) is int:
-        return datetime.fromtimestamp(n / 1000)
-    return d
+def _decode_datetime(n):
+    # The Javascript side (generated/json.js) sends {"__dt": milliseconds}.
+    return datetime.fromtimestamp(n / 1000)
 
 
-def _json_save_hook(obj):
-    if type(obj) is datetime:
-        return { '__dt' : obj.timestamp() * 1000 }
-    raise TypeError()
+def _encode_datetime(obj):
+    return { '__dt' : obj.timestamp() * 1000 }
 
 if __name__ == '__main__':
     main()
@@ -8,7 +8,7 @@ def index(ctx):
     return staticfiles.get('/static', 'index.html')
 
 @route('/click', permissions='PUBLIC')
-def click(ctx, counter, timestamp):
+def click(ctx, counter: int, timestamp: datetime):
     print('COUNTER:', counter, type(counter))
     print('TIMESTAMP:', timestamp, type(timestamp))
 
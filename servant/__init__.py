@@ -2,6 +2,7 @@
 # Import the most common items to simplify URL handlers code.
 
 from .connection import HttpProtocol
+from .server import serve, drain
 from .staticfiles import File
 from .routing import route
 from .middleware import middleware
@@ -0,0 +1,220 @@
+"""
+Converts URL handler arguments to the types in the handler's annotations.
+
+Query string and form variables arrive as strings and JSON values arrive as
+whatever JSON produced, so a handler declared as
+
+    @route('/orders')
+    def orders(ctx, page: int, since: date, status: Status, ids: list[int] = None):
+
+would otherwise have to parse each itself.  When a route is registered,
+`get_converter` is called for each annotated parameter to build a function that
+checks and converts the value.  The route's binder calls it for each request
+and rejects the request with a 400 if it raises ValueError or TypeError.
+
+Conversions for other types can be added to `converters`.  Classes without a
+converter are called with the value, so any type whose constructor accepts a
+string works.
+"""
+
+import typing, types
+from enum import Enum
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+from inspect import Parameter
+
+TRUE  = frozenset(['true', '1', 'yes', 'on'])
+FALSE = frozenset(['false', '0', 'no', 'off', ''])
+# The strings accepted for bool parameters (compared after lowercasing).
+
+
+def to_int(value):
+    if type(value) is int:
+        return value
+    if isinstance(value, str):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    raise TypeError('Expected an int: {!r}'.format(value))
+
+
+def to_float(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        return float(value)
+    raise TypeError('Expected a float: {!r}'.format(value))
+
+
+def to_bool(value):
+    if type(value) is bool:
+        return value
+    if isinstance(value, str):
+        value = value.lower()
+        if value in TRUE:
+            return True
+        if value in FALSE:
+            return False
+        raise ValueError('Expected a bool: {!r}'.format(value))
+    if value in (0, 1):
+        return bool(value)
+    raise TypeError('Expected a bool: {!r}'.format(value))
+
+
+def to_decimal(value):
+    if isinstance(value, (int, str)) and not isinstance(value, bool):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ValueError('Expected a decimal: {!r}'.format(value))
+    if isinstance(value, float):
+        # Use the shortest representation so 1.1 doesn't become
+        # 1.100000000000000088817841970012523.
+        return Decimal(repr(value))
+    if isinstance(value, Decimal):
+        return value
+    raise TypeError('Expected a decimal: {!r}'.format(value))
+
+
+def to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise TypeError('Expected a string: {!r}'.format(value))
+
+
+def to_date(value):
+    # Javascript has no date type, so dates often arrive as datetimes (see
+    # configuration.config(decoders)).
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    raise TypeError('Expected a date: {!r}'.format(value))
+
+
+def to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, time())
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    raise TypeError('Expected a datetime: {!r}'.format(value))
+
+
+def to_time(value):
+    if isinstance(value, datetime):
+        return value.time()
+    if isinstance(value, time):
+        return value
+    if isinstance(value, str):
+        return time.fromisoformat(value)
+    raise TypeError('Expected a time: {!r}'.format(value))
+
+
+converters = {
+    int      : to_int,
+    float    : to_float,
+    Decimal  : to_decimal,
+    bool     : to_bool,
+    str      : to_str,
+    date     : to_date,
+    datetime : to_datetime,
+    time     : to_time,
+}
+# Maps from an annotation type to a function that accepts a value and returns
+# it converted to that type.  It should raise ValueError or TypeError if the
+# value is invalid.
+
+
+def get_converter(annotation):
+    """
+    Returns a function that converts values for a parameter with the given
+    annotation, or None if values are passed unchanged.
+    """
+    if annotation in (Parameter.empty, typing.Any, object):
+        return None
+
+    convert = converters.get(annotation)
+    if convert:
+        return convert
+
+    origin = typing.get_origin(annotation)
+    args   = typing.get_args(annotation)
+
+    if origin in (typing.Union, types.UnionType):
+        # Optional[X] is Union[X, None].  None values are never converted, so
+        # only a single other type is supported.
+        others = [arg for arg in args if arg is not type(None)]
+        assert len(others) == 1, 'Unions are not supported: {!r}'.format(annotation)
+        return get_converter(others[0])
+
+    if origin in (list, tuple, set, frozenset):
+        assert origin is not tuple or len(args) == 2 and args[1] is Ellipsis, \
+            'Only tuple[X, ...] is supported: {!r}'.format(annotation)
+        return _sequence(origin, get_converter(args[0]) if args else None)
+
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return _enum(annotation)
+
+    if isinstance(annotation, type):
+        def convert(value):
+            if isinstance(value, annotation):
+                return value
+            return annotation(value)
+        return convert
+
+    assert callable(annotation), 'Unsupported annotation: {!r}'.format(annotation)
+    return annotation
+
+
+def is_sequence(annotation):
+    """
+    Returns True if the annotation is list[X] or similar (or Optional of one),
+    which can receive all values of a repeated query string variable.
+    """
+    origin = typing.get_origin(annotation)
+    if origin in (typing.Union, types.UnionType):
+        others = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        return len(others) == 1 and is_sequence(others[0])
+    return origin in (list, tuple, set, frozenset) or annotation in (list, tuple, set, frozenset)
+
+
+def _sequence(kind, item):
+    """
+    Returns a converter for list[X] and similar.  The value can be a list or a
+    comma-separated string.
+    """
+    def convert(value):
+        if isinstance(value, str):
+            value = value.split(',') if value else []
+        elif not isinstance(value, (list, tuple)):
+            raise TypeError('Expected a list: {!r}'.format(value))
+        if item:
+            return kind(item(v) for v in value)
+        return kind(value)
+    return convert
+
+
+def _enum(cls):
+    """
+    Returns a converter for an Enum subclass.  The value can be a member's
+    value or, if a string, its name.
+    """
+    def convert(value):
+        try:
+            return cls(value)
+        except ValueError:
+            if not isinstance(value, str):
+                raise
+        if value in cls.__members__:
+            return cls[value]
+        if issubclass(cls, int):
+            # A query string value for an IntEnum.
+            return cls(int(value))
+        raise ValueError('Invalid {}: {!r}'.format(cls.__name__, value))
+    return convert
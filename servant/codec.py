@@ -0,0 +1,264 @@
+"""
+Provides the JSON codecs used to encode responses and decode request bodies.
+
+Handlers returning lists and dictionaries make JSON encoding and decoding the
+largest cost of most API requests, so the codec is chosen and configured once
+(see configuration.config) rather than on each call:
+
+* The encoder and decoder are created once and reused.  json.dumps and
+  json.loads build new ones on every call that passes options such as
+  `default` or `object_hook`.
+
+* orjson is used if it is installed.  It is several times faster than the json
+  module.
+
+* Conversions for types JSON doesn't have are registered per type in
+  `encoders`, so encoding a datetime is a dictionary lookup instead of a chain
+  of isinstance tests in one hook.
+
+* Conversions when decoding are registered per marker key in `decoders`.  A
+  JSON object with a single registered key, such as {"__dt": 1500000000000},
+  is replaced by the decoder's result.  Bodies that don't contain a registered
+  key at all are decoded without an object hook, so the common case doesn't
+  call back into Python for every object.
+"""
+
+import json
+from dataclasses import is_dataclass
+from datetime import date, time
+from enum import Enum
+from uuid import UUID
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    """
+    The base class for JSON codecs.  Subclasses implement `encode` and `decode`.
+
+    encoders
+      A dictionary mapping from a type to a function that converts instances of
+      it (or of subclasses) into something JSON can encode.
+
+    decoders
+      A dictionary mapping from a key to a function that converts the key's
+      value in an object that has only that key.  The function's result replaces
+      the object.
+
+    encode_hook
+      An optional function called for objects with no registered encoder, like
+      json.dumps(default).  It should raise TypeError for objects it can't
+      convert.
+
+    decode_hook
+      An optional function called for every decoded object, like
+      json.loads(object_hook).  Since it must be called for every object,
+      prefer `decoders`.
+    """
+    name = None
+
+    def __init__(self, encoders=None, decoders=None, encode_hook=None, decode_hook=None):
+        self.encoders    = dict(encoders or {})
+        self.decoders    = dict(decoders or {})
+        self.encode_hook = encode_hook
+        self.decode_hook = decode_hook
+        self.configure()
+
+    def __repr__(self):
+        return '{}(encoders={}, decoders={})'.format(type(self).__name__, len(self.encoders), len(self.decoders))
+
+    def register_encoder(self, cls, func):
+        """
+        Registers a function that converts instances of `cls` for encoding.
+        """
+        self.encoders[cls] = func
+        self.configure()
+
+    def register_decoder(self, key, func):
+        """
+        Registers a function that converts objects like {key: value}.  It is
+        called with the value.
+        """
+        self.decoders[key] = func
+        self.configure()
+
+    def configure(self):
+        """
+        Called when the hooks change so subclasses can rebuild whatever they
+        have preconfigured.
+        """
+        self._dispatch = dict(self.encoders)
+        # Maps from a type to its encoder, including subclasses of registered
+        # types as they are seen.
+
+        self._markers = [json.dumps(key).encode('utf8') for key in self.decoders]
+        # The registered keys as they appear in an encoded body.
+
+    def encode(self, obj):
+        """
+        Returns `obj` encoded as UTF-8 JSON bytes.
+        """
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """
+        Returns the object decoded from UTF-8 JSON bytes.
+        """
+        raise NotImplementedError()
+
+    def default(self, obj):
+        """
+        Converts an object JSON doesn't support using the registered encoders.
+        """
+        cls = type(obj)
+        func = self._dispatch.get(cls)
+        if func is None:
+            for base in cls.__mro__[1:]:
+                func = self.encoders.get(base)
+                if func is not None:
+                    self._dispatch[cls] = func
+                    break
+            else:
+                if self.encode_hook:
+                    return self.encode_hook(obj)
+                raise TypeError('Object of type {} is not JSON serializable'.format(cls.__name__))
+        return func(obj)
+
+    def object_hook(self, obj):
+        """
+        Converts a decoded object using the registered decoders and decode_hook.
+        """
+        if len(obj) == 1 and self.decoders:
+            for key in obj:
+                func = self.decoders.get(key)
+                if func is not None:
+                    return func(obj[key])
+        if self.decode_hook:
+            return self.decode_hook(obj)
+        return obj
+
+    def _needs_hook(self, data):
+        """
+        Returns True if decoding `data` requires calling object_hook.
+        """
+        if self.decode_hook:
+            return True
+        for marker in self._markers:
+            if marker in data:
+                return True
+        return False
+
+
+class StdlibJsonCodec(JsonCodec):
+    """
+    A codec using the standard library's json module.
+    """
+    name = 'json'
+
+    def configure(self):
+        JsonCodec.configure(self)
+        self._encoder = json.JSONEncoder(default=self.default)
+        self._decoder = json.JSONDecoder()
+        self._hooked_decoder = json.JSONDecoder(object_hook=self.object_hook)
+
+    def encode(self, obj):
+        return self._encoder.encode(obj).encode('utf8')
+
+    def decode(self, data):
+        decoder = self._hooked_decoder if self._needs_hook(data) else self._decoder
+        return decoder.decode(data.decode('utf8'))
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    A codec using orjson.
+
+    Its output is compact (no spaces after separators).  orjson encodes some
+    types natively that the json module doesn't, such as datetime, UUID, enums
+    and dataclasses, so registered encoders for them would never be called:
+
+    * Datetimes and dataclasses are passed to the registered encoders if any
+      are registered for them (or to the encode_hook if there is one), using
+      orjson's passthrough options.
+
+    * orjson can't pass UUIDs and enums through, so if encoders are registered
+      for either, bodies are encoded by the json module instead.
+
+    * Integers too large for orjson (beyond 64 bits) are encoded by the json
+      module instead of failing.
+
+    So a codec configured with encoders gives the same results with either.
+    Objects with no encoder differ: orjson encodes datetimes, UUIDs, enums and
+    dataclasses itself where the json module raises TypeError (or calls the
+    encode_hook for UUIDs and enums).
+
+    orjson doesn't support object hooks, so a body containing a registered
+    decoder key (or any body if there is a decode_hook) is decoded by the json
+    module, which calls the hook from C.  This is faster than converting
+    orjson's result afterwards in Python.
+    """
+    name = 'orjson'
+
+    def __init__(self, *args, **kwargs):
+        assert orjson, 'orjson is not installed'
+        JsonCodec.__init__(self, *args, **kwargs)
+
+    def configure(self):
+        JsonCodec.configure(self)
+        options = orjson.OPT_NON_STR_KEYS
+        if self.encode_hook or any(issubclass(cls, (date, time)) for cls in self.encoders):
+            options |= orjson.OPT_PASSTHROUGH_DATETIME
+        if self.encode_hook or any(is_dataclass(cls) for cls in self.encoders):
+            options |= orjson.OPT_PASSTHROUGH_DATACLASS
+        self._options = options
+
+        self._use_json = any(issubclass(cls, (UUID, Enum)) for cls in self.encoders)
+        # True if bodies must be encoded by the json module so the encoders for
+        # UUIDs or enums are called.
+
+        self._encoder = json.JSONEncoder(default=self.default, separators=(',', ':'), ensure_ascii=False)
+        # Compact like orjson's output.
+        self._hooked_decoder = json.JSONDecoder(object_hook=self.object_hook)
+
+    def encode(self, obj):
+        if self._use_json:
+            return self._encoder.encode(obj).encode('utf8')
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options)
+        except TypeError as ex:
+            if str(ex) != 'Integer exceeds 64-bit range':
+                raise
+            return self._encoder.encode(obj).encode('utf8')
+
+    def decode(self, data):
+        if self._needs_hook(data):
+            return self._hooked_decoder.decode(data.decode('utf8'))
+        return orjson.loads(data)
+
+
+codecs = {
+    'json'   : StdlibJsonCodec,
+    'orjson' : OrjsonCodec,
+}
+# Maps from the names accepted by configuration.config(json_codec) to codec classes.
+
+
+def create_codec(json_codec=None, **kwargs):
+    """
+    Returns a codec.
+
+    json_codec
+      A name from `codecs`, a JsonCodec subclass, or None for orjson if it is
+      installed and the json module otherwise.
+
+    The keyword arguments are passed to the codec (encoders, decoders, etc.).
+    """
+    if json_codec is None:
+        json_codec = 'orjson' if orjson else 'json'
+    if isinstance(json_codec, str):
+        assert json_codec in codecs, 'Invalid json_codec {!r}'.format(json_codec)
+        json_codec = codecs[json_codec]
+    return json_codec(**kwargs)
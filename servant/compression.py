@@ -0,0 +1,360 @@
+"""
+Compresses response bodies using the best encoding the client accepts.
+
+The encoding is chosen from the request's Accept-Encoding header (with its
+q-values) and the codings available here: gzip and deflate always, "br" if the
+brotli module is installed and "zstd" if zstandard is.  When several are
+equally acceptable to the client, the first in `preference` is used.
+
+Compression costs far more CPU at high levels for very little gain on typical
+JSON - gzip level 9 is several times slower than level 6 for output about 2%
+smaller - so the defaults in `levels` are moderate.  Bodies smaller than
+`min_size` aren't worth compressing, and bodies that don't shrink by at least
+`min_saving` (already compressed data, random tokens, etc.) are sent as they
+are.
+
+Routes can override the level and minimum size using
+@route(compress_level=, compress_min_size=).  configuration.config sets the
+defaults.
+"""
+
+import zlib
+from collections import Counter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+levels = {
+    'gzip'    : 6,
+    'deflate' : 6,
+    'br'      : 4,
+    'zstd'    : 3,
+}
+# The default compression level for each coding.
+
+max_levels = {
+    'gzip'    : 9,
+    'deflate' : 9,
+    'br'      : 11,
+    'zstd'    : 22,
+}
+
+min_size = 1024
+# Bodies smaller than this many bytes are not compressed.
+
+min_saving = 0.1
+# The compressed body is only sent if it is at least this fraction smaller than
+# the original.
+
+preference = ['zstd', 'br', 'gzip', 'deflate']
+# The codings we use, most preferred first.  Codings whose module isn't
+# installed are ignored.
+
+compressible_types = frozenset([
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/x-ndjson',
+    'image/svg+xml',
+])
+# Content types that are compressed in addition to text/* and types ending in
+# "+json" or "+xml".
+
+counters = Counter()
+# Counts for monitoring:
+#
+# compressed: A response body was compressed.
+# incompressible: A body was compressed but sent uncompressed since it didn't shrink enough.
+# bytes_in, bytes_out: The total sizes of bodies before and after compression.
+
+
+def _gzip(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(data) + c.flush()
+
+def _deflate(data, level):
+    # HTTP's "deflate" is the zlib format, not raw deflate.
+    return zlib.compress(data, level)
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level)
+
+def _zstd(data, level):
+    # Compressors aren't thread-safe and bodies may be compressed in an
+    # executor, so one is created for each body.
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+class _BrotliStream:
+    # Gives brotli's streaming compressor the zlib interface.
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+def _gzip_stream(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+def _deflate_stream(level):
+    return zlib.compressobj(level)
+
+def _zstd_stream(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+compressors = {
+    'gzip'    : _gzip,
+    'deflate' : _deflate,
+}
+if brotli:
+    compressors['br'] = _brotli
+if zstandard:
+    compressors['zstd'] = _zstd
+# Maps from coding to a function that compresses bytes: func(data, level).
+
+stream_compressors = {
+    'gzip'    : _gzip_stream,
+    'deflate' : _deflate_stream,
+}
+if brotli:
+    stream_compressors['br'] = _BrotliStream
+if zstandard:
+    stream_compressors['zstd'] = _zstd_stream
+# Maps from coding to a function returning an object with the interface of
+# zlib.compressobj for compressing a body in pieces: func(level).
+
+
+_negotiated = {}
+# Maps from Accept-Encoding header values to (coding, qvalues): the coding
+# chosen for the header and the header parsed into a dictionary mapping from
+# coding to q-value.  Clients send the same few values over and over.
+
+_MAX_NEGOTIATED = 256
+
+
+def configure(level=None, size=None, codings=None):
+    """
+    Sets the default level, the minimum size and the preferred codings.  See
+    configuration.config.
+    """
+    global min_size
+    if level is not None:
+        levels.update(_levels(level))
+    if size is not None:
+        min_size = size
+    if codings is not None:
+        for coding in codings:
+            assert coding in max_levels, 'Invalid coding {!r}'.format(coding)
+        preference[:] = codings
+    _negotiated.clear()
+
+
+def _levels(level):
+    """
+    Returns a dictionary mapping from coding to level for a level passed to
+    configure or @route: an int applied to every coding (limited to each
+    coding's maximum) or a dictionary.
+    """
+    if isinstance(level, dict):
+        for coding in level:
+            assert coding in max_levels, 'Invalid coding {!r}'.format(coding)
+        return level
+    assert isinstance(level, int) and level >= 0, 'Invalid compression level {!r}'.format(level)
+    return { coding: min(level, top) for (coding, top) in max_levels.items() }
+
+
+def negotiate(accept_encoding):
+    """
+    Returns the coding to use for a request's Accept-Encoding header or None if
+    the body should not be compressed.
+    """
+    if not accept_encoding:
+        return None
+    entry = _negotiated.get(accept_encoding) or _negotiate(accept_encoding)
+    return entry[0]
+
+
+def accepts(accept_encoding, coding):
+    """
+    Returns True if a request's Accept-Encoding header allows `coding`.
+    """
+    if not accept_encoding:
+        return False
+    qvalues = (_negotiated.get(accept_encoding) or _negotiate(accept_encoding))[1]
+    return qvalues.get(coding, qvalues.get('*', 0.0)) > 0.0
+
+
+def choose(accept_encoding, available):
+    """
+    Returns the coding to use from `available`, a collection of codings a body
+    has already been compressed with, or None to send it uncompressed.
+    """
+    if not accept_encoding or not available:
+        return None
+    qvalues = (_negotiated.get(accept_encoding) or _negotiate(accept_encoding))[1]
+    star = qvalues.get('*', 0.0)
+
+    best = None
+    best_q = 0.0
+    for coding in preference:
+        if coding in available:
+            q = qvalues.get(coding, star)
+            if q > best_q:
+                best = coding
+                best_q = q
+    return best
+
+
+def _negotiate(accept_encoding):
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params[:2] in ('q=', 'Q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qvalues[coding] = q
+
+    if 'x-gzip' in qvalues and 'gzip' not in qvalues:
+        qvalues['gzip'] = qvalues['x-gzip']
+
+    star = qvalues.get('*', 0.0)
+
+    best = None
+    best_q = 0.0
+    for coding in preference:
+        if coding in compressors:
+            q = qvalues.get(coding, star)
+            if q > best_q:
+                best = coding
+                best_q = q
+
+    if len(_negotiated) >= _MAX_NEGOTIATED:
+        _negotiated.clear()
+    entry = _negotiated[accept_encoding] = (best, qvalues)
+    return entry
+
+
+def is_compressible(content_type):
+    """
+    Returns True if bodies of the given content type are usually worth
+    compressing.
+    """
+    if not content_type:
+        return False
+    mimetype = content_type.partition(';')[0].strip().lower()
+    return (mimetype.startswith('text/') or mimetype in compressible_types or
+            mimetype.endswith('+json') or mimetype.endswith('+xml'))
+
+
+def add_vary(headers, name):
+    """
+    Adds a field name to a response's Vary header.
+    """
+    vary = headers.get('vary')
+    if not vary:
+        headers['vary'] = name
+    elif name.lower() not in (v.strip().lower() for v in vary.split(',')):
+        headers['vary'] = vary + ', ' + name
+
+
+def level_for(route, coding):
+    """
+    Returns the level to use for a route and coding.
+    """
+    level = route.compress_level if route is not None else None
+    if level is None:
+        return levels[coding]
+    if isinstance(level, int):
+        return min(level, max_levels[coding])
+    return level.get(coding, levels[coding])
+
+
+def compress(data, coding, level):
+    """
+    Returns `data` compressed using `coding`, or None if it didn't shrink
+    enough to be worth sending compressed.
+    """
+    compressed = compressors[coding](data, level)
+    return compressed if accept_compressed(len(data), compressed) else None
+
+
+def compressobj(coding, level):
+    """
+    Returns an object for compressing a body a piece at a time, with the
+    interface of zlib.compressobj: `compress(data)` returns whatever output is
+    ready and `flush()` returns the rest.
+    """
+    return stream_compressors[coding](level)
+
+
+def is_worth_sending(size, compressed):
+    """
+    Returns True if a compressed body is enough smaller than the original
+    `size` bytes to send it.
+    """
+    return len(compressed) <= size * (1.0 - min_saving)
+
+
+def accept_compressed(size, compressed):
+    """
+    Returns is_worth_sending(size, compressed), updating the counters.
+    """
+    if not is_worth_sending(size, compressed):
+        counters['incompressible'] += 1
+        return False
+
+    counters['compressed'] += 1
+    counters['bytes_in']  += size
+    counters['bytes_out'] += len(compressed)
+    return True
+
+
+def select(ctx):
+    """
+    Decides whether the response body should be compressed, returning a tuple of
+    (coding, level) or None.
+
+    Adds "Vary: Accept-Encoding" to every response whose encoding depends on the
+    request's Accept-Encoding header so caches don't send a compressed
+    response to a client that can't decode it.
+    """
+    response = ctx.response
+    headers  = response.headers
+    route    = ctx.route
+
+    if route is not None and route.compress_level == 0:
+        return None
+
+    if 'content-encoding' in headers or not is_compressible(headers.get('content-type')):
+        return None
+
+    add_vary(headers, 'Accept-Encoding')
+
+    size = route.compress_min_size if route is not None else None
+    if size is None:
+        size = min_size
+    if isinstance(response.body, bytes) and len(response.body) < size:
+        return None
+
+    coding = negotiate(ctx.request.headers.get('accept-encoding'))
+    if coding is None:
+        return None
+
+    return (coding, level_for(route, coding))
+
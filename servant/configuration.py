@@ -1,39 +1,174 @@
 
-def config(encode_hook=None, decode_hook=None):
+def config(encode_hook=None, decode_hook=None, json_codec=None, encoders=None, decoders=None,
+           annotation_converter=None, pipeline_depth=None, max_body_size=None,
+           read_high_water=None, read_low_water=None, header_timeout=None, body_timeout=None,
+           keepalive_timeout=None, handler_timeout=None, max_requests=None, route_cache_size=None,
+           compression_level=None, compression_min_size=None, compression_codings=None, executor=None,
+           offload_threshold=None, sendfile_threshold=None):
     """
     Provides high-level configuration for the entire package.  It is not required; it is
     designed to allow customization.
 
     encode_hook
-      A function that accepts a URL handler response as either a list or dictionary and JSON
-      encodes it to a UTF-8 encoded string.  If not provided, json.dumps is used.
+      A function called for each object in a URL handler's response that has no encoder in
+      `encoders`, like json.dumps(default).  It should return something JSON can encode or
+      raise TypeError.
 
     decode_hook
-      A JSON object hook (for json.loads(object_hook)) that is called for every object
+      A JSON object hook (for json.loads(object_hook)) that is called for every object in a
+      JSON request body.  `decoders` is much cheaper.
 
-      A function that accepts a Unicode JSON string and decodes it into a Python dictionary.
-      If not provided, json.loads is used.
+      The body must decode to a dictionary since it is used to populate URL handler arguments
+      and we need to know the name of the argument each element should be assigned to.
 
-      A dictionary is required since it is used to populate URL handler arguments and we need
-      to know the name of the argument each element should be assigned to.
+    json_codec
+      The JSON codec used for responses and request bodies: "orjson", "json" (the standard
+      library), or a codec.JsonCodec subclass.  The default is orjson if it is installed and
+      json otherwise.  Both call `encoders` for the same objects, but objects with no encoder
+      differ: orjson encodes datetimes, UUIDs, enums and dataclasses itself where json raises
+      TypeError.  See codec.py.
+
+    encoders
+      A dictionary mapping from a type to a function that converts instances of it (and of
+      subclasses) into something JSON can encode:
+
+        encoders={ datetime: lambda dt: { '__dt': dt.timestamp() * 1000 } }
+
+    decoders
+      A dictionary mapping from a key to a function that converts JSON objects that have only
+      that key.  The function is passed the key's value and its result replaces the object:
+
+        decoders={ '__dt': lambda ms: datetime.fromtimestamp(ms / 1000) }
+
+      Bodies that don't contain any of the keys are decoded without calling back to Python.
 
     annotation_converter
       A function that post processes request variables (after the decode_hook, etc.) and
       optionally converts values based on Python argument annotations.
 
+      Values are already converted to the annotated types for common types such as int,
+      float, bool, date, datetime, Enum subclasses and list[int] (see annotations.py).  This
+      is for any additional processing.
+
       This function is only called if the Route has annotations.  If so, the variables are
       passed as a mapping from argument name to value.
 
         func(route, map_arg_to_value) -> None
 
       If a value is to be converted, the new value should overwrite the old one in the map.
+      Raise HttpError(400) to reject the request.
+
+    pipeline_depth
+      The maximum number of pipelined requests handled concurrently on each connection.
+      Responses are always written in the order the requests were received.  The default is
+      1, which handles pipelined requests one at a time.
+
+    max_body_size
+      The largest request body, in bytes, accepted by routes that don't set their own limit
+      using @route(max_body_size).  Larger requests are rejected with a 413.  The default is
+      16MB.  Pass 0 to remove the limit.
+
+    read_high_water, read_low_water
+      While requests are being handled, reading from a connection is paused when more than
+      read_high_water bytes (pipelined requests or streamed body data) are waiting to be
+      processed, and resumed once no more than read_low_water are waiting.  The defaults are
+      256KB and 64KB.  connection.counters records how often this happens.
+
+    header_timeout, body_timeout, keepalive_timeout, handler_timeout
+      Connection timeouts in seconds.  A request's headers must all arrive within
+      header_timeout (default 20) of its first byte, and its body must not stall for more than
+      body_timeout (default 30).  Either is answered with a 408 and the connection is closed.
+      A connection with no request in progress is closed after keepalive_timeout (default 60).
+      A handler that runs longer than handler_timeout is cancelled and a 503 is returned; by
+      default handlers have no limit.  Pass 0 to disable a timeout.  connection.counters
+      records how often each occurs.
+
+    max_requests
+      The maximum number of requests served on one connection before it is closed.  The last
+      response includes "Connection: close".  Load balancers use this to spread long-lived
+      clients across servers.  By default there is no limit.  Pass 0 to remove the limit.
+
+    route_cache_size
+      The number of URLs whose route and query string are cached.  URLs are only cached if
+      they are requested more often than the entry they would replace, so a flood of unique
+      URLs can't evict the popular ones.  The default is 1024.  Pass 0 to disable the cache.
+      routing.cache.stats() reports the hit rate.
+
+    compression_level
+      The default compression level for responses: an int used for every coding (limited to
+      the coding's maximum) or a dictionary mapping from coding to level.  The defaults are 6
+      for gzip and deflate, 4 for br and 3 for zstd.  Higher levels cost much more CPU for
+      little gain on typical JSON.  Routes can override this using @route(compress_level).
+
+    compression_min_size
+      Responses smaller than this many bytes are not compressed.  The default is 1024.  Routes
+      can override this using @route(compress_min_size).
+
+    compression_codings
+      The codings responses may be compressed with, most preferred first.  The default is
+      ["zstd", "br", "gzip", "deflate"]; zstd and br are only used if the zstandard and brotli
+      modules are installed.  Pass [] to disable compression.
+
+    executor
+      The concurrent.futures executor that large response bodies are compressed (and, if it is
+      a ProcessPoolExecutor, JSON encoded) on so they don't stall the event loop.  The default
+      is the event loop's default thread pool.  A process pool's workers are started immediately
+      and use the settings in effect then, so call config before serving.  See offload.py.
+
+    offload_threshold
+      Encoding or compressing a body is done in the executor if it is expected to take longer
+      than this many seconds, based on the measured time per byte.  The default is 0.002.
+      Routes can override this using @route(offload).
+
+    sendfile_threshold
+      Static files larger than this many bytes are sent from disk using sendfile instead of
+      being held in memory.  The default is 1MB.  Pass 0 to hold every file in memory.  This
+      applies to files loaded afterwards, so call config before staticfiles.serve_prefix.
     """
     # Note: Push even if the value is None in case we're *restoring* the original value.  (I
     # don't see that being useful, but it would be expected if someone passed None on a second
     # call.)
 
+    from .codec import create_codec
+    codec = create_codec(json_codec, encoders=encoders, decoders=decoders, encode_hook=encode_hook,
+                         decode_hook=decode_hook)
+
     from .requests import Request
-    Request._ohook = decode_hook
+    Request._codec = codec
 
     from .responses import Response
-    Response._ohook = encode_hook
+    Response._codec = codec
+
+    from . import routing
+    routing.set_annotation_converter(annotation_converter)
+
+    from .connection import HttpProtocol
+    if pipeline_depth is not None:
+        assert pipeline_depth >= 1, 'pipeline_depth must be at least 1: {!r}'.format(pipeline_depth)
+        HttpProtocol.pipeline_depth = pipeline_depth
+    if max_body_size is not None:
+        HttpProtocol.max_body_size = max_body_size or None
+    if read_high_water is not None:
+        HttpProtocol.read_high_water = read_high_water
+    if read_low_water is not None:
+        HttpProtocol.read_low_water = read_low_water
+    if max_requests is not None:
+        HttpProtocol.max_requests = max_requests or None
+    for name, value in [('header_timeout', header_timeout), ('body_timeout', body_timeout),
+                        ('keepalive_timeout', keepalive_timeout), ('handler_timeout', handler_timeout)]:
+        if value is not None:
+            setattr(HttpProtocol, name, value or None)
+    assert HttpProtocol.read_low_water <= HttpProtocol.read_high_water, 'read_low_water must not be greater than read_high_water'
+
+    if route_cache_size is not None:
+        routing.cache.resize(route_cache_size)
+
+    from . import compression
+    compression.configure(level=compression_level, size=compression_min_size, codings=compression_codings)
+
+    from . import offload
+    offload.configure(pool=executor, seconds=offload_threshold)
+
+    from . import staticfiles
+    if sendfile_threshold is not None:
+        staticfiles.sendfile_threshold = sendfile_threshold or None
@@ -3,47 +3,191 @@
 # the connection is closed.
 #
 # As soon as it is created we start accepting data.  When a complete request is
-# received we create a Request object and launch it on its own using
-# asyncio.async.  When the request completes, it must call back into the
+# received we create a Request object and launch it on its own task using
+# loop.create_task.  When the request completes, it must call back into the
 # protocol so it can continue parsing the next request.  If your handler never
 # calls a completing method (e.g. request.complete_with_content) then a
 # connection timeout (a TCP/IP timeout or our background reaper) will eventually
 # clean up, but this is not ideal.
 #
+# Pipelined requests are parsed and dispatched until `pipeline_depth` requests
+# are in flight.  Each is tracked by a _Pending entry and responses are written
+# strictly in the order the requests arrived, so a fast handler's response waits
+# for the slower ones before it.
+#
+# Timeouts are enforced by the loop's Reaper (see reaper.py).  Each connection
+# computes its next deadline in _update_timeouts whenever its state changes and
+# the reaper calls _reap when it passes.
+#
+# Every open connection is kept in `connections` so a server can be drained (see
+# server.drain).  A draining connection finishes the requests it has already
+# started receiving, marks the last response "Connection: close" and closes.
+#
 # I'm trying to keep the logic in Request to make it easier to make it generic
 # and subclassable later.  (For now, I'm hardcoding our application Logic there
 # though.)
 
-# TODO: Reaper
-# TODO: Handle connection close
-
 import re, logging, inspect
-from asyncio import Protocol, coroutine, async
+from collections import deque, Counter
+from asyncio import Protocol, get_running_loop
 
 from . import errors
 from .errors import HttpError
 from . import routing
 from .contexts import Context
-from .requests import Request
+from .requests import Request, BodyStream
+from .responses import Response, is_stream, FileBody
 from .lowerdict import LowerDict
 from .middleware import middleware
+from .reaper import get_reaper
 
 logger = logging.getLogger('web')
 
 MAX_HEADERS = 1024 * 6
-RE_REQUEST_LINE  = re.compile(r'(GET|POST|PUT|DELETE) [ ]+ (\S+) [ ]+ HTTP/1.1 [ ]* \r\n', re.VERBOSE)
+
+COMPACT_THRESHOLD = 1024 * 64
+# Once this many bytes at the front of the receive buffer have been consumed we
+# shift the remainder down.  Until then consuming data only advances an offset.
+
+FILE_BLOCK_SIZE = 1024 * 64
+# The size of the blocks a FileBody is copied in when the transport doesn't
+# support sendfile.
+
+MAX_CHUNK_LINE = 1024
+# The longest chunk-size line (including extensions) or trailer line we accept
+# in a chunked request body.
+
+RE_CHUNK_SIZE = re.compile(rb'[0-9A-Fa-f]{1,16}')
+# A chunk size.  int(x, 16) also accepts signs, underscores, "0x" and
+# whitespace, which a proxy in front of us may parse differently, disagreeing
+# with us about where the body ends.
+
+RE_REQUEST_LINE  = re.compile(r'(GET|HEAD|POST|PUT|PATCH|DELETE|OPTIONS) [ ]+ (\S+) [ ]+ HTTP/1\.[01] [ ]* \r\n', re.VERBOSE)
+
+METHODS = (b'GET', b'HEAD', b'POST', b'PUT', b'PATCH', b'DELETE', b'OPTIONS')
+
+VERSIONS = (b'HTTP/1.1', b'HTTP/1.0')
+# The HTTP versions we accept.  Other versions are rejected with a 505.
 
 _STATE_IDLE             = 0
 _STATE_READING_HEADERS  = 1
 _STATE_READING_CONTENT  = 2
 _STATE_HANDLING_REQUEST = 3
+_STATE_CLOSING          = 4
+
+_CHUNK_SIZE     = 0 # reading the chunk-size line
+_CHUNK_DATA     = 1 # reading chunk data
+_CHUNK_DATA_END = 2 # reading the CRLF after chunk data
+_CHUNK_TRAILER  = 3 # reading trailer lines after the last chunk
 
 _STATE_NAMES = { v: k for (k,v) in globals().items() if k.startswith('_STATE_') }
 
+_TIMEOUT_ATTRS = {
+    'idle'    : 'keepalive_timeout',
+    'headers' : 'header_timeout',
+    'body'    : 'body_timeout',
+}
+# Maps from the kinds of read timeouts to the HttpProtocol attribute with its
+# length.
+
+counters = Counter()
+# Counts of connection events, for monitoring:
+#
+# read_paused: Reading was paused because too much data was waiting to be processed.
+# read_resumed: Reading was resumed after being paused.
+# timeout_idle: A keep-alive connection was closed because no request arrived.
+# timeout_headers: A request's headers were not received in time.
+# timeout_body: A request's body stopped arriving.
+# timeout_handler: A handler took too long and was cancelled.
+# max_requests: A connection was closed after serving max_requests requests.
+# drain_aborted: A request was still running when a drain timed out.
+# sendfile: A file body was sent using loop.sendfile.
+# sendfile_unsupported: A file body was copied since the loop or transport doesn't support sendfile.
+
+connections = set()
+# The open connections (HttpProtocol objects) on all loops.  Used to drain them
+# when shutting down.
+
+class _Pending:
+    """
+    A request that has been parsed and dispatched but whose response has not
+    been written yet.
+    """
+    __slots__ = ['ctx', 'match', 'allow', 'done', 'error', 'task', 'started', 'timed_out']
+
+    def __init__(self, ctx, match, allow=None, error=None):
+        self.ctx   = ctx
+        self.match = match
+
+        self.allow = allow
+        # The methods the URL accepts, formatted for the Allow header, or None if
+        # no route matches the URL.
+
+        self.done  = False
+        # Set when the handler and middleware have finished and the response
+        # can be written as soon as the responses before it have been.
+
+        self.task = None
+        # The task running the handler.  This is cleared once the handler has
+        # returned (before the middleware completes) since only the handler is
+        # subject to the handler timeout.
+
+        self.started = None
+        # The loop time the handler was started.
+
+        self.timed_out = False
+        # Set if the task was cancelled because the handler took too long.
+
+        self.error = error
+        # If the request was rejected while it was being read there is no
+        # context, only this error code to respond with.
+
+
 class HttpProtocol(Protocol):
 
     _next_id = 1
 
+    pipeline_depth = 1
+    # The maximum number of pipelined requests handled concurrently on one
+    # connection.  Responses are always written in the order the requests were
+    # received.  The default of 1 handles one request at a time, leaving
+    # pipelined requests in the buffer until the previous response is written.
+    # Set using configuration.config(pipeline_depth).
+
+    max_body_size = 1024 * 1024 * 16
+    # The largest request body accepted for routes that don't set their own
+    # max_body_size.  Larger requests are rejected with a 413, before the body is
+    # read if there is a Content-Length.  None means no limit.  Set using
+    # configuration.config(max_body_size).
+
+    read_high_water = 1024 * 256
+    read_low_water  = 1024 * 64
+    # While requests are being handled, reading from the connection is paused
+    # if more than `read_high_water` bytes are waiting to be processed and is
+    # resumed once there are no more than `read_low_water`.  Data waiting is
+    # pipelined requests in the buffer and streamed body data the handler has
+    # not read yet.  Set using configuration.config(read_high_water,
+    # read_low_water).
+
+    header_timeout    = 20
+    body_timeout      = 30
+    keepalive_timeout = 60
+    handler_timeout   = None
+    # Timeouts in seconds, enforced by the reaper.  All of a request's headers
+    # must arrive within `header_timeout` of its first byte and the body must
+    # not stall for more than `body_timeout`.  Both are answered with a 408 and
+    # the connection is closed.  A connection with no request in progress is
+    # closed after `keepalive_timeout`.  A handler running longer than
+    # `handler_timeout` is cancelled and a 503 is returned.  None disables a
+    # timeout.  Set using configuration.config.
+
+    max_requests = None
+    # The maximum number of requests served on one connection.  The response to
+    # the last includes "Connection: close" and the connection is closed after
+    # it is written.  This allows load balancers to spread long-lived clients
+    # across servers.  None means no limit.  Set using
+    # configuration.config(max_requests).
+
     def __init__(self):
         Protocol.__init__(self)
 
@@ -53,10 +197,24 @@ class HttpProtocol(Protocol):
         self.ip = None
         # The IP4 address we are directly connected to.
 
-        self.buffer = b''
+        self.buffer = bytearray()
+        # The receive buffer.  Data before `self.start` has already been
+        # consumed.  We don't remove it immediately since that would copy
+        # everything after it - see _consume.
+
+        self.start = 0
+        # The offset in `self.buffer` of the first unconsumed byte.
+
+        self.scan = 0
+        # The offset in `self.buffer` where the search for the end of the
+        # headers should resume.  This keeps a client that trickles headers in
+        # from causing us to search the same bytes over and over.
 
         self.state = _STATE_READING_HEADERS
 
+        self.loop = None
+        # The event loop we are running on, set when the connection is made.
+
         self.transport = None
         # Set to the transport while we are connected.  Once we close the
         # connection or it is closed on us, we set this back to None.
@@ -66,18 +224,89 @@ class HttpProtocol(Protocol):
         # blank line).
 
         self.request_length = None
-        # The content length of the request.
+        # The content length of the request.  None if the body is chunked.
 
         self.method  = None
         self.url     = None
-        self.match   = None
+        self.version = None
         self.route   = None
-        self.ctx = None # The current request we are handling
+        self.match   = None
+        self.query   = None
+        self.allow   = None
+
+        self.keep_alive = True
+        # False if the request being read is the last we'll read from this
+        # connection.
+
+        self.request_count = 0
+        # The number of requests read from this connection.
+
+        self.client_closed = False
+        # Set when the client has indicated it won't send any more data.  We
+        # close once the requests we already have are answered.
+
+        self.body_limit = None
+        # The maximum body size for the request being read.
+
+        self.body_size = 0
+        # The number of body bytes read so far.
+
+        self.body = None
+        # Collects a chunked body that is not being streamed.
+
+        self.chunk_state = None
+        self.chunk_remaining = 0
+        # The position within a chunked body.  chunk_state is one of the
+        # _CHUNK_* constants and chunk_remaining is the number of bytes of the
+        # current chunk's data that have not been read.  While reading trailers
+        # it is the number of trailer bytes we will still accept.
+
+        self.stream = None
+        # The BodyStream for the request being read if its route streams the
+        # body.  The request is dispatched once the headers are read and the
+        # body is fed to this as it arrives.
+
+        self.streaming = None
+        # The context whose streamed response body is being written.  No other
+        # responses can be written until it is finished.
+
+        self.reading_paused = False
+        # True if we have paused reading from the transport.
+
+        self.reaper = None
+        self.reaper_slot = None
+        self.reaper_deadline = None
+        # The Reaper enforcing our timeouts and its bookkeeping.
+
+        self.read_timeout = None
+        self.read_deadline = None
+        # The timeout that applies to what we are waiting for the client to
+        # send ('idle', 'headers' or 'body') and the loop time it expires.
+
+        self.writing_paused = False
+        self.drain_waiter = None
+        # Set by pause_writing when the transport's write buffer is full.  A
+        # streamed response waits on `drain_waiter` until resume_writing is
+        # called so a slow reader holds up the producer instead of the data
+        # piling up in memory.
+
+        self.pending = deque()
+        # The _Pending entry for each request being handled, in the order
+        # the requests were received.  The response for the first is written
+        # as soon as it is done, followed by any done after it.
+
+        self.draining = False
+        self.close_waiter = None
+        # Set by drain.  While draining, the last response we can tell is the
+        # last one is sent with "Connection: close".  `close_waiter` is a future
+        # completed when the connection is lost.
 
     def connection_made(self, transport):
         assert self.ip is None
 
         self.transport = transport
+        self.loop = get_running_loop()
+        connections.add(self)
 
         peername = transport.get_extra_info('peername')
         self.debug('Connection from %s', peername)
@@ -88,6 +317,9 @@ class HttpProtocol(Protocol):
 
         self.state = _STATE_READING_HEADERS
 
+        self.reaper = get_reaper(self.loop)
+        self._update_timeouts()
+
     def debug(self, msg, *args, exc_info=None):
         logger.debug(msg, *args, exc_info=exc_info)
 
@@ -97,63 +329,544 @@ class HttpProtocol(Protocol):
     def connection_lost(self, exc):
         self.debug('connection_lost')
         self.transport = None
+        connections.discard(self)
+
+        if self.close_waiter and not self.close_waiter.done():
+            self.close_waiter.set_result(None)
+
+        if self.stream:
+            self.stream.set_exception(ConnectionResetError('Connection lost while reading the request body'))
+            self.stream = None
+
+        self._wakeup_writer()
+
+        if self.reaper:
+            self.reaper.schedule(self, None)
+            self.reaper = None
+
+    def drain(self):
+        """
+        Closes the connection once the requests that have been received (or have
+        started to be received) are answered.  The last response is sent with
+        "Connection: close".  An idle connection is closed immediately.
+
+        Returns a future that completes when the connection has been closed.
+        """
+        if self.close_waiter is None:
+            self.close_waiter = self.loop.create_future()
+            if not self.transport:
+                self.close_waiter.set_result(None)
+
+        if not self.draining and self.transport:
+            self.debug('drain')
+            self.draining = True
+            self._write_responses()
+            self._update_timeouts()
+
+        return self.close_waiter
+
+    def in_flight(self):
+        """
+        Returns the number of requests received that have not been answered,
+        including one whose body is still being read.
+        """
+        count = len(self.pending) + (1 if self.streaming else 0)
+        if self.state == _STATE_READING_CONTENT and not self.stream:
+            count += 1
+        return count
+
+    def abort(self):
+        """
+        Closes the connection immediately, cancelling any handlers that are
+        still running.  Returns the number of requests that were abandoned.
+        """
+        count = self.in_flight()
+
+        if self.transport:
+            self.transport.abort()
+
+        for pending in self.pending:
+            if pending.task:
+                pending.task.cancel()
+
+        return count
+
+    def pause_writing(self):
+        self.debug('pause_writing')
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.debug('resume_writing')
+        self.writing_paused = False
+        self._wakeup_writer()
+
+    def _wakeup_writer(self):
+        waiter = self.drain_waiter
+        if waiter is not None:
+            self.drain_waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _drain(self):
+        """
+        Waits until the transport can accept more data.
+        """
+        while self.writing_paused and self.transport:
+            self.drain_waiter = self.loop.create_future()
+            await self.drain_waiter
 
     def data_received(self, data):
         # data: Bytes
+        if self.state == _STATE_CLOSING:
+            # We've stopped reading from this connection.
+            return
+
         self.buffer += data
         self.debug('data_received')
         self._process_buffer()
+        self._update_reading()
+        self._update_timeouts(received=True)
+
+    def _update_timeouts(self, received=False):
+        """
+        Determines what we are waiting for and schedules the connection with the
+        reaper for when that should time out.  Call this whenever the state
+        changes.
+
+        received
+          True if data was just received.  A body that is making progress gets a
+          new deadline.
+        """
+        if not self.reaper:
+            return
 
-    def _process_buffer(self):
-        self.debug('_process_buffer')
-        if self.state == _STATE_READING_HEADERS:
-            parts = self.buffer.split(b'\r\n\r\n', 1)
+        if self.state == _STATE_READING_HEADERS and len(self.buffer) > self.start:
+            timeout = 'headers'
+        elif self.state == _STATE_READING_CONTENT and not self.reading_paused:
+            # (While reading is paused the handler is the one holding things
+            # up, so only the handler timeout applies.)
+            timeout = 'body'
+        elif self.state == _STATE_READING_HEADERS and not self.pending and not self.streaming:
+            timeout = 'idle'
+        else:
+            # We're the ones holding things up.
+            timeout = None
+
+        if timeout != self.read_timeout or (received and timeout == 'body'):
+            self.read_timeout = timeout
+            seconds = getattr(self, _TIMEOUT_ATTRS[timeout]) if timeout else None
+            self.read_deadline = self.reaper.loop.time() + seconds if seconds else None
+
+        deadline = self.read_deadline
+
+        if self.handler_timeout:
+            for pending in self.pending:
+                if pending.task and not pending.timed_out:
+                    # Handlers start in order, so this is the first to expire.
+                    expires = pending.started + self.handler_timeout
+                    if deadline is None or expires < deadline:
+                        deadline = expires
+                    break
+
+        self.reaper.schedule(self, deadline)
+
+    def _reap(self, now):
+        """
+        Called by the reaper when our deadline has passed.
+        """
+        if not self.transport:
+            return
 
-            if len(parts[0]) > MAX_HEADERS:
-                # (By putting the check here we check the length when the
-                # end-of-headers has been found and when it hasn't.)
-                self.error('Headers too large: length=%s', len(parts[0]))
-                raise HttpError(431)
+        if self.read_deadline is not None and self.read_deadline <= now:
+            timeout = self.read_timeout
+            counters['timeout_' + timeout] += 1
+            self.read_timeout = None
+            self.read_deadline = None
 
-            if len(parts) == 1:
-                # Haven't seen the end-of-headers yet.
+            if timeout == 'idle':
+                self.debug('Closing idle connection')
+                self.transport.close()
                 return
 
-            self.buffer = parts[1]
+            self.error('Timed out reading request %s: url=%s', timeout, self.url)
+            self._reject(408)
+
+        if self.handler_timeout:
+            for pending in self.pending:
+                if pending.task and not pending.timed_out and pending.started + self.handler_timeout <= now:
+                    counters['timeout_handler'] += 1
+                    pending.timed_out = True
+                    pending.task.cancel()
+
+        self._update_timeouts()
+
+    def _update_reading(self):
+        """
+        Pauses reading from the transport if too much data is waiting for
+        handlers and resumes once enough of it has been processed.
+        """
+        if not self.transport:
+            return
+
+        waiting = self.stream.buffered if self.stream else 0
+        if self.state == _STATE_HANDLING_REQUEST:
+            # The buffer holds pipelined requests we aren't ready to parse.
+            # (While reading headers or a body the buffer is bounded by the
+            # header and body limits.)
+            waiting += len(self.buffer) - self.start
+
+        if self.reading_paused:
+            if waiting <= self.read_low_water:
+                self.debug('resume_reading waiting=%s', waiting)
+                self.reading_paused = False
+                counters['read_resumed'] += 1
+                self.transport.resume_reading()
+                # The client gets a new body deadline from now.
+                self._update_timeouts()
+        elif waiting > self.read_high_water:
+            self.debug('pause_reading waiting=%s', waiting)
+            self.reading_paused = True
+            counters['read_paused'] += 1
+            self.transport.pause_reading()
+
+    def _consume(self, length):
+        """
+        Marks `length` bytes at the front of the buffer as consumed.
+        """
+        self.start += length
+
+        if self.start == len(self.buffer):
+            self.buffer.clear()
+            self.start = 0
+        elif self.start >= COMPACT_THRESHOLD:
+            del self.buffer[:self.start]
+            self.start = 0
+
+        self.scan = self.start
+
+    def _process_buffer(self):
+        self.debug('_process_buffer')
+        try:
+            while self._process_request():
+                pass
+        except HttpError as ex:
+            self.error('HTTP error %s %s url=%s', ex.code, str(ex), self.url)
+            self._reject(ex.code)
+
+    def _process_request(self):
+        """
+        Parses the next request from the buffer and dispatches it.  Returns True
+        if a request was dispatched and there may be another in the buffer.
+        """
+        if self.state in (_STATE_READING_HEADERS, _STATE_HANDLING_REQUEST):
+            if len(self.pending) >= self.pipeline_depth:
+                # Leave pipelined requests in the buffer until a handler
+                # completes.
+                self.state = _STATE_HANDLING_REQUEST
+                return False
+
+            self.state = _STATE_READING_HEADERS
+
+            # Only search the bytes we haven't searched before (backing up 3 in
+            # case the terminator was split across reads) and never search past
+            # the point where the headers would be too large.
+            end = self.buffer.find(b'\r\n\r\n', max(self.start, self.scan - 3), self.start + MAX_HEADERS + 4)
+
+            if end == -1:
+                if len(self.buffer) - self.start > MAX_HEADERS:
+                    self.error('Headers too large: length=%s', len(self.buffer) - self.start)
+                    raise HttpError(431)
+
+                # Haven't seen the end-of-headers yet.
+                self.scan = len(self.buffer)
+                return False
 
-            self.method, self.url, headers = self.parse_start_line(parts[0])
+            self.method, self.url, self.version, headers = self.parse_start_line(bytes(self.buffer[self.start:end]))
             self.headers = self.parse_headers(headers)
+            self._consume(end + 4 - self.start)
+
+            self._start_body()
+
+        if self.state != _STATE_READING_CONTENT:
+            return False
 
-            self.request_length = int(self.headers.get('content-length', 0))
+        if self.request_length is None:
+            if not self._read_chunks():
+                return False
+            body = bytes(self.body) if self.body is not None else None
 
-            self.state = _STATE_READING_CONTENT
+        elif self.stream:
+            count = min(len(self.buffer) - self.start, self.request_length - self.body_size)
+            if count:
+                self._body_data(count)
+            if self.body_size < self.request_length:
+                return False
+            body = None
+
+        else:
+            if len(self.buffer) - self.start < self.request_length:
+                return False
 
-        if self.state == _STATE_READING_CONTENT and len(self.buffer) >= self.request_length:
             # Remember, if multiple requests are pipelined there can be *more*
             # data in the buffer than the content length.
+            #
+            # Copy the body directly out of the buffer.  The memoryview keeps
+            # us from making an intermediate bytearray copy first.
+
+            with memoryview(self.buffer) as view:
+                body = bytes(view[self.start:self.start + self.request_length])
+            self._consume(self.request_length)
 
-            body = self.buffer[:self.request_length]
-            self.buffer = self.buffer[self.request_length:]
+        self.state = _STATE_HANDLING_REQUEST
 
-            self.state = _STATE_HANDLING_REQUEST
+        if self.stream:
+            # The handler is already running.
+            self.stream.feed_eof()
+            self.stream = None
+        else:
             self.handle_request(body)
 
+        self.request_length = None
+        self.method  = None
+        self.url     = None
+        self.version = None
+        self.headers = None
+        self.route   = None
+        self.match   = None
+        self.query   = None
+        self.allow   = None
+        self.body    = None
+
+        if not self.keep_alive:
+            # That was the last request we will read.
+            self._stop_reading()
+            self._write_responses()
+            return False
+
+        return True
+
+    def _keep_alive(self):
+        """
+        Returns True if the connection can be reused after the request whose
+        headers were just read.
+        """
+        self.request_count += 1
+        if self.max_requests and self.request_count >= self.max_requests:
+            counters['max_requests'] += 1
+            return False
+
+        tokens = [t.strip().lower() for t in self.headers.get('connection', '').split(',')]
+
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+
+        return 'close' not in tokens
+
+    def _start_body(self):
+        """
+        Called when the headers have been parsed to determine how the body will
+        be read.  A body that is too large is rejected here if we can tell from
+        the Content-Length.
+        """
+        self.route, self.match, self.query, self.allow = routing.resolve(self.method, self.url)
+
+        self.keep_alive = self._keep_alive()
+
+        te = self.headers.get('transfer-encoding')
+        if te is not None:
+            if te.lower() != 'chunked':
+                raise HttpError(501)
+            if 'content-length' in self.headers:
+                # Ambiguous lengths are how request smuggling works.
+                raise HttpError(400)
+            self.request_length  = None
+            self.chunk_state     = _CHUNK_SIZE
+            self.chunk_remaining = 0
+        else:
+            cl = self.headers.get('content-length', '0')
+            if not cl.isdigit():
+                raise HttpError(400)
+            self.request_length = int(cl)
+
+        if self.route and self.route.max_body_size is not None:
+            self.body_limit = self.route.max_body_size
+        else:
+            self.body_limit = self.max_body_size
+
+        if self.request_length and self.body_limit is not None and self.request_length > self.body_limit:
+            raise HttpError(413)
+
+        if self.draining and self.keep_alive:
+            if self.request_length is None or len(self.buffer) - self.start <= self.request_length:
+                # Nothing has been pipelined after this request, so make it the
+                # last.  (We can't tell where a chunked body ends.)
+                self.keep_alive = False
+
+        if (self.headers.get('expect', '').lower() == '100-continue' and not self.pending and not self.streaming and
+                self.version == 'HTTP/1.1'):
+            # The client is waiting to hear that we want the body.  (If there
+            # are responses waiting to be written we can't write this ahead of
+            # them.  The client will eventually give up waiting and send it.)
+            self.transport.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        self.body_size = 0
+        self.state = _STATE_READING_CONTENT
+
+        if self.route and self.route.stream_body:
+            self.stream = BodyStream(on_read=self._update_reading)
+            self.handle_request(None)
+        elif self.request_length is None:
+            self.body = bytearray()
+
+    def _body_data(self, count):
+        """
+        Called as each piece of the body is read to pass the next `count` bytes
+        in the buffer to the body and consume them.
+        """
+        self.body_size += count
+
+        if self.body_limit is not None and self.body_size > self.body_limit:
+            raise HttpError(413)
+
+        with memoryview(self.buffer)[self.start:self.start + count] as data:
+            if self.stream:
+                self.stream.feed_data(bytes(data))
+            else:
+                self.body.extend(data)
+
+        self._consume(count)
+
+    def _read_line(self):
+        """
+        Returns the length of the next CRLF-terminated line in the buffer
+        (excluding the CRLF) or None if it has not all been received.
+        """
+        end = self.buffer.find(b'\r\n', self.start)
+        if end == -1:
+            if len(self.buffer) - self.start > MAX_CHUNK_LINE:
+                raise HttpError(400)
+            return None
+        if end - self.start > MAX_CHUNK_LINE:
+            raise HttpError(400)
+        return end - self.start
+
+    def _read_chunks(self):
+        """
+        Decodes as much of a chunked body as has been received.  Returns True
+        once the last chunk and any trailers have been read.
+        """
+        while True:
+            if self.chunk_state == _CHUNK_DATA:
+                count = min(len(self.buffer) - self.start, self.chunk_remaining)
+                if not count:
+                    return False
+                self._body_data(count)
+                self.chunk_remaining -= count
+                if not self.chunk_remaining:
+                    self.chunk_state = _CHUNK_DATA_END
+                continue
+
+            length = self._read_line()
+            if length is None:
+                return False
+
+            line = bytes(self.buffer[self.start:self.start + length])
+            self._consume(length + 2)
+
+            if self.chunk_state == _CHUNK_SIZE:
+                # Ignore any chunk extensions after a semicolon.  (Whitespace
+                # is only allowed before the semicolon.)
+                size, semicolon, _ = line.partition(b';')
+                if semicolon:
+                    size = size.rstrip(b' \t')
+                if not RE_CHUNK_SIZE.fullmatch(size):
+                    raise HttpError(400)
+                size = int(size, 16)
+                if size:
+                    self.chunk_state     = _CHUNK_DATA
+                    self.chunk_remaining = size
+                else:
+                    self.chunk_state     = _CHUNK_TRAILER
+                    self.chunk_remaining = MAX_HEADERS
+
+            elif self.chunk_state == _CHUNK_DATA_END:
+                if line:
+                    raise HttpError(400)
+                self.chunk_state = _CHUNK_SIZE
+
+            else:
+                # _CHUNK_TRAILER: We don't use trailers, so skip lines until the
+                # blank one that ends the body.  They are limited like headers
+                # so they can't trickle in forever.
+                if not line:
+                    self.chunk_state = None
+                    return True
+                self.chunk_remaining -= length + 2
+                if self.chunk_remaining < 0:
+                    raise HttpError(431)
+
+    def _reject(self, code):
+        """
+        Responds with an error to a request we could not read and closes the
+        connection once the responses before it have been written.  We don't
+        know where the next request would start, so we stop reading.
+        """
+        if self.stream:
+            # The handler is already running, so it responds.  It will get the
+            # error when it reads the body.
+            stream = self.stream
+            stream.set_exception(HttpError(code))
+            self.stream = None
+            if self.pending and self.pending[-1].ctx and self.pending[-1].ctx.request.stream is stream:
+                self.pending[-1].ctx.request.keep_alive = False
+            else:
+                # The handler returned without reading the whole body and its
+                # response has already been written (or is being written), so
+                # the rest of the body can't be answered.
+                self._stop_reading()
+                if not self.streaming and self.transport:
+                    self.transport.close()
+                return
+        else:
+            pending = _Pending(None, None, error=code)
+            pending.done = True
+            self.pending.append(pending)
+
+        self._stop_reading()
+        self._write_responses()
+
+    def _stop_reading(self):
+        """
+        Stops reading requests from the connection.  It is closed by
+        _write_responses once the responses for the requests we've already read
+        are written.
+        """
+        self.state = _STATE_CLOSING
+
+        self.buffer.clear()
+        self.start = 0
+        self.scan  = 0
 
     def parse_start_line(self, buffer):
-        line, headers = buffer.split(b'\r\n', 1)
+        line, _, headers = buffer.partition(b'\r\n')
 
         tokens = line.split(None)
         # method url HTTP/1.1
-        if len(tokens) != 3 or tokens[0] not in (b'GET', b"POST", b'PUT', b'DELETE'):
+        if len(tokens) != 3 or tokens[0] not in METHODS or not tokens[2].startswith(b'HTTP/'):
             self.error('Invalid start line: "%s"', line)
             raise HttpError(400)
 
+        if tokens[2] not in VERSIONS:
+            self.error('Unsupported version: "%s"', line)
+            raise HttpError(505)
+
         # TODO: Decode the URL
 
-        method = str(tokens[0], encoding='ascii')
-        url    = str(tokens[1], encoding='ascii')
+        method  = str(tokens[0], encoding='ascii')
+        url     = str(tokens[1], encoding='ascii')
+        version = str(tokens[2], encoding='ascii')
 
-        return method, url, headers
+        return method, url, version, headers
 
 
     def parse_headers(self, raw):
@@ -161,6 +874,9 @@ class HttpProtocol(Protocol):
 
         headers = LowerDict()
 
+        if not raw:
+            return headers
+
         for line in raw.split('\r\n'):
             parts = line.split(':', 1)
             if len(parts) != 2 or not len(parts[0]) or ' ' in parts[0]:
@@ -182,80 +898,362 @@ class HttpProtocol(Protocol):
 
 
     def handle_request(self, body):
-
-        # It doesn't seem possible to use async (ensure_future) and pass
-        # parameters.  I guess we have to first launch a function with no
-        # parameters that then yields to the one we want.  I've put the handler
-        # into the request.
-
-        self.route, self.match = routing.get(self.url)
-
         ip = self.headers.get('X-Forwarded-For', self.ip)
 
-        request = Request(self, self.method, self.url, self.headers, body)
-        self.ctx = Context(self.route, request, ip)
-
-        async(self._handle_request_coroutine())
+        request = Request(self, self.method, self.url, self.headers, body, stream=self.stream,
+                          version=self.version, keep_alive=self.keep_alive, query=self.query)
+        pending = _Pending(Context(self.route, request, ip), self.match, self.allow)
+        self.pending.append(pending)
 
+        pending.started = self.loop.time()
+        pending.task = self.loop.create_task(self._handle_request_coroutine(pending))
 
-    @coroutine
-    def _handle_request_coroutine(self):
-        ctx = self.ctx
 
-        # TODO: Errors are not going through the context and middleware.
+    async def _handle_request_coroutine(self, pending):
+        ctx   = pending.ctx
+        route = ctx.route
 
         try:
             for m in middleware:
                 result = m.start(ctx)
-                if result and inspect.isgenerator(result):
-                    # The middleware function is a generator.
-                    yield from result
-
-            if not self.route:
-                raise HttpError(404, ctx.url)
-
-            ctx.response.body = yield from self.route(self.match, ctx)
+                if result is not None and inspect.isawaitable(result):
+                    # The middleware function is a coroutine.
+                    await result
+
+            if ctx.request.method == 'OPTIONS':
+                # Answered from the route table without calling the handler.
+                if ctx.url == '*':
+                    allow = ', '.join(routing.METHODS)
+                elif pending.allow:
+                    allow = pending.allow
+                else:
+                    raise HttpError(404, ctx.url)
+
+                ctx.response.status = 204
+                ctx.response.headers['allow'] = allow
+
+            else:
+                if not route:
+                    if pending.allow:
+                        # The URL exists but not for this method.
+                        ctx.response.headers['allow'] = pending.allow
+                        raise HttpError(405, ctx.url)
+                    raise HttpError(404, ctx.url)
+
+                # HEAD requests are handled by the GET handler and _send leaves
+                # out the body.
+                ctx.response.body = await route(pending.match, ctx)
 
         except HttpError as ex:
             ctx.response.status = ex.code
+            ctx.response.body   = None
             self.error('HTTP error %s %s url=%s', ex.code, str(ex), ctx.url)
-            self._complete_with_error(ex.code)
 
         except:
-            ctx.response.status = 500
-            self.error('Unhandled error in %s', self.route, exc_info=True)
-            self._complete_with_error(500)
-
-        for m in reversed(middleware):
-            result = m.complete(ctx)
-            if result and inspect.isgenerator(result):
-                # The middleware function is a generator.
-                yield from result
+            ctx.response.body = None
+            if pending.timed_out:
+                ctx.response.status = 503
+                self.error('Handler timed out: %s url=%s', route, ctx.url)
+            elif not self.transport:
+                # The connection was aborted, which cancels the handler.
+                self.debug('Handler cancelled: %s url=%s', route, ctx.url)
+            else:
+                ctx.response.status = 500
+                self.error('Unhandled error in %s', route, exc_info=True)
+
+        pending.task = None
 
         try:
-            ctx.response._send(ctx, self.transport)
+            for m in reversed(middleware):
+                result = m.complete(ctx)
+                if result is not None and inspect.isawaitable(result):
+                    # The middleware function is a coroutine.
+                    await result
         except:
-            # An error happened while we were sending.  (Try to do as little as
-            # possible in _send so there is less chance of getting an exception
-            # there.)  At this point our best bet is to abort.
-            logger.error('An error occurred while trying to send: %r', ctx, exc_info=True)
+            # (For example, the codec couldn't encode the handler's result.)
+            # The response may be half built, so replace it.  The response must
+            # still be marked done or the responses after it would never be
+            # written.
+            self.error('Unhandled error completing %s', route, exc_info=True)
+            ctx.response = Response()
+            ctx.response.status = 500
 
-        # Reset everything
-        self.state = _STATE_READING_HEADERS
+        pending.done = True
+        self._responses_ready()
 
-        self.request_length = None
-        self.method  = None
-        self.url     = None
-        self.headers = None
-        self.route   = None
-        self.match   = None # Can we put this into the route or request?
-        self.ctx     = None
+    def _responses_ready(self):
+        """
+        Called when a response is done or a streamed body has been written to
+        write the responses that can be and parse pipelined requests.
+        """
+        self._write_responses()
 
-        if self.buffer:
+        if self.state == _STATE_HANDLING_REQUEST:
+            # We may have stopped parsing because too many requests were
+            # pipelined.
             self._process_buffer()
+            self._update_reading()
+
+            # If the buffer held no more requests, a client that has closed
+            # its side (or a draining connection) is finished.
+            self._close_if_done()
+
+        self._update_timeouts()
+
+    def _write_responses(self):
+        """
+        Writes the responses that are done, stopping at the first request that
+        is still being handled so responses are sent in request order.
+        """
+        while self.pending and self.pending[0].done and not self.streaming:
+            pending = self.pending.popleft()
+            ctx = pending.ctx
+
+            if not self.transport:
+                # Already disconnected.
+                continue
+
+            if not ctx:
+                self.complete(pending.error, [b'Connection: close'])
+                continue
+
+            if self.draining and not self.pending and self._nothing_buffered():
+                # This is the last response we'll send, so tell the client.
+                ctx.request.keep_alive = False
+
+            try:
+                ctx.response._send(ctx, self.transport)
+            except:
+                # An error happened while we were sending.  (Try to do as little as
+                # possible in _send so there is less chance of getting an exception
+                # there.)  _send writes everything in one call at the end, so
+                # nothing has been written yet and a plain 500 can be sent in
+                # its place.  Skipping the response would make the client take
+                # the next one as the answer to this request.
+                logger.error('An error occurred while trying to send: %r', ctx, exc_info=True)
+                self._discard_body(ctx.response.body)
+                ctx.response = Response()
+                ctx.response.status = 500
+                try:
+                    ctx.response._send(ctx, self.transport)
+                except:
+                    logger.error('An error occurred while trying to send a 500: %r', ctx, exc_info=True)
+                    self._abandon()
+                    return
+
+            if not ctx.request.keep_alive:
+                # This response told the client we're closing.  (If a handler
+                # turned off keep_alive there may be pipelined requests after
+                # it, but they can't be answered now.)
+                self.pending.clear()
+                if self.state != _STATE_CLOSING:
+                    self._stop_reading()
+
+            body = ctx.response.body
+            if ctx.request.method == 'HEAD':
+                # We don't need the body after all.
+                self._discard_body(body)
+            elif is_stream(body):
+                # _send only wrote the headers.  The rest of the responses
+                # have to wait until the body has been written.
+                self.streaming = ctx
+                self.loop.create_task(self._write_stream(ctx))
+            elif type(body) is FileBody:
+                self.streaming = ctx
+                self.loop.create_task(self._write_file(ctx))
+
+        self._close_if_done()
+
+    def _close_if_done(self):
+        """
+        Closes the connection if every response has been written and no more
+        requests will be answered on it.
+        """
+        if self.pending or self.streaming or not self.transport:
+            return
+
+        if self.state == _STATE_CLOSING or (self.client_closed and self.state == _STATE_READING_HEADERS):
+            # (When reading headers, anything in the buffer is an incomplete
+            # request that will never be completed.)
+            self.transport.close()
+        elif self.draining and self._nothing_buffered():
+            self.transport.close()
+
+    def _nothing_buffered(self):
+        """
+        Returns True if no part of another request has been received.
+        """
+        if self.state == _STATE_READING_CONTENT:
+            # Only the handler of a streamed body has a response to write while
+            # its body is being read.
+            return self.stream is not None
+        return len(self.buffer) == self.start
+
+    async def _write_stream(self, ctx):
+        """
+        Writes a response body that is an iterator or async iterator of chunks
+        using the chunked transfer-encoding.
+        """
+        body = ctx.response.body
+
+        try:
+            if hasattr(body, '__aiter__'):
+                async for chunk in body:
+                    if not self.transport:
+                        break
+                    await self._write_chunk(chunk, ctx.response.chunked)
+            else:
+                for chunk in body:
+                    if not self.transport:
+                        break
+                    await self._write_chunk(chunk, ctx.response.chunked)
+
+            if self.transport and ctx.response.chunked:
+                self.transport.write(b'0\r\n\r\n')
+        except:
+            # The headers have been sent, so the best we can do is close the
+            # connection without the final chunk so the client knows the
+            # response is incomplete.
+            logger.error('An error occurred while streaming the response: %r', ctx, exc_info=True)
+            self._abandon()
+
+        await self._close_stream(body)
+
+        self.streaming = None
+        self._responses_ready()
+
+    async def _write_file(self, ctx):
+        """
+        Writes a FileBody, sending its ranges of the file using loop.sendfile.
+        This falls back to copying the file for transports where the kernel
+        can't write to the socket directly, such as TLS.
+        """
+        body = ctx.response.body
+        sendfile = True
+
+        try:
+            for part in body.parts:
+                if not self.transport or self.transport.is_closing():
+                    break
+
+                if type(part) is not tuple:
+                    self.transport.write(part)
+                    if self.writing_paused:
+                        await self._drain()
+                    continue
+
+                offset, count = part
+                sent = None
+                if sendfile:
+                    try:
+                        sent = await self.loop.sendfile(self.transport, body.file, offset, count)
+                        counters['sendfile'] += 1
+                    except (NotImplementedError, RuntimeError):
+                        # Raised before anything is sent if the loop (e.g.
+                        # uvloop) or transport doesn't support sendfile at all.
+                        if not self.transport or self.transport.is_closing():
+                            raise
+                        counters['sendfile_unsupported'] += 1
+                        sendfile = False
+                if sent is None:
+                    sent = await self._copy_file(body.file, offset, count)
+
+                if self.transport and sent != count:
+                    # The file was changed after we sent the Content-Length.
+                    # Close the connection so the client knows the response is
+                    # incomplete.
+                    logger.error('File body sent %s bytes instead of %s: %r', sent, count, ctx)
+                    self._abandon()
+                    break
+        except:
+            if self.transport:
+                logger.error('An error occurred while sending a file: %r', ctx, exc_info=True)
+                self._abandon()
+
+        body.close()
+
+        self.streaming = None
+        self._responses_ready()
+
+    async def _copy_file(self, file, offset, count):
+        """
+        Writes part of a file by reading it in the default executor, returning
+        the number of bytes written.
+        """
+        remaining = count
+        file.seek(offset)
+        while remaining and self.transport:
+            data = await self.loop.run_in_executor(None, file.read, min(remaining, FILE_BLOCK_SIZE))
+            if not data:
+                break
+            self.transport.write(data)
+            remaining -= len(data)
+            if self.writing_paused:
+                await self._drain()
+        return count - remaining
+
+    def _abandon(self):
+        """
+        Closes the connection immediately after a response body failed partway.
+        Closing is the only way the client can tell the body is incomplete, so
+        nothing can be written after it, including the responses to pipelined
+        requests.
+        """
+        for pending in self.pending:
+            if pending.task:
+                pending.task.cancel()
+        self.pending.clear()
+
+        self._stop_reading()
+        if self.transport:
+            self.transport.close()
+
+    def _discard_body(self, body):
+        """
+        Releases a response body that won't be sent.
+        """
+        if is_stream(body):
+            self.loop.create_task(self._close_stream(body))
+        elif type(body) is FileBody:
+            body.close()
+
+    async def _close_stream(self, body):
+        """
+        Closes a streamed response body so a generator can clean up, even if
+        it was not read to the end.
+        """
+        close = getattr(body, 'aclose', None)
+        if close:
+            await close()
+        else:
+            close = getattr(body, 'close', None)
+            if close:
+                close()
+
+    async def _write_chunk(self, chunk, chunked):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf8')
+        if not chunk:
+            # An empty chunk would end the body.
+            return
+        if chunked:
+            self.transport.writelines([b'%x\r\n' % len(chunk), chunk, b'\r\n'])
+        else:
+            # An HTTP/1.0 client - the end of the body is marked by closing the
+            # connection.
+            self.transport.write(chunk)
+        if self.writing_paused:
+            await self._drain()
 
     def eof_received(self):
-        pass
+        # The client has closed its side of the connection.  If we're handling
+        # requests keep the connection open so we can send the responses.
+        # Returning a false value closes the transport.
+        self.client_closed = True
+        if self.state == _STATE_READING_CONTENT:
+            # We'll never get the rest of the body.
+            return None
+        return bool(self.pending or self.streaming)
 
     def complete(self, code, headers=None, body=None):
         if not self.transport:
@@ -276,11 +1274,14 @@ class HttpProtocol(Protocol):
             assert all(b'content-length:' not in h.lower() for h in headers)
             response.extend(headers)
 
+        # The blank line that ends the headers.
         response.append(b'')
 
         if body:
             assert isinstance(body, bytes), 'Forgot to convert body to bytes: {!r}'.format(body)
             response.append(body)
+        else:
+            response.append(b'')
 
         response = b'\r\n'.join(response)
 
@@ -288,7 +1289,3 @@ class HttpProtocol(Protocol):
 
         # Don't reset flags yet.  Wait until the handler returns in
         # _handle_request_coroutine
-
-    def _complete_with_error(self, code):
-        # You should have already logged the error.
-        self.complete(code)
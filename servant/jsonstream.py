@@ -0,0 +1,117 @@
+"""
+Streams large list responses as JSON without building them in memory.
+
+A handler that returns a list normally has it encoded into one bytes object
+which is then compressed into another, so a large result is held in memory
+several times over.  A route registered with @route(stream_json="json") or
+stream_json="ndjson" instead has its result encoded an item at a time, fed
+through a streaming compressor and sent using the chunked transfer-encoding as
+it is produced.  The handler can return a list or any iterable or async
+iterable (such as a generator reading rows from a database), in which case
+memory use doesn't depend on the size of the result at all.
+
+"json" sends a JSON array.  "ndjson" sends newline-delimited JSON: one item per
+line, which clients can process as it arrives.
+
+Each item is encoded with the configured codec (see codec.py), which is much
+faster than JSONEncoder.iterencode's pure-Python generator, and the encoded
+items are collected into chunks of about CHUNK_SIZE bytes so the connection
+isn't written to for every item.
+"""
+
+from .responses import Response
+from . import compression
+
+CHUNK_SIZE = 64 * 1024
+# Encoded items are sent once at least this many bytes have been collected.
+
+content_types = {
+    'json'   : 'application/json',
+    'ndjson' : 'application/x-ndjson',
+}
+
+
+def stream(ctx, items, format):
+    """
+    Sets ctx.response to stream `items`, a list, iterable or async iterable of
+    objects to be JSON encoded, in the given format ("json" or "ndjson").  The
+    body is compressed if the client accepts a coding.
+    """
+    response = ctx.response
+    response.status = 200
+    response.headers['content-type'] = content_types[format]
+
+    body = _encode(items, format)
+
+    # The size isn't known in advance, so compression.min_size doesn't apply.
+    selected = compression.select(ctx)
+    if selected is not None:
+        coding, level = selected
+        response.headers['content-encoding'] = coding
+        body = _compress(body, compression.compressobj(coding, level))
+
+    response.body = body
+
+
+async def _encode(items, format):
+    encode = Response._codec.encode
+    parts = []
+    size = 0
+
+    if format == 'json':
+        parts.append(b'[')
+        separator = b','
+        first = True
+
+    try:
+        iterator = items if hasattr(items, '__aiter__') else _iterate(items)
+
+        async for item in iterator:
+            data = encode(item)
+            if format == 'json':
+                if first:
+                    first = False
+                else:
+                    parts.append(separator)
+                parts.append(data)
+            else:
+                parts.append(data)
+                parts.append(b'\n')
+
+            size += len(data)
+            if size >= CHUNK_SIZE:
+                yield b''.join(parts)
+                parts.clear()
+                size = 0
+
+        if format == 'json':
+            parts.append(b']')
+        if parts:
+            yield b''.join(parts)
+
+    finally:
+        # Let a generator returned by the handler clean up if the client
+        # disconnected.
+        close = getattr(items, 'aclose', None)
+        if close:
+            await close()
+        else:
+            close = getattr(items, 'close', None)
+            if close:
+                close()
+
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+
+async def _compress(chunks, compressor):
+    try:
+        async for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        await chunks.aclose()
@@ -1,12 +1,18 @@
-
-import gzip, json
+from asyncio import get_running_loop
 from servant import File
-from servant.responses import Response
+from servant.responses import FileBody, is_stream
 from servant.middleware import Middleware
+from servant.compression import choose, add_vary
+from servant import offload, jsonstream, ranges
 
 class ResponseMiddleware(Middleware):
     """
     Examines URL handler responses and converts them to bytes if necessary.
+
+    JSON and other compressible bodies are compressed using an encoding the
+    client accepts (see compression.py).  Large bodies are encoded and
+    compressed in an executor (see offload.py), in which case this returns a
+    coroutine.
     """
     def complete(self, ctx):
 
@@ -21,36 +27,80 @@ class ResponseMiddleware(Middleware):
             response.status = 204
             return
 
+        if ctx.route is not None and ctx.route.stream_json and not isinstance(body, (dict, bytes, str, File)):
+            # A list, generator, etc. of items to be encoded one at a time.
+            jsonstream.stream(ctx, body, ctx.route.stream_json)
+            return
+
         if isinstance(body, dict) or isinstance(body, list):
             response.status = 200
-            response.body   = json.dumps(body, default=Response._ohook).encode('utf8')
-
-            if len(response.body) > 200:
-                response.headers['content-encoding'] = 'gzip'
-                response.body = gzip.compress(response.body)
-                
-            response.headers['content-type']   = 'application/json'
-            response.headers['content-length'] = len(response.body)
-            return
+            response.headers['content-type'] = 'application/json'
+            return offload.encode(ctx, body)
 
         if isinstance(body, File):
-            if body.etag and body.etag == ctx.request.headers.get('if-none-match', None):
+            headers = ctx.request.headers
+            coding = choose(headers.get('accept-encoding'), body.encodings)
+
+            if body.encodings:
+                add_vary(response.headers, 'Accept-Encoding')
+
+            response.headers['etag'] = body.etags[coding]
+
+            if_none_match = headers.get('if-none-match')
+            if if_none_match and body.matches(if_none_match, coding):
                 response.status = 304
                 response.body   = None
                 return
 
-            if body.etag:
-                response.headers['etag'] = body.etag
+            response.headers['accept-ranges'] = 'bytes'
+            response.headers['content-type']  = body.mimetype
+            if coding:
+                response.headers['content-encoding'] = coding
+
+            range_header = headers.get('range')
+            if range_header and ctx.request.method == 'GET' and ranges.respond(ctx, body, coding, range_header):
+                if type(response.body) is FileBody:
+                    return _open(response, body.path)
+                return
 
-            if body.compressed:
-                response.headers['content-encoding'] = 'gzip'
+            if coding:
+                content = body.encodings[coding]
+            elif body.content is None:
+                # A large file sent from disk.
+                content = FileBody(None, [(0, body.size)])
+            else:
+                content = body.content
 
             response.status = 200
-            response.body   = body.content
-            response.headers['content-type']   = body.mimetype
-            response.headers['content-length'] = len(response.body)
+            response.body   = content
+            response.headers['content-length'] = str(len(content))
+
+            if type(content) is FileBody and ctx.request.method != 'HEAD':
+                # (A HEAD response only needs the length, so the file isn't
+                # opened.)
+                return _open(response, body.path)
 
             return
 
+        if is_stream(body):
+            # Sent using the chunked transfer-encoding as the handler produces it.
+            response.status = 200
+            return
+
         if not isinstance(body, bytes):
             raise Exception('Response is not bytes: ctx=%s resp=%s' % (ctx, body))
+
+        return offload.compress(ctx)
+
+
+async def _open(response, path):
+    """
+    Opens the file for a FileBody response.  This is done in an executor since
+    opening a file can block on disk I/O.
+    """
+    try:
+        response.body.file = await get_running_loop().run_in_executor(None, open, path, 'rb')
+    except OSError:
+        response.status = 404
+        response.body   = None
+        response.headers.pop('content-range', None)
@@ -0,0 +1,277 @@
+"""
+Moves slow response work - JSON encoding and compression - off the event loop.
+
+A multi-megabyte response can take tens of milliseconds to encode and
+compress, and every other connection handled by the worker waits while it does.
+Small bodies are cheap and handing them to another thread costs more than it
+saves, so work is only offloaded when it is expected to take longer than
+`threshold` seconds.
+
+The expected time is the size of the body times the measured time per byte,
+which is kept for encoding and each compression coding as a moving average of
+the bodies processed so far.  Nothing is offloaded until a rate has been
+measured.  The size of a dictionary or list isn't known until it is encoded,
+so the encoded size of each route's recent responses is used.
+
+Compression (zlib, brotli and zstandard) releases the GIL, so it runs in
+parallel on a thread pool.  JSON encoders don't: encoding on another thread
+would block the event loop just as much, so encoding is only offloaded if
+`executor` is a ProcessPoolExecutor.  The response object has to be pickled to
+send it to the process, which is done on the event loop and timed like
+encoding.  Encoding is only offloaded if pickling is expected to save more than
+the threshold, which is typical for the json module but not for orjson, which
+is faster than pickle.  Process pool workers use the codec and compression settings that
+were configured when they started, so pass the pool to configuration.config,
+which starts them, before listening for connections.
+
+Routes can force offloading with @route(offload=True) (useful with encoders
+that release the GIL) or prevent it with offload=False.
+"""
+
+import pickle
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from asyncio import get_running_loop
+from .responses import Response
+from . import compression
+
+executor = None
+# The concurrent.futures.Executor used.  If None, the event loop's default
+# executor (a ThreadPoolExecutor) is used.  Set this using
+# configuration.config(executor).
+
+threshold = 0.002
+# Work expected to take longer than this many seconds is offloaded.  Set this
+# using configuration.config(offload_threshold).
+
+_ALPHA = 0.2
+# The weight of each new measurement in the moving averages.
+
+_MIN_SAMPLE = 4096
+# Smaller bodies aren't used to measure rates since fixed overheads dominate.
+
+rates = {}
+# Maps from 'json', 'pickle' or a compression coding to the average seconds per
+# byte of encoded JSON or of the body being compressed.
+
+sizes = {}
+# Maps from route to the average size of its encoded JSON bodies.
+
+counters = Counter()
+# Counts for monitoring:
+#
+# encode: A JSON body was encoded (and compressed) in the executor.
+# compress: A body was compressed in the executor.
+
+
+def configure(pool=None, seconds=None):
+    """
+    Sets the executor and the threshold in seconds.  See configuration.config.
+    Either is left unchanged if None.
+    """
+    global executor, threshold
+
+    if pool is not None:
+        executor = pool
+        if isinstance(executor, ProcessPoolExecutor):
+            # Start the worker processes now.  If they were forked when first
+            # used they would inherit the sockets of the connections open at
+            # the time, which then wouldn't close until the workers exit.
+            executor.submit(int).result()
+
+    if seconds is not None:
+        assert seconds >= 0, 'Invalid offload_threshold {!r}'.format(seconds)
+        threshold = seconds
+
+
+def _record(kind, size, elapsed):
+    if size >= _MIN_SAMPLE:
+        rate = elapsed / size
+        average = rates.get(kind)
+        rates[kind] = rate if average is None else average + _ALPHA * (rate - average)
+
+
+def _record_size(route, size):
+    average = sizes.get(route)
+    sizes[route] = size if average is None else average + _ALPHA * (size - average)
+
+
+def _slow(kind, size):
+    """
+    Returns True if processing `size` bytes is expected to take longer than the
+    threshold.
+    """
+    rate = rates.get(kind)
+    return rate is not None and size * rate > threshold
+
+
+def _saves(size):
+    """
+    Returns True if encoding a body of `size` bytes in a process pool is
+    expected to save more than the threshold.
+    """
+    encode_rate = rates.get('json')
+    if encode_rate is None:
+        return False
+    pickle_rate = rates.get('pickle')
+    if pickle_rate is None:
+        # Try it so we can measure it.
+        return size * encode_rate > threshold
+    return size * (encode_rate - pickle_rate) > threshold
+
+
+def encode(ctx, obj):
+    """
+    Encodes a list or dictionary into ctx.response.body and compresses it if
+    appropriate.
+
+    Returns None if this was done immediately or an awaitable that completes
+    once it has been done in the executor.
+    """
+    route = ctx.route
+    override = route.offload if route is not None else None
+
+    if override or (override is None and isinstance(executor, ProcessPoolExecutor) and
+                    route in sizes and _saves(sizes[route])):
+        return _encode_offloaded(ctx, obj)
+
+    start = perf_counter()
+    body = Response._codec.encode(obj)
+    _record('json', len(body), perf_counter() - start)
+    _record_size(route, len(body))
+
+    ctx.response.body = body
+    return compress(ctx)
+
+
+def compress(ctx):
+    """
+    Compresses ctx.response.body, which must be bytes, if the client accepts a
+    coding and it is worth doing.
+
+    Returns None if this was done immediately or an awaitable that completes
+    once it has been done in the executor.
+    """
+    selected = compression.select(ctx)
+    if selected is None:
+        return None
+
+    coding, level = selected
+    body  = ctx.response.body
+    route = ctx.route
+    override = route.offload if route is not None else None
+
+    if override or (override is None and _slow(coding, len(body))):
+        return _compress_offloaded(ctx, coding, level)
+
+    start = perf_counter()
+    compressed = compression.compressors[coding](body, level)
+    _record(coding, len(body), perf_counter() - start)
+
+    _set_compressed(ctx, coding, len(body), compressed)
+    return None
+
+
+def _set_compressed(ctx, coding, size, compressed):
+    if compression.accept_compressed(size, compressed):
+        ctx.response.body = compressed
+        ctx.response.headers['content-encoding'] = coding
+
+
+async def _compress_offloaded(ctx, coding, level):
+    counters['compress'] += 1
+    body = ctx.response.body
+    compressed, elapsed = await get_running_loop().run_in_executor(executor, _compress_job, body, coding, level)
+    _record(coding, len(body), elapsed)
+    _set_compressed(ctx, coding, len(body), compressed)
+
+
+async def _encode_offloaded(ctx, obj):
+    counters['encode'] += 1
+
+    # Choose the coding now since it depends on the request.  The body's size
+    # isn't known yet so the job checks the minimum size.
+    route = ctx.route
+    selected = compression.select(ctx)
+    coding, level = selected or (None, None)
+    min_size = route.compress_min_size if route is not None else None
+    if min_size is None:
+        min_size = compression.min_size
+
+    pickled = None
+    if isinstance(executor, ProcessPoolExecutor):
+        # Pickle it here rather than in the executor's feeder thread so we can
+        # measure it.
+        start = perf_counter()
+        try:
+            pickled = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # It may contain objects the encoders can handle but pickle can't.
+            ctx.response.body = Response._codec.encode(obj)
+            await _await(compress(ctx))
+            return
+        pickle_elapsed = perf_counter() - start
+
+    body, size, compressed, encode_elapsed, compress_elapsed = await get_running_loop().run_in_executor(
+        executor, _encode_job, obj if pickled is None else pickled, pickled is not None, coding, level, min_size)
+
+    _record('json', size, encode_elapsed)
+    _record_size(route, size)
+    if pickled is not None:
+        _record('pickle', size, pickle_elapsed)
+
+    if compressed is not None:
+        _record(coding, size, compress_elapsed)
+        if compression.accept_compressed(size, compressed):
+            ctx.response.body = compressed
+            ctx.response.headers['content-encoding'] = coding
+            return
+
+    if body is None:
+        # The job didn't return the body since it expected the compressed body
+        # to be sent.  (This only happens if the settings differ between this
+        # process and the pool's.)
+        body = Response._codec.encode(obj)
+    ctx.response.body = body
+
+
+async def _await(result):
+    if result is not None:
+        await result
+
+
+def _compress_job(body, coding, level):
+    """
+    Compresses a body in the executor, returning (compressed, elapsed).
+    """
+    start = perf_counter()
+    compressed = compression.compressors[coding](body, level)
+    return (compressed, perf_counter() - start)
+
+
+def _encode_job(obj, pickled, coding, level, min_size):
+    """
+    Encodes and compresses a body in the executor, returning (body, size,
+    compressed, encode_elapsed, compress_elapsed).  To avoid sending both back
+    to the event loop, `body` is None if the compressed body is worth sending
+    and `compressed` is None if it isn't.
+    """
+    if pickled:
+        obj = pickle.loads(obj)
+
+    start = perf_counter()
+    body = Response._codec.encode(obj)
+    encode_elapsed = perf_counter() - start
+
+    compressed = None
+    compress_elapsed = 0.0
+    if coding is not None and len(body) >= min_size:
+        start = perf_counter()
+        compressed = compression.compressors[coding](body, level)
+        compress_elapsed = perf_counter() - start
+        if compression.is_worth_sending(len(body), compressed):
+            return (None, len(body), compressed, encode_elapsed, compress_elapsed)
+        compressed = None
+
+    return (body, len(body), compressed, encode_elapsed, compress_elapsed)
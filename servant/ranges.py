@@ -0,0 +1,153 @@
+"""
+Answers byte-range requests for static files so downloads can be resumed and
+media players can seek without fetching the whole file.
+
+A GET request with a Range header (e.g. "bytes=0-1023", "bytes=-500" or
+"bytes=100-199, 500-") is answered with a 206 containing just those bytes.  One
+range is sent as it is, with a Content-Range header.  Several are sent as a
+multipart/byteranges body with a Content-Range header on each part.  If none of
+the ranges overlap the file the response is a 416.
+
+If-Range makes the range conditional: the ranges are only sent if the ETag
+still matches, otherwise the whole file is sent so the client doesn't combine
+pieces of two versions.  Files have no Last-Modified date, so an If-Range date
+never matches.
+
+Ranges apply to the representation being sent, so a client that accepts gzip
+gets ranges of the gzipped file, matching its ETag.  Files held in memory are
+sliced using memoryviews and files sent from disk use sendfile with an offset,
+so only the requested bytes are copied.
+"""
+
+import os
+from .responses import FileBody
+
+max_ranges = 16
+# A Range header with more ranges than this (after overlapping and adjacent
+# ranges are combined) is ignored and the whole file is sent.  Requests for
+# many small ranges cost far more to answer than they save.
+
+
+def parse(header, size):
+    """
+    Parses a Range header for a body of `size` bytes, returning a list of
+    (start, stop) tuples (stop is exclusive) with overlapping and adjacent
+    ranges combined.  They are in the order requested, with each combined range
+    placed where the first of its ranges was.
+
+    Returns None if the header should be ignored (it is invalid, isn't for
+    bytes, or asks for too many ranges) and an empty list if none of the ranges
+    can be satisfied.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs:
+        return None
+
+    spans = []
+    for spec in specs:
+        first, dash, last = spec.partition('-')
+        first = first.strip()
+        last  = last.strip()
+        if not dash or not (first.isdigit() or first == '') or not (last.isdigit() or last == ''):
+            return None
+
+        if not first:
+            # The last N bytes.
+            if not last:
+                return None
+            count = int(last)
+            if count == 0 or size == 0:
+                # (An empty file has no last N bytes to send.)
+                continue
+            spans.append((max(size - count, 0), size))
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+            spans.append((start, min(int(last) + 1, size) if last else size))
+
+    # Combine them in order of position, remembering the first range requested
+    # in each group so they can be put back in the order requested.
+    combined = []
+    for index in sorted(range(len(spans)), key=spans.__getitem__):
+        start, stop = spans[index]
+        if combined and start <= combined[-1][1]:
+            last = combined[-1]
+            last[1] = max(last[1], stop)
+            last[2] = min(last[2], index)
+        else:
+            combined.append([start, stop, index])
+
+    if len(combined) > max_ranges:
+        return None
+
+    combined.sort(key=lambda group: group[2])
+    return [(start, stop) for (start, stop, index) in combined]
+
+
+def respond(ctx, file, coding, header):
+    """
+    Answers a GET request with a Range header for a staticfiles.File, sending
+    the representation compressed with `coding` (None for the original).  The
+    ETag, Content-Type and Content-Encoding headers must already be set.
+
+    Returns False if the whole file should be sent instead.
+
+    A file sent from disk gets a FileBody with no file, which the caller opens
+    (in an executor, since opening can block on disk I/O).
+    """
+    request  = ctx.request
+    response = ctx.response
+
+    if_range = request.headers.get('if-range')
+    if if_range is not None and if_range.strip() != file.etags[coding]:
+        # (This is a strong comparison, so weak ETags and dates don't match.)
+        return False
+
+    content = file.encodings[coding] if coding else file.content
+    size = file.size if content is None else len(content)
+
+    spans = parse(header, size)
+    if spans is None:
+        return False
+
+    if not spans:
+        response.status = 416
+        response.body   = None
+        response.headers['content-range'] = 'bytes */{}'.format(size)
+        return True
+
+    if len(spans) == 1:
+        start, stop = spans[0]
+        response.headers['content-range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+        parts = [(start, stop - start)]
+    else:
+        boundary = os.urandom(12).hex()
+        mimetype = response.headers['content-type']
+        response.headers['content-type'] = 'multipart/byteranges; boundary=' + boundary
+        parts = []
+        for start, stop in spans:
+            parts.append('\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, mimetype, start, stop - 1, size).encode('ascii'))
+            parts.append((start, stop - start))
+        parts.append('\r\n--{}--\r\n'.format(boundary).encode('ascii'))
+
+    if content is None:
+        body = FileBody(None, parts)
+    else:
+        view = memoryview(content)
+        if len(parts) == 1:
+            body = view[parts[0][0]:parts[0][0] + parts[0][1]]
+        else:
+            body = b''.join(view[part[0]:part[0] + part[1]] if type(part) is tuple else part for part in parts)
+
+    response.status = 206
+    response.body   = body
+    response.headers['content-length'] = str(len(body))
+    return True
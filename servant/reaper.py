@@ -0,0 +1,124 @@
+"""
+Provides the Reaper which enforces connection timeouts.
+
+Tens of thousands of mostly idle connections would need tens of thousands of
+timer handles if each used its own loop.call_later, and every keep-alive
+request would cancel one and create another.  Instead all connections on a
+loop share a single timer wheel: a ring of slots, each holding the connections
+whose deadline falls in that interval.  One timer ticks through the slots and
+asks each connection in the current slot to check its timeouts.
+
+Moving a connection to a new slot is a set removal and insertion.  It is
+skipped entirely if the new deadline falls in the same slot.
+"""
+
+from asyncio import get_running_loop
+from weakref import WeakKeyDictionary
+
+_reapers = WeakKeyDictionary()
+# Maps from event loop to its Reaper.
+
+
+def get_reaper(loop=None):
+    """
+    Returns the Reaper for the given loop, or the running loop if not provided,
+    creating it if necessary.
+    """
+    loop = loop or get_running_loop()
+    reaper = _reapers.get(loop)
+    if reaper is None:
+        reaper = _reapers[loop] = Reaper(loop)
+    return reaper
+
+
+class Reaper:
+    """
+    A timer wheel that calls `conn._reap(now)` when a connection's deadline
+    passes.  The connection is expected to act on whatever timed out and
+    schedule its next deadline, if any.
+
+    Each connection has a single deadline and the wheel stores the slot it was
+    put in on the connection (`reaper_slot`) so it can be moved in O(1).
+    Deadlines are only accurate to `resolution` seconds.
+    """
+    def __init__(self, loop, resolution=1.0, slots=128):
+        self.loop = loop
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+
+        self.count = 0
+        # The number of connections in the wheel.  The timer only runs while
+        # this is non-zero.
+
+        self.tick = None
+        # The number of the next tick to process.  Tick `n` covers deadlines in
+        # [n * resolution, (n+1) * resolution) and is processed once that
+        # interval has passed.
+
+        self.timer = None
+
+    def schedule(self, conn, deadline):
+        """
+        Sets the loop time at which `conn` will be reaped, replacing any previous
+        deadline.  Pass None to remove the connection from the wheel.
+        """
+        slot = None
+        if deadline is not None:
+            tick = int(deadline / self.resolution)
+            if self.tick is not None and tick < self.tick:
+                # Already past - reap it on the next tick.
+                tick = self.tick
+            slot = tick % len(self.slots)
+
+        conn.reaper_deadline = deadline
+
+        old = conn.reaper_slot
+        if old == slot:
+            return
+
+        if old is not None:
+            self.slots[old].discard(conn)
+            self.count -= 1
+
+        conn.reaper_slot = slot
+
+        if slot is not None:
+            self.slots[slot].add(conn)
+            self.count += 1
+            if self.timer is None:
+                self._start()
+
+    def _start(self):
+        if self.tick is None:
+            self.tick = int(self.loop.time() / self.resolution)
+        self.timer = self.loop.call_at((self.tick + 1) * self.resolution, self._run)
+
+    def _run(self):
+        self.timer = None
+        now = self.loop.time()
+
+        # If the loop was blocked we may have missed ticks.  Process each, but
+        # never go around the wheel more than once.
+        last = int(now / self.resolution) - 1
+        if last - self.tick >= len(self.slots):
+            self.tick = last - len(self.slots) + 1
+
+        while self.tick <= last:
+            slot = self.slots[self.tick % len(self.slots)]
+
+            # Advance first so connections rescheduled into the past while
+            # being reaped land in the next tick rather than this one.
+            self.tick += 1
+
+            for conn in [c for c in slot if c.reaper_deadline <= now]:
+                slot.discard(conn)
+                self.count -= 1
+                conn.reaper_slot = None
+                conn.reaper_deadline = None
+                conn._reap(now)
+
+        if self.count:
+            self._start()
+        else:
+            # Start counting from the current time when we are restarted.
+            self.tick = None
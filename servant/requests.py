@@ -2,10 +2,104 @@
 Provides the Request object.
 """
 
-import json
-from cgi import parse_qs
-from urllib.parse import urlsplit
+from collections import deque
+from functools import cached_property
+from asyncio import get_running_loop
+from urllib.parse import unquote_plus
 from cookies import Cookies
+from .codec import create_codec
+from .errors import HttpError
+
+
+class MultiDict(dict):
+    """
+    A dictionary of query string or form variables.
+
+    Indexing and `get` return a variable's first value, so it can be used as
+    a normal dictionary (and passed to handlers as one).  A variable can be
+    repeated ("?id=1&id=2"); use `getall` to get all of its values.
+    """
+    __slots__ = ['repeated']
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+
+        self.repeated = {}
+        # Maps from key to a list of all of its values for the keys that have
+        # more than one.
+
+    def add(self, key, value):
+        """
+        Adds a value for `key`, keeping any it already has.
+        """
+        if key in self:
+            values = self.repeated.get(key)
+            if values is None:
+                self.repeated[key] = [self[key], value]
+            else:
+                values.append(value)
+        else:
+            dict.__setitem__(self, key, value)
+
+    def getall(self, key, default=None):
+        """
+        Returns a list of all values for `key`, or `default` (an empty list if
+        None) if there are none.
+        """
+        values = self.repeated.get(key)
+        if values is not None:
+            return list(values)
+        if key in self:
+            return [self[key]]
+        return [] if default is None else default
+
+    def __setitem__(self, key, value):
+        self.repeated.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.repeated.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def copy(self):
+        other = MultiDict(self)
+        for key, values in self.repeated.items():
+            other.repeated[key] = list(values)
+        return other
+
+
+def parse_urlencoded(s, keep_blank_values=False):
+    """
+    Parses "a=1&b=2&a=3" into a MultiDict.
+
+    This is what urllib.parse.parse_qs does, without the overhead of its
+    options and only unquoting the fields that need it, which is most of the
+    cost for typical query strings.  Fields without a value ("a" or "a=") are
+    skipped unless `keep_blank_values` is True.
+    """
+    result = MultiDict()
+    for field in s.split('&'):
+        if not field:
+            continue
+        key, _, value = field.partition('=')
+        if not value and not keep_blank_values:
+            continue
+        if '%' in field or '+' in field:
+            key   = unquote_plus(key)
+            value = unquote_plus(value)
+        result.add(key, value)
+    return result
+
+
+def parse_query(url):
+    """
+    Returns a MultiDict of the variables in a URL's query string.
+    """
+    query = url.partition('?')[2]
+    if not query:
+        return MultiDict()
+    return parse_urlencoded(query.partition('#')[0])
+
 
 class Request:
     """
@@ -20,59 +114,191 @@ class Request:
       automatically lowercase keys when inserted or used for lookup.
 
     cookies
-      A dictionary (case-sensitive) mapping cookie names to values.
+      A dictionary (case-sensitive) mapping cookie names to values.  The Cookie
+      header is parsed the first time this is used.
 
     form
-      A dictionary of variables from either the query string if a GET
-      or from form or JSON data if it is a POST.  These are preparsed
-      so they can be passed to the route in parameters.
+      The variables from the query string if a GET or HEAD, or from form or JSON
+      data if a POST or PATCH.  A route's handler is passed its parameters from
+      here.  This is parsed the first time it is used, so requests for routes
+      that don't take form variables never parse it.
+
+    body
+      The request body as bytes.  This is None if the route was registered
+      with stream_body=True.
+
+    stream
+      A BodyStream for reading the body as it arrives if the route was
+      registered with stream_body=True, otherwise None.
+
+    query
+      A MultiDict of the query string variables for any method, parsed the
+      first time it is used.
+
+    version
+      The HTTP version from the request line: "HTTP/1.1" or "HTTP/1.0".
+
+    keep_alive
+      True if the connection will be kept open for another request after the
+      response is sent.  A handler can set this to False to close the
+      connection after its response.
     """
     _next_id = 1
 
-    _ohook = None
-    # The json.loads object_hook.  Set this using configuration.config(decode_hook).
+    _codec = create_codec()
+    # The JsonCodec used to decode JSON bodies.  Set this using configuration.config.
 
-    def __init__(self, cnxn, method, url, headers, body):
+    def __init__(self, cnxn, method, url, headers, body, stream=None, version='HTTP/1.1', keep_alive=True,
+                 query=None):
+        """
+        query
+          The query string variables if they have already been parsed (see
+          routing.resolve).  They may be shared with other requests, so they
+          are copied when first used.
+        """
         self.cnxn    = cnxn
         self.method  = method
         self.url     = url
         self.headers = headers
         self.body    = body
+        self.stream  = stream
+        self.version = version
+        self.keep_alive = keep_alive
+        self._query  = query
 
         # A counter to help troubleshoot.
         self._id = Request._next_id
         Request._next_id = (Request._next_id + 1) % 1000000
 
-        self.form = self.parse_form()
-
-        c = headers.get('cookie', None)
-        if c:
-            self.cookies = Cookies.from_request(c)
-        else:
-            self.cookies = Cookies()
-
     def __repr__(self):
         # Format for debugging, not normal logging.
+        if self.body is None:
+            return '{}/{} {} body=streamed'.format(self._id, self.method, self.url)
         return '{}/{} {} body={} bytes'.format(self._id, self.method, self.url, len(self.body))
 
+    @cached_property
+    def query(self):
+        if self._query is not None:
+            # Copy it since it may be shared with other requests.
+            return self._query.copy()
+        return parse_query(self.url)
+
+    @cached_property
+    def form(self):
+        return self.parse_form()
+
+    @cached_property
+    def cookies(self):
+        c = self.headers.get('cookie', None)
+        if c:
+            return Cookies.from_request(c)
+        return Cookies()
+
     def parse_form(self):
         """
-        Stores variables into self.form so they can be passed to the URL handlers.
+        Returns the variables for self.form so they can be passed to the URL handlers.
+
+        POSTs and PATCHes will be parsed if the content is JSON or form encoded.
+        GETs and HEADs will have their variables parsed.
 
-        POSTs will be parsed if the content is JSON or form encoded.  GETs will
-        have their variables parsed.
+        Raises HttpError(400) if the body can't be decoded or JSON doesn't decode
+        to a dictionary.
         """
-        if self.method == 'GET':
-            return { key: val[0] for (key, val) in parse_qs(urlsplit(self.url)[3]).items() }
+        if self.method in ('GET', 'HEAD'):
+            return self.query
 
-        if self.method == 'POST':
+        if self.method in ('POST', 'PATCH') and self.body is not None:
             ct = self.headers.get('content-type') or ''
-            if ct == 'application/x-www-form-urlencoded':
-                return { key: val[0] for (key, val) in parse_qs(self.body.decode('utf8'), True).items() }
+            try:
+                if ct == 'application/x-www-form-urlencoded':
+                    return parse_urlencoded(self.body.decode('utf8'), keep_blank_values=True)
 
-            # TODO: Look for charset, etc.
-            if ct == 'application/json':
-                s = self.body.decode('UTF-8')
-                return json.loads(s, object_hook=Request._ohook)
+                # TODO: Look for charset, etc.
+                if ct == 'application/json':
+                    form = Request._codec.decode(self.body)
+                    if not isinstance(form, dict):
+                        raise HttpError(400, message='The JSON body is not an object')
+                    return form
+            except ValueError:
+                # (Including JSON and UTF-8 decoding errors.  The error isn't
+                # put in the message since it can contain the client's data.)
+                raise HttpError(400, message='Invalid request body')
 
         return None
+
+
+class BodyStream:
+    """
+    The body of a request being received, used by routes registered with
+    stream_body=True.  The chunks are bytes objects in the sizes they were
+    received (after removing any chunked transfer-encoding).
+
+    Read it using `async for`:
+
+        async for chunk in ctx.request.stream:
+            ...
+
+    or by calling `read` until it returns an empty bytes object.  If the body
+    is too large or the connection is lost, reading raises an exception.
+
+    on_read
+      An optional function called after each chunk is read.  The connection
+      uses this to resume reading once the handler has caught up.
+    """
+    def __init__(self, on_read=None):
+        self._on_read = on_read
+        self._chunks = deque()
+        self._eof = False
+        self._exception = None
+        self._waiter = None
+
+        self.buffered = 0
+        # The number of bytes received but not yet read.
+
+    def feed_data(self, data):
+        self._chunks.append(data)
+        self.buffered += len(data)
+        self._wakeup()
+
+    def feed_eof(self):
+        self._eof = True
+        self._wakeup()
+
+    def set_exception(self, exc):
+        self._exception = exc
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def read(self):
+        """
+        Returns the next chunk of the body or an empty bytes object once the
+        entire body has been read.
+        """
+        while not self._chunks:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                return b''
+            self._waiter = get_running_loop().create_future()
+            await self._waiter
+
+        data = self._chunks.popleft()
+        self.buffered -= len(data)
+        if self._on_read:
+            self._on_read()
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read()
+        if not data:
+            raise StopAsyncIteration
+        return data
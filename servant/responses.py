@@ -6,6 +6,7 @@ import os, logging, gzip
 from . import errors
 from .staticfiles import File
 from .lowerdict import LowerDict
+from .codec import create_codec
 
 # TODO:: Need to enable way to make this secure.
 HTTP_COOKIE_PATH   = '/'
@@ -20,6 +21,47 @@ def itob(n):
     return bytes(str(n), 'ascii')
 
 
+def is_stream(body):
+    """
+    Returns True if a response body is an iterator or async iterator of chunks
+    to be sent using the chunked transfer-encoding.
+    """
+    return hasattr(body, '__aiter__') or hasattr(body, '__next__')
+
+
+class FileBody:
+    """
+    A response body sent from an open file using loop.sendfile, which copies the
+    data from the page cache to the socket without it passing through Python.
+
+    file
+      A file opened in binary mode.  The connection closes it once the body has
+      been sent.  This is None for the response to a HEAD request, which only
+      needs the length.
+
+    parts
+      A list of the parts of the body to send in order: (offset, count) tuples
+      for ranges of the file and bytes to send as they are (such as the headers
+      of a multipart/byteranges body).
+    """
+    __slots__ = ['file', 'parts', 'length']
+
+    def __init__(self, file, parts):
+        self.file   = file
+        self.parts  = parts
+        self.length = sum(part[1] if type(part) is tuple else len(part) for part in parts)
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return 'FileBody<{} {} bytes>'.format(getattr(self.file, 'name', None), self.length)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
 class Response:
     """
     Encapsulates the response to send to the client.
@@ -27,11 +69,17 @@ class Response:
     A URL handler does not have to interact with this object - it can simply
     return the value to send.  However, it may set the status, headers, cookies,
     or the body.
+
+    To send a large body without building it in memory, return an iterator or
+    async iterator (such as an async generator) of bytes.  Each item is sent as
+    it is produced using the chunked transfer-encoding.  To send a file (or part
+    of one) from disk, set the body to a FileBody.  A memoryview can be used to
+    send part of a bytes object without copying it first.
     """
 
-    _ohook = None
-    # The JSON encoding hook (json.dumps(default=xx)).  Set this using
-    # configuration.config(encode_hook).
+    _codec = create_codec()
+    # The JsonCodec used to encode list and dictionary bodies.  Set this using
+    # configuration.config.
 
     def __init__(self):
         self.status  = None
@@ -39,6 +87,9 @@ class Response:
         self.cookies = {}
         self.body    = None
 
+        self.chunked = False
+        # Set by _send if the body is streamed using the chunked transfer-encoding.
+
     def set_cookie(self, name, value, http_only=True):
         """
         Sets a response cookie
@@ -62,7 +113,21 @@ class Response:
         status = self.status
         body   = self.body
 
-        if type(body) not in (type(None), bytes):
+        request = ctx.request
+
+        streaming = is_stream(body)
+
+        if streaming:
+            # The connection writes the body after we've written the headers.
+            self.headers.pop('content-length', None)
+            if request.version == 'HTTP/1.0':
+                # HTTP/1.0 doesn't have chunked encoding.  The end of the body is
+                # marked by closing the connection.
+                request.keep_alive = False
+            else:
+                self.headers['transfer-encoding'] = 'chunked'
+                self.chunked = True
+        elif type(body) not in (type(None), bytes, memoryview, FileBody):
             # (In development, assert which will raise an exception.  If it gets out of
             # development, log it and return an error to the browser.)
             logger.error('Response is not bytes: {} {!r}'.format(type(body), body))
@@ -76,8 +141,19 @@ class Response:
             else:
                 status = 200
 
-        if body is not None:
+        if streaming:
+            pass
+        elif body is not None:
             self.headers['content-length'] = str(len(body))
+        elif status not in (204, 304):
+            # Without a length the client would read until the connection
+            # closed, which would break the next request on the connection.
+            self.headers['content-length'] = '0'
+
+        if not request.keep_alive:
+            self.headers['connection'] = 'close'
+        elif request.version == 'HTTP/1.0':
+            self.headers['connection'] = 'keep-alive'
 
         if __debug__:
             for key, val in self.headers.items():
@@ -98,7 +174,10 @@ class Response:
 
         parts.append(b'\r\n\r\n')
 
-        if body:
+        if body and not streaming and type(body) is not FileBody and request.method != 'HEAD':
+            # (A HEAD response has the headers of the GET response, including
+            # its Content-Length, but no body.  Streams and FileBody bodies are
+            # written by the connection after the headers.)
             parts.append(body)
 
         transport.writelines(parts)
@@ -0,0 +1,166 @@
+"""
+Provides RouteCache, which remembers how recently requested URLs were routed.
+
+Most traffic goes to a small number of distinct URLs, so caching the route,
+the URL variables and the parsed query string for each saves looking them up
+again.  Since anyone can send us URLs, the cache has to be careful about what
+it keeps: a flood of unique URLs (e.g. "/users/1", "/users/2", ...) would
+evict everything useful from a plain LRU cache.
+
+Instead a URL is only added to a full cache if it has been requested more often
+than the least recently used entry it would replace.  Request frequencies are
+estimated for all URLs (cached or not) using a count-min sketch: a few rows of
+small counters indexed by different bits of the URL's hash.  A URL's estimate
+is the smallest of its counters, which can only be too high if all of them
+collide with other URLs.  The counters are halved periodically so the
+frequencies reflect recent traffic.
+
+This is the "TinyLFU" admission policy described by Einziger, Friedman and
+Manes.
+"""
+
+from collections import OrderedDict
+
+_ROWS = 4
+# The number of counters per URL in the sketch.
+
+_MAX_COUNT = 15
+# Counters stop increasing at this value.  We only need to tell hot URLs from
+# cold ones, and small counters age out quickly.
+
+
+class RouteCache:
+    """
+    A bounded LRU cache of values keyed by URL with frequency-based admission.
+
+    size
+      The maximum number of entries.  0 disables the cache.
+    """
+    def __init__(self, size=1024):
+        self.hits = 0
+        self.misses = 0
+
+        self.rejected = 0
+        # The number of entries not added because they were requested less
+        # often than the entry they would have replaced.
+
+        self.resize(size)
+
+    def resize(self, size):
+        """
+        Sets the maximum number of entries, clearing the cache.
+        """
+        assert size >= 0, 'Invalid route cache size: {!r}'.format(size)
+
+        self.size = size
+
+        self.entries = OrderedDict()
+        # Maps from key to (value, indexes) where `indexes` are the key's
+        # counters in the sketch.  Remembering them makes counting a hit cheap.
+
+        # Use roughly 8 counters per row per entry (but no more than 16 bits of
+        # the hash per row) so URLs requested once rarely share all of their
+        # counters with others between agings.
+        bits = min(max(6, (size * 8 - 1).bit_length()), 16)
+        self.width  = 1 << bits
+        self.mask   = self.width - 1
+        self.sketch = bytearray(self.width * _ROWS)
+
+        self.additions = 0
+        self.sample = max(size, 64) * 10
+        # The counters are halved each time `sample` requests have been counted.
+
+    def clear(self):
+        """
+        Removes all entries.  The request frequencies are kept since they don't
+        depend on what the URLs map to.
+        """
+        self.entries.clear()
+
+    def get(self, key):
+        """
+        Returns the value cached for `key` or None.  Each call counts as a
+        request for `key` when deciding what to cache.
+        """
+        if not self.size:
+            return None
+
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            self._increment(self._indexes(key))
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self._increment(entry[1])
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Caches `value` for `key` if there is room or `key` has been requested
+        more often than the least recently used entry.  Call after `get` misses.
+        """
+        if not self.size:
+            return
+
+        entries = self.entries
+
+        indexes = self._indexes(key)
+
+        if len(entries) >= self.size:
+            victim = next(iter(entries))
+            if self._estimate(indexes) <= self._estimate(entries[victim][1]):
+                self.rejected += 1
+                return
+            del entries[victim]
+
+        entries[key] = (value, indexes)
+
+    def stats(self):
+        """
+        Returns a dictionary of statistics for monitoring.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size'     : len(self.entries),
+            'capacity' : self.size,
+            'hits'     : self.hits,
+            'misses'   : self.misses,
+            'rejected' : self.rejected,
+            'hit_rate' : self.hits / lookups if lookups else 0.0,
+        }
+
+    def _indexes(self, key):
+        """
+        Returns the index of each of the key's counters in the sketch.  Each row
+        uses a different 16 bits of the hash.
+        """
+        h = hash(key)
+        mask  = self.mask
+        width = self.width
+        return (h & mask,
+                width     + ((h >> 16) & mask),
+                width * 2 + ((h >> 32) & mask),
+                width * 3 + ((h >> 48) & mask))
+
+    def _estimate(self, indexes):
+        sketch = self.sketch
+        a, b, c, d = indexes
+        return min(sketch[a], sketch[b], sketch[c], sketch[d])
+
+    def _increment(self, indexes):
+        # This is called for every request, so the loop is unrolled.
+        sketch = self.sketch
+        a, b, c, d = indexes
+        if sketch[a] < _MAX_COUNT: sketch[a] += 1
+        if sketch[b] < _MAX_COUNT: sketch[b] += 1
+        if sketch[c] < _MAX_COUNT: sketch[c] += 1
+        if sketch[d] < _MAX_COUNT: sketch[d] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample:
+            # Age the counts so URLs that were popular a while ago don't stay in
+            # the cache forever.
+            self.additions = 0
+            self.sketch = bytearray(count >> 1 for count in sketch)
@@ -4,6 +4,26 @@ Provides the @route decorator and its implementation.
 The decorator creates a DynamicRoute object, defined here, and stores it in the global
 list of routes (`_routes`).  There is also a lookup function to find the
 appropriate route for a URL.
+
+Routes are indexed so lookups don't depend on the number of routes.  Patterns
+without variables are stored in a dictionary (`_exact`) keyed by path.  All
+routes are also stored in a tree (`_tree`) with a node per path segment, which
+is walked one segment at a time.  At each node a literal segment is preferred
+over a variable, and a variable over a prefix route (StaticFileRoute), falling
+back to the next choice if the rest of the path doesn't match.
+
+Variables can have a converter ("{id:int}") that checks and converts the
+segment.  The tree has a separate branch for each converter at a position and
+tries them in turn, so a segment that doesn't convert falls through to the
+next route.
+
+Each pattern can have a different route for each HTTP method.  The tree finds
+the routes for the path (a _Methods object) and the request method picks one
+from it.  If the path matches but the method doesn't, the request is rejected
+with a 405 listing the methods that are allowed.
+
+The results for frequently requested URLs are also cached (see routecache.py)
+and `resolve` is used to look them up.
 """
 
 # REVIEW: We could implement static files as middleware, but I don't
@@ -12,25 +32,231 @@ appropriate route for a URL.
 # using a CDN or proxy and never load a static file
 
 import re, inspect
-from urllib.parse import urlparse
-from asyncio import coroutine
+from uuid import UUID
+from types import GeneratorType
+from collections import namedtuple
+from urllib.parse import urlsplit
 from .middleware import middleware
+from . import compression
+from .errors import HttpError
+from .annotations import get_converter, is_sequence
+from .routecache import RouteCache
+from .requests import MultiDict, parse_query
 
 _routes = []
 # The global list of registered routes as DynamicRoute objects.
 
+_exact = {}
+# Maps from URL path to the _Methods for patterns without variables.  Each
+# pattern is stored with and without a trailing slash.
+
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+# The HTTP methods we support.
+
+HANDLER_METHODS = METHODS[:-1]
+# The methods routes can handle.  OPTIONS requests are answered from the route
+# table without calling a handler.
+
+
+Var = namedtuple('Var', 'key convert')
+# A variable segment in a route's `segments`.  `key` identifies the converter
+# ("" for a plain variable, "int", "re:[a-z]+", etc.) and `convert` is the
+# converter function, or None for a plain variable.
+
+
+def _int(value):
+    # int() would also accept signs, spaces, underscores and non-ASCII digits.
+    if not (value.isdigit() and value.isascii()):
+        raise ValueError(value)
+    return int(value)
+
+
+_RE_UUID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+def _uuid(value):
+    # UUID() would also accept braces, "urn:uuid:" and no hyphens.
+    if not _RE_UUID.match(value):
+        raise ValueError(value)
+    return UUID(value)
+
+
+converters = {
+    'str'  : None,
+    'int'  : _int,
+    'uuid' : _uuid,
+}
+# Maps from converter name to a function that accepts a URL path segment and
+# returns the value to pass to the handler, raising ValueError if the segment
+# is not valid.  Add to this to register custom converters.  There are two
+# converters handled specially: "re:<regexp>" matches segments matching a
+# regular expression and "path" matches the rest of the URL.
+
+
+def _regexp(expr):
+    """
+    Returns a converter for {name:re:<expr>} variables.
+    """
+    regexp = re.compile(expr)
+    def convert(value):
+        if not regexp.fullmatch(value):
+            raise ValueError(value)
+        return value
+    return convert
+
+
+annotation_converter = None
+# The optional function set by configuration.config(annotation_converter) that
+# post-processes annotated arguments.  Use set_annotation_converter to change
+# it so existing routes are updated.
+
+_MISSING = object()
+# Returned by form.get when a variable is missing.  (None is a valid value.)
+
+
+class _Methods:
+    """
+    The routes registered for one pattern, keyed by HTTP method.
+    """
+    __slots__ = ['routes', 'allow']
+
+    def __init__(self):
+        self.routes = {}
+        # Maps from method to the route that handles it.  HEAD requests are
+        # handled by the GET route unless a route is registered for HEAD.
+
+        self.allow = None
+        # The methods allowed, formatted for the Allow header.
+
+    def add(self, r):
+        for method in r.methods:
+            existing = self.routes.get(method)
+            # (A GET route only handles HEAD until a HEAD route is registered.)
+            assert not existing or (method == 'HEAD' and 'HEAD' not in existing.methods), \
+                '{} {} matches the same URLs as {}'.format(method, r, existing)
+            self.routes[method] = r
+
+        if 'GET' in r.methods and 'HEAD' not in self.routes:
+            self.routes['HEAD'] = r
+
+        self.allow = ', '.join(m for m in METHODS if m in self.routes or m == 'OPTIONS')
+
+
+class _Node:
+    """
+    A node in the route tree representing one path segment.
+    """
+    __slots__ = ['children', 'vars', 'route', 'prefix']
+
+    def __init__(self):
+        self.children = {}
+        # Maps from a literal segment to the node for it.
+
+        self.vars = []
+        # A list of (key, convert, node) for variable segments, one per
+        # converter.  Patterns with the same converter here share the node
+        # regardless of the variable's name.  Converters are tried in the order
+        # they were added except plain variables are tried last.
+
+        self.route = None
+        # The _Methods for the pattern ending at this node.
+
+        self.prefix = None
+        # The _Methods for a prefix route that handles everything below this
+        # node.
+
+_tree = _Node()
+
+cache = RouteCache()
+# Caches `resolve` results for the most frequently requested URLs.  It is
+# cleared when a route is registered.  Use cache.stats() for hit rates.  Set the
+# size using configuration.config(route_cache_size).
+
 
 def register_route(r):
+    """
+    Adds a route to the route table.  Raises an AssertionError if it would match
+    the same URLs and methods as a route that is already registered, such as
+    "/users/{id}" and "/users/{name}".
+
+    Other overlaps are resolved by preferring the more specific route, so
+    "/users/me" is chosen over "/users/{id:int}", then "/users/{id}" and all
+    over a prefix route for "/users", regardless of the order they are
+    registered.
+    """
+    node = _tree
+    for segment in r.segments:
+        if isinstance(segment, str):
+            node = node.children.setdefault(segment, _Node())
+        else:
+            node = _var_node(node, segment)
+
+    if r.catch_all:
+        if node.prefix is None:
+            node.prefix = _Methods()
+        methods = node.prefix
+    else:
+        if node.route is None:
+            node.route = _Methods()
+        methods = node.route
+
+    methods.add(r)
+
     for m in middleware:
         m.register_route(r)
+
     _routes.append(r)
+    cache.clear()
+
+    if not r.catch_all and all(isinstance(segment, str) for segment in r.segments):
+        path = '/' + '/'.join(r.segments)
+        _exact[path] = methods
+        _exact[path.rstrip('/') + '/'] = methods
+
+
+def set_annotation_converter(func):
+    """
+    Sets the annotation_converter hook (see configuration.config) and rebuilds
+    the binders of routes that have already been registered.
+    """
+    global annotation_converter
+    if func is annotation_converter:
+        return
+    annotation_converter = func
+    for r in _routes:
+        if isinstance(r, DynamicRoute):
+            r._bind = r.build_binder()
 
 
-def route(pattern, *, logger=None, **kwargs):
+def _var_node(node, var):
+    """
+    Returns the child of `node` for the variable `var`, creating it if needed.
+    """
+    for key, convert, child in node.vars:
+        if key == var.key:
+            return child
+
+    child = _Node()
+    entry = (var.key, var.convert, child)
+    if var.convert:
+        # Keep the plain variable, if any, at the end.
+        count = len(node.vars)
+        if count and not node.vars[-1][1]:
+            count -= 1
+        node.vars.insert(count, entry)
+    else:
+        node.vars.append(entry)
+    return child
+
+
+def route(pattern, *, methods=None, logger=None, stream_body=False, max_body_size=None, compress_level=None,
+          compress_min_size=None, offload=None, stream_json=None, **kwargs):
     """
     The @route decorator used to register URL handlers.  The first parameter of
     the decorated function should be named "ctx".
 
+    The decorated function can be a normal function or an `async def` coroutine
+    function.  An async generator function streams its response (see Response).
+
     pattern
       The pattern for the URL the decorated function will handle.
 
@@ -38,50 +264,248 @@ def route(pattern, *, logger=None, **kwargs):
       ("/file/{filename}").  The decorated function must take a parameter with
       this name.
 
+      A variable can have a converter after a colon, which is applied once
+      when the URL is matched.  If the segment can't be converted the pattern
+      doesn't match and other routes are tried.
+
+        {id:int}        A non-negative integer, passed as an int.
+        {id:uuid}       A UUID in the usual hyphenated form, passed as a UUID.
+        {slug:re:expr}  A segment fully matching the regular expression, which
+                        cannot contain "/".  Passed as a string.
+        {rest:path}     The rest of the URL, which may contain slashes.  This
+                        must be the last segment.
+
+      Converters registered in routing.converters can also be used.
+
+    methods
+      The HTTP methods the function handles, such as ['GET'] or ['PUT',
+      'DELETE'].  Other functions can be registered for the same pattern with
+      different methods.  A request using a method with no function is rejected
+      with a 405.  A GET function also handles HEAD requests unless one is
+      registered for HEAD.  OPTIONS requests are answered automatically.  By
+      default the function handles all methods.
+
     logger
       Optional Python logging.Logger instance.  If provided, the route
       parameters will be logged to it using logger.debug.
+
+    stream_body
+      If True, the handler is called as soon as the request headers have been
+      read and can read the body as it arrives from ctx.request.stream.  The
+      handler should not take any form parameters since the body is not parsed.
+
+    max_body_size
+      The largest request body accepted, overriding the server-wide default set
+      with configuration.config(max_body_size).  Larger bodies are rejected with
+      a 413.
+
+    compress_level
+      The compression level for responses, overriding the defaults set with
+      configuration.config(compression_level): an int used for every coding or
+      a dictionary mapping from coding ("gzip", "br", etc.) to level.  Pass 0
+      to never compress this route's responses.
+
+    compress_min_size
+      Responses smaller than this many bytes are not compressed, overriding
+      configuration.config(compression_min_size).
+
+    offload
+      True to always encode and compress responses in the executor, False to
+      never do so, or None (the default) to offload them when they are expected
+      to be slow.  See offload.py.
+
+    stream_json
+      "json" or "ndjson" to send a list returned by the function (or any
+      iterable or async iterable, such as a generator) as a JSON array or as
+      newline-delimited JSON, encoded and compressed an item at a time and
+      sent using the chunked transfer-encoding.  Memory use doesn't depend on
+      the size of the result.  See jsonstream.py.
     """
     def wrapper(func):
-        # TODO: Convert to "==".
-        assert not any(getattr(r, 'pattern', None) == pattern for r in _routes), 'URL "{}" registered twice: first={} second={}'.format(pattern, _routes[pattern], func)
+        r = DynamicRoute(pattern, func, kwargs, methods=methods, logger=logger, stream_body=stream_body,
+                         max_body_size=max_body_size, compress_level=compress_level,
+                         compress_min_size=compress_min_size, offload=offload, stream_json=stream_json)
+        register_route(r)
+    return wrapper
 
-        r = DynamicRoute(pattern, func, kwargs, logger=logger)
-        for m in middleware:
-            m.register_route(r)
 
-        _routes.append(r)
-    return wrapper
+def resolve(method, url):
+    """
+    Returns a tuple of (route, values, query, allow) for a request, using the
+    cache for frequently requested URLs.
+
+    `route` and `values` are the same as returned by `get`.  If no route handles
+    the method, `route` is None.
+
+    `query` is a MultiDict of the query string variables for GET and HEAD
+    requests to routes that take form variables (see Route.uses_form), and None
+    otherwise.  It is shared by all requests for the URL, so it must be copied
+    before being modified.  Requests for other routes only parse the query
+    string if the handler uses it.
+
+    `allow` is the value for an Allow header listing the methods the URL
+    accepts, or None if no pattern matches the URL.
+    """
+    entry = cache.get(url)
+    if entry is None:
+        # The query is parsed the first time a GET needs it.
+        entry = list(_lookup(url)) + [None]
+        cache.put(url, entry)
+
+    methods, values, query = entry
+
+    if methods is None:
+        return (None, None, None, None)
+
+    route = methods.routes.get(method)
 
+    if route is not None and route.uses_form and method in ('GET', 'HEAD'):
+        if query is None:
+            query = entry[2] = parse_query(url)
+    else:
+        query = None
 
-def get(url):
+    return (route, values, query, methods.allow)
+
+
+def get(url, method='GET'):
     """
     Given a URL, find the Route that handles it.
 
-    If found, a tuple containing the Route object and the regular expression match used to
-    match the pattern is returned.  If there are variables in the URL, the match will have a
-    group for each in the order they are found in the URL.
+    If found, a tuple containing the Route object and a tuple of the values matched by the
+    pattern is returned.  For a DynamicRoute this has the value of each variable in the order
+    they are found in the URL.  For a prefix route it has the rest of the path after the
+    prefix.
 
-    If not found, (None, None) is returned.
+    If not found, or no route for the URL handles `method`, (None, None) is returned.
     """
-    url = urlparse(url)
+    methods, values = _lookup(url)
+    r = methods and methods.routes.get(method)
+    if not r:
+        return (None, None)
+    return (r, values)
 
-    for r in _routes:
-        match = r.regexp.match(url.path)
-        if match:
-            return (r, match)
 
-    return (None, None)
+def _lookup(url):
+    """
+    Returns a tuple of the _Methods for the pattern matching a URL and the
+    values matched, or (None, None).
+    """
+    if url.startswith('/'):
+        path = url.partition('?')[0]
+    else:
+        # An absolute URL ("http://host/path") or "*".
+        path = urlsplit(url).path
+        if not path.startswith('/'):
+            return (None, None)
+
+    methods = _exact.get(path)
+    if methods:
+        return (methods, ())
+
+    segments = path[1:].split('/')
+    found = _find(_tree, segments, 0, [])
+    return found or (None, None)
+
+
+def _find(node, segments, index, values):
+    """
+    Returns the _Methods and values for segments[index:] below `node`, or None
+    if nothing matches.  `values` collects the values of the variables above.
+    """
+    count = len(segments)
+
+    if index == count or (index == count - 1 and not segments[index]):
+        # The end of the path (possibly with a trailing slash).
+        if node.route:
+            return (node.route, tuple(values))
+
+    if index < count:
+        segment = segments[index]
+
+        child = node.children.get(segment)
+        if child:
+            found = _find(child, segments, index + 1, values)
+            if found:
+                return found
+
+        if node.vars and segment:
+            for key, convert, child in node.vars:
+                if convert:
+                    try:
+                        value = convert(segment)
+                    except ValueError:
+                        continue
+                else:
+                    value = segment
+
+                values.append(value)
+                found = _find(child, segments, index + 1, values)
+                if found:
+                    return found
+                values.pop()
+
+        if node.prefix:
+            rest = '/'.join(segments[index:])
+            if rest:
+                values.append(rest)
+                return (node.prefix, tuple(values))
+
+    return None
 
 
 class Route:
     """
     The base class for routes.
     """
-    def __init__(self, route_keywords=None, *, logger=None):
+
+    methods = HANDLER_METHODS
+    # The HTTP methods the route handles.
+
+    segments = ()
+    # The path segments the route matches.  Each is a literal string or a Var.
+
+    catch_all = False
+    # If True the route is a prefix: it matches any URL below its segments and
+    # is passed the rest of the path.
+
+    uses_form = False
+    # True if the route passes variables from ctx.request.form to its handler.
+    # The query string is only parsed in advance (and cached) for these.
+
+    def __init__(self, route_keywords=None, *, logger=None, stream_body=False, max_body_size=None,
+                 compress_level=None, compress_min_size=None, offload=None, stream_json=None):
         self.route_keywords = route_keywords or {}
         self.logger = logger
 
+        self.stream_body = stream_body
+        # If True the handler is called before the body is read and reads it
+        # from ctx.request.stream.
+
+        self.max_body_size = max_body_size
+        # The maximum request body size for this route.  If None, the server's
+        # default (HttpProtocol.max_body_size) is used.
+
+        if compress_level is not None:
+            compression._levels(compress_level)
+        self.compress_level = compress_level
+        # The compression level for responses: an int, a dictionary mapping from
+        # coding to level, 0 to disable compression, or None for the defaults in
+        # compression.levels.
+
+        self.compress_min_size = compress_min_size
+        # Smaller responses are not compressed.  If None, compression.min_size
+        # is used.
+
+        self.offload = offload
+        # True to always encode and compress responses in the executor, False
+        # to never do so, or None to decide based on their expected cost.
+
+        assert stream_json in (None, 'json', 'ndjson'), 'Invalid stream_json {!r}'.format(stream_json)
+        self.stream_json = stream_json
+        # "json" or "ndjson" to stream lists returned by the handler.  See
+        # jsonstream.py.
+
 
 class DynamicRoute(Route):
     """
@@ -89,15 +513,20 @@ class DynamicRoute(Route):
     registered by the @route decorator.
 
     Variables can be created in the URL pattern by wrapping components
-    in braces, such as "/static/js/{filename}".
+    in braces, such as "/static/js/{filename}" or "/users/{id:int}".
 
     This object is callable like a function and will pick the arguments to the
     URL handler from the request (GET variables, JSON variables, etc.)
     """
-    def __init__(self, pattern, func, route_keywords, *, logger=None):
+    def __init__(self, pattern, func, route_keywords, *, methods=None, logger=None, stream_body=False,
+                 max_body_size=None, compress_level=None, compress_min_size=None, offload=None,
+                 stream_json=None):
         """
         pattern
-          The URL regexp.
+          The URL pattern.
+
+        methods
+          The HTTP methods the function handles.  If None, all are handled.
 
         func
           The URL handler callback.
@@ -105,28 +534,42 @@ class DynamicRoute(Route):
         route_keywords
           A dictionary of keyword arguments passed to the @route decorator.
         """
-        Route.__init__(self, route_keywords=route_keywords, logger=logger)
+        Route.__init__(self, route_keywords=route_keywords, logger=logger, stream_body=stream_body,
+                       max_body_size=max_body_size, compress_level=compress_level,
+                       compress_min_size=compress_min_size, offload=offload, stream_json=stream_json)
 
         self.pattern = pattern
         self._func = func
-        self.func = coroutine(func)
 
-        self.regexp = None
+        if methods is not None:
+            if isinstance(methods, str):
+                methods = [methods]
+            methods = tuple(m.upper() for m in methods)
+            assert methods and all(m in HANDLER_METHODS for m in methods), \
+                'Invalid methods for {!r}: {!r}'.format(pattern, methods)
+            self.methods = methods
 
         self.urlvars = []
         # The names of variables to be parsed from the URL, in the order they
-        # appear in the pattern.  There is a group for each in `self.regexp` so
-        # all we have to do is get all of the groups.
+        # appear in the pattern.  routing.get returns their values in the same
+        # order.
 
         self.formvars = []
         # The names of variables we expect to find in vars variables or a JSON
         # object (depending on the content-type).  These are the URL handler
         # parameters that are not variables in the URL pattern.
 
+        self.params = []
+        # The handler's parameters after `ctx` as inspect.Parameter objects.
+
+        self._bind = None
+        # A function generated by build_binder that calls the handler with the
+        # arguments for a request, or None if it only takes `ctx`.
+
         self.annotations = {}
         # The optional annotations describing the argument types for the URL handler function.
         #
-        # This is the annotations from `inspect.getfullargspect`.  It is a mapping from
+        # This is a mapping from
         # argument name to its type.  Only arguments that have an annotation are present.
         #
         # This is available to the functions reading URL and form variables to provide for
@@ -137,69 +580,206 @@ class DynamicRoute(Route):
 
         self.analyze_pattern()
         self.analyze_params()
+        self._bind = self.build_binder()
 
     def analyze_params(self):
         """
         Analyzes the URL handlers parameters to determine which should come from URL
         variables and which are expected to be in the body.
         """
-        spec = inspect.getfullargspec(self._func)
+        params = list(inspect.signature(self._func, eval_str=True).parameters.values())
+
+        assert params and params[0].name == 'ctx' and params[0].kind != params[0].KEYWORD_ONLY, \
+            'The first parameter is not `ctx`.  pattern={} callback={}'.format(self.pattern, self._func)
+
+        self.params = params[1:]
+
+        for param in self.params:
+            assert param.kind != param.VAR_POSITIONAL, \
+                'URL handlers cannot take *{}.  pattern={}'.format(param.name, self.pattern)
+            if param.annotation is not param.empty:
+                self.annotations[param.name] = param.annotation
+
+        names = [param.name for param in self.params if param.kind != param.VAR_KEYWORD]
+        missing = set(self.urlvars) - set(names)
+        assert not missing, 'URL variables {} are not parameters of {}'.format(', '.join(missing), self._func)
+
+        self.formvars = [name for name in names if name not in self.urlvars]
+
+        self.uses_form = bool(self.formvars) or len(names) < len(self.params)
+
+    def build_binder(self):
+        """
+        Returns a function specialized for the handler that calls it with the
+        arguments for a request:
+
+            bind(func, values, ctx) -> func's result
+
+        URL variables are taken from `values` (the values returned by
+        routing.get) by position and the other parameters are looked up in
+        ctx.request.form.  A form variable that is missing gets the parameter's
+        default.  If there is no default the request is rejected with a 400.
+        A **kwargs parameter receives any other form variables.  Parameters
+        annotated as sequences (e.g. list[int]) receive all values of a
+        repeated query string variable.
+
+        Values for annotated parameters are converted to the annotated type
+        (see annotations.py), except for None and defaults.  A value that can't
+        be converted is rejected with a 400.  If configured, the
+        annotation_converter hook is then called with the annotated arguments.
+
+        Generating the source means each request only does the lookups it needs
+        and calls the handler directly instead of building a dictionary of
+        arguments.
+
+        Returns None if the handler only takes `ctx` (and there is no logger),
+        in which case __call__ calls it directly.
+        """
+        if not self.params and not self.logger:
+            return None
+
+        # Locals are prefixed so they can't collide with parameter names.
+        namespace = { '_HttpError': HttpError, '_MISSING': _MISSING, '_EMPTY': {}, '_MultiDict': MultiDict }
+        lines     = []
+        args      = ['_ctx']
+        kwargs    = []
+        logged    = []
+
+        if self.uses_form:
+            lines.append('_form = _ctx.request.form or _EMPTY')
+
+        for param in self.params:
+            name = param.name
+            var  = 'a_' + name
+
+            if param.kind == param.VAR_KEYWORD:
+                namespace['_BOUND'] = frozenset(self.formvars)
+                lines.append('{} = {{ k: v for (k, v) in _form.items() if k not in _BOUND }}'.format(var))
+                kwargs.append('**' + var)
+                logged.append('**' + var)
+                continue
+
+            convert = get_converter(param.annotation)
+            if convert:
+                namespace['c_' + name] = convert
+                conversion = [
+                    'try:',
+                    '    {0} = c_{1}({0})'.format(var, name),
+                    'except (ValueError, TypeError):',
+                    '    raise _HttpError(400, message={!r})'.format('Invalid argument ' + name),
+                ]
+            else:
+                conversion = []
+
+            if name in self.urlvars:
+                lines.append('{} = _values[{}]'.format(var, self.urlvars.index(name)))
+                lines.extend(conversion)
+            elif param.default is not param.empty and not conversion and not is_sequence(param.annotation):
+                namespace['d_' + name] = param.default
+                lines.append('{} = _form.get({!r}, d_{})'.format(var, name, name))
+            else:
+                lines.append('{} = _form.get({!r}, _MISSING)'.format(var, name))
+                if is_sequence(param.annotation):
+                    # A repeated query string variable ("?id=1&id=2") is passed
+                    # as a list of all of its values.
+                    lines.append('if _form.__class__ is _MultiDict and {!r} in _form.repeated:'.format(name))
+                    lines.append('    {} = _form.getall({!r})'.format(var, name))
+                lines.append('if {} is _MISSING:'.format(var))
+                if param.default is param.empty:
+                    lines.append('    raise _HttpError(400, message={!r})'.format('Missing argument ' + name))
+                    if conversion:
+                        lines.append('if {} is not None:'.format(var))
+                        lines.extend('    ' + line for line in conversion)
+                else:
+                    namespace['d_' + name] = param.default
+                    lines.append('    {} = d_{}'.format(var, name))
+                    if conversion:
+                        lines.append('elif {} is not None:'.format(var))
+                        lines.extend('    ' + line for line in conversion)
+
+            if param.kind == param.KEYWORD_ONLY:
+                kwargs.append('{}={}'.format(name, var))
+            else:
+                args.append(var)
+            logged.append('{!r}: {}'.format(name, var))
+
+        if annotation_converter and self.annotations:
+            names = [name for name in self.annotations if name != 'return']
+            namespace['_hook']  = annotation_converter
+            namespace['_route'] = self
+            lines.append('_map = {{ {} }}'.format(', '.join('{!r}: a_{}'.format(name, name) for name in names)))
+            lines.append('_hook(_route, _map)')
+            lines.extend("a_{} = _map[{!r}]".format(name, name) for name in names)
 
-        if spec.annotations:
-            self.annotations = spec.annotations
+        if self.logger:
+            namespace['_logger']  = self.logger
+            namespace['_pattern'] = self.pattern
+            lines.append("_logger.debug('URL: %s params=%r', _pattern, {{ {} }})".format(', '.join(logged)))
 
-        assert spec.args and spec.args[0] == 'ctx', 'The first parameter is not `ctx`.  pattern={} callback={}'.format(self.pattern, self._func)
+        lines.append('return _func({})'.format(', '.join(args + kwargs)))
 
-        args = set(spec.args[1:])
-        self.formvars = args - set(self.urlvars)
+        source = 'def bind(_func, _values, _ctx):\n' + ''.join('    ' + line + '\n' for line in lines)
+        exec(compile(source, '<binder {}>'.format(self.pattern), 'exec'), namespace)
+        return namespace['bind']
 
     def analyze_pattern(self):
         """
-        Creates a regular expression from the pattern for matching URLs.
+        Splits the pattern into the segments used to find the route.  A trailing
+        slash is optional.
         """
         # Split the URL by slashes and examine each part.  Each could be either
         # plan text (e.g. "static") or a variables (e.g. "{filename}").
 
-        regexps  = []
+        segments = []
         varnames = []
 
         assert self.pattern.startswith('/'), 'DynamicRoute patterns must start with "/": {!r}'.format(self.pattern)
 
-        for part in self.pattern.rstrip('/').split('/'):
+        path = self.pattern.rstrip('/')
+        parts = path[1:].split('/') if path else []
+
+        for i, part in enumerate(parts):
             if part.startswith('{') and part.endswith('}'):
                 # variable
-                varnames.append(part[1:-1])
-                regexps.append('([^/]+)')
+                name, _, kind = part[1:-1].partition(':')
+                varnames.append(name)
+
+                if kind == 'path':
+                    assert i == len(parts) - 1, '{{{}:path}} must be at the end of {!r}'.format(name, self.pattern)
+                    self.catch_all = True
+                elif kind.startswith('re:'):
+                    segments.append(Var(kind, _regexp(kind[3:])))
+                else:
+                    assert kind in converters or not kind, 'Unknown converter {!r} in {!r}'.format(kind, self.pattern)
+                    convert = converters.get(kind)
+                    segments.append(Var(kind if convert else '', convert))
             else:
                 # plain text
-                regexps.append(re.escape(part))
+                segments.append(part)
 
-        regexp = '^' + '/'.join(regexps) + '/?$'
+        assert len(set(varnames)) == len(varnames), 'Variable used twice in {!r}'.format(self.pattern)
 
-        self.regexp = re.compile(regexp)
+        self.segments = tuple(segments)
         self.urlvars = varnames
 
-    @coroutine
-    def __call__(self, match, ctx):
+    async def __call__(self, match, ctx):
         """
         Calls the URL handler, passing any defined parameters.
         """
-        args = {
-            'ctx': ctx
-        }
-
-        if self.urlvars:
-            args.update(zip(self.urlvars, match.groups()))
-
-        if self.formvars:
-            assert ctx.request.form, 'No variables: %r' % ctx
-            args.update({ name: ctx.request.form.get(name, None) for name in self.formvars })
-
-        if self.logger:
-            self.logger.debug('URL: %s params=%r', self.pattern, args)
-
-        result = yield from self.func(**args)
+        bind = self._bind
+        if bind is None:
+            result = self._func(ctx)
+        else:
+            result = bind(self._func, match, ctx)
+        if hasattr(result, '__await__') or (type(result) is GeneratorType and inspect.isawaitable(result)):
+            # A coroutine function, or a handler wrapped by a decorator that
+            # returns the coroutine (so iscoroutinefunction is False).
+            # (inspect.isawaitable alone is slow for the usual results, which
+            # aren't awaitable.  The generator test is for @types.coroutine.)
+            result = await result
         return result
 
     def __repr__(self):
-        return 'DynamicRoute<{} {}>'.format(self.pattern, self._func)
+        if self.methods is HANDLER_METHODS:
+            return 'DynamicRoute<{} {}>'.format(self.pattern, self._func)
+        return 'DynamicRoute<{} {} {}>'.format(','.join(self.methods), self.pattern, self._func)
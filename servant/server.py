@@ -0,0 +1,269 @@
+"""
+Provides `serve`, which runs the server in one or more worker processes.
+
+Python can only use one core per process, so to use a whole machine we fork a
+worker per core.  Each worker runs its own event loop accepting connections on
+the same port, either with its own SO_REUSEPORT socket (the kernel spreads
+connections across them) or by inheriting a single listening socket from the
+supervisor.
+
+The supervisor (the original process) does nothing but wait for workers to
+exit and restart them.  Sending it SIGTERM or SIGINT stops the workers and
+then exits.
+
+Workers stop gracefully: they stop accepting connections and finish the
+requests they have already received before exiting (see `drain`).  A second
+signal stops a worker immediately.
+
+Register routes, middleware and configuration before calling `serve` so every
+worker inherits them when it is forked.
+"""
+
+import os, signal, socket, logging, time
+import asyncio
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from .connection import HttpProtocol, connections, counters
+
+logger = logging.getLogger('servant')
+
+RESTART_DELAY = 1.0
+# If a worker exits within this many seconds of being started we wait this long
+# before restarting it so a worker that can't start doesn't make us spin.
+
+
+def serve(host='127.0.0.1', port=8000, *, workers=1, reuse_port=None, cpu_affinity=False,
+          backlog=1024, protocol=HttpProtocol, event_loop=None, drain_timeout=30):
+    """
+    Runs the server until it receives SIGTERM or SIGINT.
+
+    workers
+      The number of worker processes.  If 0 or None, one is started per CPU.  If
+      1, the server runs in this process without a supervisor.
+
+    reuse_port
+      If True, each worker binds its own socket with SO_REUSEPORT and the kernel
+      balances new connections across them.  If False, the socket is bound once
+      before forking and all workers accept from it.  The default is True where
+      SO_REUSEPORT is available.
+
+    cpu_affinity
+      If True, worker N is pinned to CPU N (modulo the CPU count).  Only
+      supported where os.sched_setaffinity is available (Linux).
+
+    backlog
+      The listen backlog for the socket(s).
+
+    protocol
+      The protocol factory, normally HttpProtocol or a subclass.
+
+    event_loop
+      The event loop implementation each worker uses: "asyncio", "uvloop", or a
+      function returning a new loop.  The default is uvloop if it is installed
+      and asyncio otherwise.
+
+    drain_timeout
+      When stopping, the number of seconds workers wait for requests that have
+      already been received to finish.  See `drain`.
+    """
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    if reuse_port is None:
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+
+    assert not reuse_port or hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT is not supported on this platform'
+    assert not cpu_affinity or hasattr(os, 'sched_setaffinity'), 'cpu_affinity is not supported on this platform'
+
+    loop_factory = _loop_factory(event_loop)
+
+    if workers == 1:
+        _run_worker(0, _bind(host, port, False, backlog), protocol, cpu_affinity, loop_factory, drain_timeout)
+        return
+
+    sock = None if reuse_port else _bind(host, port, False, backlog)
+
+    Supervisor(workers, lambda index: _run_worker(index, sock or _bind(host, port, True, backlog), protocol, cpu_affinity, loop_factory, drain_timeout)).run()
+
+    if sock:
+        sock.close()
+
+
+async def drain(server, timeout=30):
+    """
+    Stops an asyncio server from accepting connections and waits for the
+    HttpProtocol connections on the current loop to close.
+
+    Idle keep-alive connections are closed immediately.  Connections with
+    requests in progress (including pipelined requests that have been
+    received) close once they are answered, with "Connection: close" in the
+    last response.  After `timeout` seconds any remaining connections are
+    aborted and their handlers cancelled.
+
+    Returns the number of requests that were still running when the timeout
+    expired.  0 means everything finished cleanly.
+    """
+    server.close()
+
+    loop  = asyncio.get_running_loop()
+    conns = [conn for conn in connections if conn.loop is loop]
+
+    waiters = [conn.drain() for conn in conns]
+    if waiters:
+        await asyncio.wait(waiters, timeout=timeout)
+
+    abandoned = sum(conn.abort() for conn in conns if conn.transport)
+    if abandoned:
+        counters['drain_aborted'] += abandoned
+        logger.warning('drain timed out with %s requests running', abandoned)
+
+    await server.wait_closed()
+
+    return abandoned
+
+
+def _loop_factory(event_loop):
+    """
+    Returns a function that creates event loops of the requested type.  See the
+    `event_loop` parameter of `serve`.
+    """
+    if callable(event_loop):
+        return event_loop
+
+    if event_loop is None:
+        event_loop = 'uvloop' if uvloop else 'asyncio'
+
+    if event_loop == 'uvloop':
+        assert uvloop, 'uvloop is not installed'
+        return uvloop.new_event_loop
+
+    assert event_loop == 'asyncio', 'Invalid event_loop {!r}'.format(event_loop)
+    return asyncio.new_event_loop
+
+
+def _bind(host, port, reuse_port, backlog):
+    """
+    Returns a non-blocking listening socket.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def _run_worker(index, sock, protocol, cpu_affinity, loop_factory, drain_timeout):
+    """
+    Runs an event loop serving connections from `sock` until SIGTERM or SIGINT,
+    then drains the connections.
+    """
+    if cpu_affinity:
+        os.sched_setaffinity(0, {index % os.cpu_count()})
+
+    loop = loop_factory()
+    asyncio.set_event_loop(loop)
+
+    server = loop.run_until_complete(loop.create_server(protocol, sock=sock))
+    logger.info('worker %s (pid %s) listening on %s', index, os.getpid(), sock.getsockname())
+
+    stopping = []
+
+    def on_signal():
+        if stopping:
+            # Asked again - don't wait any longer.
+            stopping[0].cancel()
+            return
+        logger.info('worker %s (pid %s) draining', index, os.getpid())
+        stopping.append(loop.create_task(drain(server, drain_timeout)))
+        stopping[0].add_done_callback(lambda task: loop.stop())
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, on_signal)
+
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        for conn in [conn for conn in connections if conn.loop is loop]:
+            conn.abort()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+class Supervisor:
+    """
+    Forks worker processes and restarts any that exit until told to stop.
+
+    target
+      A function called in each forked worker with the worker's index.  The
+      worker exits when it returns.
+    """
+    def __init__(self, count, target):
+        self.count = count
+        self.target = target
+
+        self.workers = {}
+        # Maps from worker pid to (index, start time).
+
+        self.stopping = False
+
+    def run(self):
+        previous = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous[signum] = signal.signal(signum, self._on_signal)
+
+        try:
+            for index in range(self.count):
+                self._spawn(index)
+
+            while self.workers:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+
+                index, started = self.workers.pop(pid, (None, None))
+                if index is None or self.stopping:
+                    continue
+
+                logger.error('worker %s (pid %s) exited with status %s - restarting', index, pid, status)
+                if time.monotonic() - started < RESTART_DELAY:
+                    time.sleep(RESTART_DELAY)
+                if not self.stopping:
+                    self._spawn(index)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # The child.  Never return into the supervisor's code.
+            status = 1
+            try:
+                for signum in (signal.SIGTERM, signal.SIGINT):
+                    signal.signal(signum, signal.SIG_DFL)
+                self.target(index)
+                status = 0
+            except:
+                logger.error('worker %s failed', index, exc_info=True)
+            finally:
+                os._exit(status)
+
+        self.workers[pid] = (index, time.monotonic())
+
+    def _on_signal(self, signum, frame):
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
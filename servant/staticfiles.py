@@ -16,31 +16,47 @@
 # don't really support it.  Apparently *nix systems have the API (select with file descriptors)
 # but they always report themselves ready and therefore end up blocking anyway.
 #
-# Python will soon (or may already) support an asynchronous sendfile, which would could try to
-# use.
-#
 # To work around this, we'll simply cache the files in memory.  Due to reference counting,
 # Python is usually very good with memory.  The library is really designed for single page
 # applications where resources are cached at the browser for a year.  (Put your version number
 # on the end!)
 
+# Files are compressed when they are loaded using every coding available (see
+# compression.py) and each compressed copy is kept if it is worth sending, so clients get the
+# best encoding they accept without any compression per request.  Each file has a strong ETag
+# computed from its content so browsers can revalidate with If-None-Match and get a 304.
+#
+# Files larger than `sendfile_threshold` aren't held in memory.  They are sent from disk using
+# loop.sendfile, which copies them from the page cache to the socket in the kernel.  Their
+# compressed copies are still held in memory if they are below the threshold, since sending less
+# data matters more for a large file than avoiding the copy.  Static files are assumed not to
+# change while the server is running.
+#
+# Range requests, for resuming downloads and seeking in media, are answered by ranges.py.
+#
+# Files are normally loaded (in an executor, not the event loop) when first requested, compressed
+# at the normal response levels (compression.levels) so the first request isn't slow.  Pass
+# preload=True to serve_prefix to load every file under the directory at startup instead, at the
+# higher `precompression_levels`, which logs the time taken and the memory used (see
+# `manifests`).
+
 # TODO ITEMS
 # ----------
 #
-# We have not implemented compression yet.  I don't believe there are any modern browsers that
-# don't support gzip, so we should only support compression and hold the compressed version in
-# memory.
-#
 # Add a way to register mimetypes.  (Or perhaps use a module that already has them?)
 
-import re, gzip
-from os.path import isdir, splitext, abspath, join, exists, isabs
+import os
+from hashlib import blake2b
+from time import perf_counter
+from asyncio import get_running_loop, shield
+from os.path import isdir, splitext, abspath, join, exists, isabs, relpath as _relpath
+from posixpath import normpath
 from logging import getLogger
 from .errors import HttpError
-from asyncio import coroutine
 from collections import namedtuple
 
 from .routing import Route, register_route
+from . import compression
 
 use_cache = True
 
@@ -74,49 +90,160 @@ map_prefix_to_path = {}
 # path.
 
 map_path_to_cache = {}
-# Maps from fully-qualified filename to a cached http.File entry.
+# Maps from (prefix, relpath) to a cached File.
+
+manifests = {}
+# Maps from URL prefix to statistics about the files preloaded for it:
+#
+# files: The number of files loaded.
+# bytes: The total size of the files.
+# compressed_bytes: The total size of the compressed copies kept.
+# memory: The bytes held in memory, including compressed copies.
+# sendfile: The number of files that are sent from disk.
+# seconds: The time taken to load and compress them.
+
+sendfile_threshold = 1024 * 1024
+# Files larger than this many bytes are sent from disk using sendfile instead of
+# being held in memory.  None holds every file in memory.  This is applied when
+# files are loaded, so set it using configuration.config(sendfile_threshold)
+# before calling serve_prefix.
+
+READ_SIZE = 1024 * 1024
+# Files sent from disk are hashed and compressed in blocks of this size when
+# loaded.
+
+precompression_levels = {
+    'gzip' : 9,
+    'br'   : 11,
+    'zstd' : 19,
+}
+# The levels files are compressed with when they are preloaded.  Each file is
+# only compressed once, so these are high.  A file is compressed with each of
+# these codings that is available.  Files loaded when first requested use
+# compression.levels instead since a request is waiting.
+
+_loading = {}
+# Maps from (prefix, relpath) to the future loading a file that was requested
+# before it was cached, so concurrent requests for it wait for one load.
+
 
 class File:
-    def __init__(self, relpath, mimetype, content, compressed):
-        self.relpath    = relpath
-        self.mimetype   = mimetype
-        self.content    = content
-        self.compressed = compressed # True if gzipped
-        self.etag       = None
+    """
+    A static file.
+
+    content
+      The file's contents, or None if it is too large to hold in memory and is
+      sent from `path`.
+
+    size
+      The size of the file.
+
+    path
+      The fully-qualified path of the file.
+
+    encodings
+      A dictionary mapping from coding (e.g. "gzip") to the content compressed
+      with it.  Only codings that make the file enough smaller are included.
+
+    etag
+      A strong ETag computed from the content.  Each compressed copy is a
+      different representation, so it has its own ETag in `etags`.
+    """
+    def __init__(self, relpath, mimetype, content, encodings=None, etag=None, path=None, size=None):
+        self.relpath   = relpath
+        self.mimetype  = mimetype
+        self.content   = content
+        self.encodings = encodings or {}
+        self.path      = path
+        self.size      = len(content) if size is None else size
+
+        self.etag = etag or '"{}"'.format(blake2b(content, digest_size=12).hexdigest())
+
+        self.etags = { None: self.etag }
+        for coding in self.encodings:
+            self.etags[coding] = '{}-{}"'.format(self.etag[:-1], coding)
+        # Maps from coding (None for the uncompressed content) to its ETag.
+
+    def __repr__(self):
+        return 'File<{} {} bytes {}{}>'.format(self.relpath, self.size, ','.join(self.encodings),
+                                               ' sendfile' if self.content is None else '')
+
+    def memory(self):
+        """
+        Returns the number of bytes held in memory for the file.
+        """
+        return len(self.content or b'') + sum(len(data) for data in self.encodings.values())
+
+    def matches(self, if_none_match, coding=None):
+        """
+        Returns True if an If-None-Match header value matches the ETag of the
+        representation being sent: the content compressed with `coding`, or
+        uncompressed if it is None.
+        """
+        if if_none_match.strip() == '*':
+            return True
+        etag = self.etags[coding]
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == etag:
+                return True
+        return False
 
 
 class StaticFileRoute(Route):
     """
     A route for serving static files from the static file cache.
     """
+
+    methods = ('GET', 'HEAD')
+    catch_all = True
+
     def __init__(self, prefix, route_keywords=None):
         Route.__init__(self, route_keywords=route_keywords)
 
         self.prefix = prefix
 
-        if not prefix[:-1] == '/':
-            prefix += '/'
-
-        self.regexp = re.compile('^' + re.escape(prefix) + '(.+)')
+        # Matches "{prefix}/{relpath}" where relpath may contain slashes.
+        path = prefix.strip('/')
+        self.segments = tuple(path.split('/')) if path else ()
 
     def __repr__(self):
         return 'StaticFileRoute<%s>' % self.prefix
 
-    @coroutine
-    def __call__(self, match, ctx):
-        relpath = match.group(1)
-        return get(self.prefix, relpath)
+    async def __call__(self, match, ctx):
+        # Each file is cached (and loaded) once under its normalized path, not
+        # once for every spelling of it such as "./a.js" or "sub/../a.js".
+        relpath = normpath(match[0])
+        entry = map_path_to_cache.get((self.prefix, relpath)) if use_cache else None
+        if entry is None:
+            # Reading and compressing a large file would stall the event loop.
+            key = (self.prefix, relpath)
+            future = _loading.get(key)
+            if future is None:
+                future = _loading[key] = get_running_loop().run_in_executor(None, get, self.prefix, relpath)
+                future.add_done_callback(lambda future: _loading.pop(key, None))
+            # (Shielded so one request being cancelled doesn't cancel the load
+            # for the others.)
+            entry = await shield(future)
+        return entry
 
 
 def register_file_type(ext, mimetype=None, compress=None):
     map_ext_to_mime[ext] = Ext(mimetype=mimetype, compress=compress)
 
 
-def serve_prefix(prefix, path, **route_keywords):
+def serve_prefix(prefix, path, *, preload=False, **route_keywords):
     """
     Registers a URL prefix (e.g. "/images") with a directory.  Any URLs starting with this
     prefix will serve files from the given path or below.
 
+    preload
+      If True, every file below the directory with an extension in map_ext_to_mime is loaded
+      and compressed now instead of when first requested.  The time taken and the memory used
+      are logged and stored in manifests[prefix].
+
     route_keywords
       Route keywords.  These are attached to the route for use by middleware.
     """
@@ -125,6 +252,51 @@ def serve_prefix(prefix, path, **route_keywords):
     map_prefix_to_path[prefix] = path
     register_route(StaticFileRoute(prefix, route_keywords=route_keywords))
 
+    if preload:
+        build_manifest(prefix)
+
+
+def build_manifest(prefix):
+    """
+    Loads every file for a prefix into the cache, returning statistics about
+    them (see `manifests`).
+    """
+    root = path_from_prefix(prefix)
+
+    start = perf_counter()
+    files = 0
+    size = 0
+    compressed = 0
+    memory = 0
+    on_disk = 0
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if splitext(filename)[1] not in map_ext_to_mime:
+                continue
+            relpath = _relpath(join(dirpath, filename), root).replace(os.sep, '/')
+            entry = _load(prefix, root, relpath, precompression_levels)
+            map_path_to_cache[(prefix, relpath)] = entry
+            files += 1
+            size += entry.size
+            compressed += sum(len(data) for data in entry.encodings.values())
+            memory += entry.memory()
+            if entry.content is None:
+                on_disk += 1
+
+    stats = manifests[prefix] = {
+        'files'            : files,
+        'bytes'            : size,
+        'compressed_bytes' : compressed,
+        'memory'           : memory,
+        'sendfile'         : on_disk,
+        'seconds'          : perf_counter() - start,
+    }
+    logger.info('Loaded %s: %d files, %d bytes plus %d compressed, %d bytes in memory, %d sent from disk, in %.2fs',
+                prefix, files, size, compressed, memory, on_disk, stats['seconds'])
+    return stats
+
 
 def path_from_prefix(prefix):
     """
@@ -136,12 +308,16 @@ def path_from_prefix(prefix):
         raise Exception('The prefix {!r} is not being served'.format(prefix))
     return path
 
+
 def get(prefix, relpath):
     """
     Returns an http.File object for the given URL prefix and path from that prefix.
+
+    This reads the file if it isn't cached, so don't call it from the event loop.
     """
+    relpath = normpath(relpath)
 
-    entry = map_path_to_cache.get(relpath) if use_cache else None
+    entry = map_path_to_cache.get((prefix, relpath)) if use_cache else None
 
     assert prefix in map_prefix_to_path, "Prefix {!r} is not registered".format(prefix)
     root = map_prefix_to_path[prefix]
@@ -152,7 +328,7 @@ def get(prefix, relpath):
             logger.debug('Not found: url=%r fqn=%r', relpath, fqn)
             raise HttpError(404, relpath)
 
-        if fqn[:len(root)] != root:
+        if not fqn.startswith(join(root, '')):
             # This means someone used ".." to try to move up out of the static directory.  This
             # very well may be a hack attempt.
 
@@ -160,20 +336,78 @@ def get(prefix, relpath):
                          prefix, root, relpath, fqn)
             raise HttpError(404, relpath)
 
-        ext = splitext(relpath)[1]
-        if ext not in map_ext_to_mime:
-            raise Exception('No mimetype for "{}" (from {!r})'.format(ext, relpath))
+        levels = { coding: compression.levels[coding] for coding in precompression_levels }
+        entry = _load(prefix, root, relpath, levels)
 
-        content = open(fqn, 'rb').read()
-        extinfo = map_ext_to_mime[ext]
+        if use_cache:
+            map_path_to_cache[(prefix, relpath)] = entry
 
-        if extinfo.compress:
-            # compress using gzip
-            content = gzip.compress(content)
+    return entry
 
-        entry = File(relpath, extinfo.mimetype, content, extinfo.compress)
 
-        if use_cache:
-            map_path_to_cache[relpath] = entry
+def _load(prefix, root, relpath, levels):
+    """
+    Reads a file and returns a File with its compressed copies.
 
-    return entry
+    levels
+      A dictionary mapping from coding to the level to compress with.
+    """
+    ext = splitext(relpath)[1]
+    if ext not in map_ext_to_mime:
+        raise Exception('No mimetype for "{}" (from {!r})'.format(ext, relpath))
+
+    extinfo = map_ext_to_mime[ext]
+    fqn = join(root, relpath)
+
+    if sendfile_threshold and os.stat(fqn).st_size > sendfile_threshold:
+        return _load_large(relpath, extinfo, fqn, levels)
+
+    with open(fqn, 'rb') as f:
+        content = f.read()
+
+    encodings = {}
+    if extinfo.compress:
+        for coding, level in levels.items():
+            if coding in compression.compressors:
+                data = compression.compressors[coding](content, level)
+                if compression.is_worth_sending(len(content), data):
+                    encodings[coding] = data
+
+    return File(relpath, extinfo.mimetype, content, encodings)
+
+
+def _load_large(relpath, extinfo, fqn, levels):
+    """
+    Returns a File for a file that is sent from disk.  It is read a block at a
+    time to compute its ETag and any compressed copies small enough to keep.
+    """
+    digest = blake2b(digest_size=12)
+    compressors = {}
+    if extinfo.compress:
+        for coding, level in levels.items():
+            if coding in compression.stream_compressors:
+                compressors[coding] = (compression.compressobj(coding, level), [])
+
+    size = 0
+    with open(fqn, 'rb') as f:
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            size += len(block)
+            digest.update(block)
+            for coding, (compressor, parts) in list(compressors.items()):
+                parts.append(compressor.compress(block))
+                if sum(len(part) for part in parts) > sendfile_threshold:
+                    # Too large to keep.
+                    del compressors[coding]
+
+    encodings = {}
+    for coding, (compressor, parts) in compressors.items():
+        parts.append(compressor.flush())
+        data = b''.join(parts)
+        if len(data) <= sendfile_threshold and compression.is_worth_sending(size, data):
+            encodings[coding] = data
+
+    return File(relpath, extinfo.mimetype, None, encodings, etag='"{}"'.format(digest.hexdigest()), path=fqn,
+                size=size)
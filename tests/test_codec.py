@@ -0,0 +1,70 @@
+"""
+Tests that the JSON codecs give the same results once configured.
+
+    python3 -m pytest tests
+"""
+
+import json
+from dataclasses import dataclass
+from datetime import date, datetime
+from enum import Enum
+from uuid import UUID
+
+import pytest
+
+from servant.codec import StdlibJsonCodec, orjson
+
+if orjson:
+    from servant.codec import OrjsonCodec
+
+
+class Color(Enum):
+    RED = 'red'
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+VALUES = [
+    { 'when': datetime(2020, 1, 2, 3, 4, 5) },
+    { 'day': date(2020, 1, 2) },
+    { 'id': UUID(int=1) },
+    { 'color': Color.RED },
+    { 'point': Point(1, 2) },
+    { 'big': 2 ** 70, 'small': [1, -2 ** 70] },
+    { 'text': 'café', 1: None },
+]
+
+ENCODERS = {
+    date  : lambda d: { '__date': d.isoformat() },
+    UUID  : lambda u: { '__uuid': u.hex },
+    Enum  : lambda e: { '__enum': e.name },
+    Point : lambda p: [p.x, p.y],
+}
+
+
+@pytest.mark.skipif(not orjson, reason='orjson is not installed')
+@pytest.mark.parametrize('value', VALUES)
+def test_encoders_give_same_results(value):
+    stdlib = StdlibJsonCodec(encoders=ENCODERS)
+    fast = OrjsonCodec(encoders=ENCODERS)
+    assert json.loads(fast.encode(value)) == json.loads(stdlib.encode(value))
+
+
+@pytest.mark.skipif(not orjson, reason='orjson is not installed')
+def test_encode_hook_gives_same_results():
+    def hook(obj):
+        return repr(obj)
+    stdlib = StdlibJsonCodec(encode_hook=hook)
+    fast = OrjsonCodec(encode_hook=hook)
+    for value in [datetime(2020, 1, 2), Point(1, 2), 2 ** 70]:
+        assert json.loads(fast.encode(value)) == json.loads(stdlib.encode(value))
+
+
+@pytest.mark.skipif(not orjson, reason='orjson is not installed')
+def test_unencodable_raises():
+    with pytest.raises(TypeError):
+        OrjsonCodec().encode({ 'values': { 1, 2 } })
@@ -0,0 +1,83 @@
+"""
+Tests for choosing a coding from Accept-Encoding.
+
+    python3 -m pytest tests
+"""
+
+import pytest
+
+from servant import compression
+from servant.compression import negotiate, accepts, choose
+
+
+@pytest.fixture(autouse=True)
+def gzip_and_deflate():
+    # Only gzip and deflate are always available.
+    saved = list(compression.preference)
+    compression.configure(codings=['gzip', 'deflate'])
+    yield
+    compression.configure(codings=saved)
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None,                          None),
+    ('',                            None),
+    ('gzip',                        'gzip'),
+    ('GZIP',                        'gzip'),
+    ('x-gzip',                      'gzip'),
+    ('deflate',                     'deflate'),
+    ('br',                          None),
+
+    # Ties are broken by the server's preference.
+    ('deflate, gzip',               'gzip'),
+    ('gzip;q=0.5, deflate;q=0.5',   'gzip'),
+
+    # Otherwise the highest q-value wins.
+    ('gzip;q=0.5, deflate;q=0.8',   'deflate'),
+    ('gzip;q=0.5, deflate',         'deflate'),
+    ('gzip; q=1.0, deflate; q=0.9', 'gzip'),
+    ('gzip;Q=0.1, deflate;q=0.2',   'deflate'),
+
+    # q=0 means "not acceptable".
+    ('gzip;q=0',                    None),
+    ('gzip;q=0.000, deflate',       'deflate'),
+    ('gzip;q=invalid, deflate',     'deflate'),
+
+    # "*" matches codings not listed.
+    ('*',                           'gzip'),
+    ('gzip;q=0, *',                 'deflate'),
+    ('*;q=0.5, deflate',            'deflate'),
+    ('*;q=0',                       None),
+    ('*;q=0, gzip',                 'gzip'),
+
+    # Refusing identity doesn't make a coding acceptable, but doesn't stop one
+    # being chosen.
+    ('identity;q=0',                None),
+    ('identity;q=0, deflate',       'deflate'),
+    ('identity, gzip;q=0.5',        'gzip'),
+])
+def test_negotiate(header, expected):
+    assert negotiate(header) == expected
+
+
+def test_preference():
+    compression.configure(codings=['deflate', 'gzip'])
+    assert negotiate('gzip, deflate') == 'deflate'
+    assert negotiate('gzip, deflate;q=0.9') == 'gzip'
+
+
+def test_accepts():
+    assert accepts('gzip', 'gzip')
+    assert not accepts('gzip', 'deflate')
+    assert not accepts('gzip;q=0', 'gzip')
+    assert accepts('*', 'br')
+    assert not accepts('*, br;q=0', 'br')
+    assert not accepts(None, 'gzip')
+
+
+def test_choose_from_available():
+    assert choose('gzip, deflate', { 'deflate': b'' }) == 'deflate'
+    assert choose('gzip, deflate', { 'br': b'' }) is None
+    assert choose('gzip;q=0, deflate;q=0.1', { 'gzip': b'', 'deflate': b'' }) == 'deflate'
+    assert choose('gzip', {}) is None
+    assert choose(None, { 'gzip': b'' }) is None
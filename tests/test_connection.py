@@ -0,0 +1,294 @@
+"""
+Regression tests for HttpProtocol, run against a real server on localhost.
+
+    python3 -m pytest tests
+"""
+
+import asyncio, functools
+
+from servant import route
+from servant.connection import HttpProtocol, counters
+from servant.middleware import middleware, register
+from servant.middleware.response import ResponseMiddleware
+
+if not any(isinstance(m, ResponseMiddleware) for m in middleware):
+    register(ResponseMiddleware())
+
+
+@route('/test/unread', methods=['POST'], stream_body=True, max_body_size=100)
+def unread(ctx):
+    # Returns without reading the body.
+    return {'ok': 1}
+
+
+def run(client, **settings):
+    """
+    Runs `client(port)` against a server, restoring any HttpProtocol settings
+    afterwards.  Returns the result and a list of the exceptions that reached
+    the event loop.
+    """
+    saved = { name: getattr(HttpProtocol, name) for name in settings }
+    for name, value in settings.items():
+        setattr(HttpProtocol, name, value)
+
+    errors = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(lambda loop, context: errors.append(context))
+        server = await loop.create_server(HttpProtocol, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.wait_for(client(port), 10)
+        finally:
+            server.close()
+
+    try:
+        return asyncio.run(main()), errors
+    finally:
+        for name, value in saved.items():
+            setattr(HttpProtocol, name, value)
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode().split('\r\n')
+    headers = { name.lower(): value for (name, value) in (line.split(': ', 1) for line in lines[1:] if line) }
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return lines[0], headers, body
+
+
+async def unread_body(port, more):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'POST /test/unread HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nfirst\r\n')
+    status = (await read_response(reader))[0]
+    if more:
+        # More body arrives after the response, enough to exceed max_body_size.
+        writer.write(b'80\r\n' + b'x' * 128 + b'\r\n')
+    rest = await reader.read()
+    writer.close()
+    return status, rest
+
+
+def test_body_too_large_after_handler_returns():
+    (status, rest), errors = run(lambda port: unread_body(port, True))
+    assert status == 'HTTP/1.1 200 OK'
+    assert rest == b''
+    assert not errors
+
+
+def test_body_timeout_after_handler_returns():
+    (status, rest), errors = run(lambda port: unread_body(port, False), body_timeout=0.5)
+    assert status == 'HTTP/1.1 200 OK'
+    assert rest == b''
+    assert not errors
+
+
+@route('/test/fails')
+async def fails(ctx):
+    yield b'first'
+    raise ValueError('failed partway')
+
+
+@route('/test/ok')
+def ok(ctx):
+    return b'OK-BODY'
+
+
+async def failed_stream(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /test/fails HTTP/1.1\r\n\r\nGET /test/ok HTTP/1.1\r\n\r\n')
+    data = await reader.read()
+    writer.close()
+    return data
+
+
+def test_failed_stream_closes_connection():
+    data, errors = run(failed_stream, pipeline_depth=2)
+    head, _, body = data.partition(b'\r\n\r\n')
+    assert b'transfer-encoding: chunked' in head
+    # The body is cut off after the first chunk and nothing follows it.
+    assert body == b'5\r\nfirst\r\n'
+    assert not errors
+
+
+@route('/test/slow')
+async def slow(ctx):
+    await asyncio.sleep(0.1)
+    return b'OK-BODY'
+
+
+async def half_close(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    # The client closes its side while the handler is running.
+    writer.write(b'GET /test/slow HTTP/1.1\r\n\r\n')
+    writer.write_eof()
+    status, headers, body = await read_response(reader)
+    # The server closes once it has answered, well before keepalive_timeout.
+    rest = await asyncio.wait_for(reader.read(), 2)
+    writer.close()
+    return status, body, rest
+
+
+def test_half_close_closes_after_response():
+    (status, body, rest), errors = run(half_close)
+    assert status == 'HTTP/1.1 200 OK'
+    assert body == b'OK-BODY'
+    assert rest == b''
+    assert not errors
+
+
+@route('/test/post', methods=['POST'])
+def post(ctx):
+    return b'OK-BODY'
+
+
+async def chunked_post(port, chunks):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'POST /test/post HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' + chunks)
+    status = (await read_response(reader))[0]
+    writer.close()
+    return status
+
+
+def test_chunk_sizes_are_strict():
+    for size in [b'0x5', b'+5', b'0_5', b' 5', b'5 ', b'-0', b'']:
+        status, _ = run(lambda port: chunked_post(port, size + b'\r\nfirst\r\n0\r\n\r\n'))
+        assert status == 'HTTP/1.1 400 Bad Request', size
+
+    for size in [b'5', b'05', b'5;name=value', b'5 ; name']:
+        status, _ = run(lambda port: chunked_post(port, size + b'\r\nfirst\r\n0\r\n\r\n'))
+        assert status == 'HTTP/1.1 200 OK', size
+
+
+def test_trailers_are_limited():
+    status, _ = run(lambda port: chunked_post(port, b'5\r\nfirst\r\n0\r\nname: value\r\n\r\n'))
+    assert status == 'HTTP/1.1 200 OK'
+
+    trailers = b'name: value\r\n' * 1000
+    status, _ = run(lambda port: chunked_post(port, b'5\r\nfirst\r\n0\r\n' + trailers + b'\r\n'))
+    assert status == 'HTTP/1.1 431 Request Header Fields Too Large'
+
+
+def wrapped(func):
+    # An ordinary decorator around a coroutine function.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@route('/test/wrapped')
+@wrapped
+async def wrapped_handler(ctx):
+    await asyncio.sleep(0)
+    return b'OK-BODY'
+
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET {} HTTP/1.1\r\n\r\n'.format(path)).encode())
+    response = await read_response(reader)
+    writer.close()
+    return response
+
+
+def test_wrapped_coroutine_handler():
+    (status, headers, body), errors = run(lambda port: get(port, '/test/wrapped'))
+    assert status == 'HTTP/1.1 200 OK'
+    assert body == b'OK-BODY'
+
+
+@route('/test/unencodable')
+def unencodable(ctx):
+    return {'values': {1, 2}}
+
+
+async def unencodable_then_ok(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /test/unencodable HTTP/1.1\r\n\r\nGET /test/ok HTTP/1.1\r\n\r\n')
+    first = await read_response(reader)
+    second = await read_response(reader)
+    writer.close()
+    return first[0], second[0]
+
+
+def test_completion_error_is_answered():
+    (first, second), errors = run(unencodable_then_ok)
+    assert first == 'HTTP/1.1 500 Internal Server Error'
+    assert second == 'HTTP/1.1 200 OK'
+
+
+@route('/test/badheader')
+def badheader(ctx):
+    ctx.response.headers['x-count'] = 1
+    return b'BAD-BODY'
+
+
+async def badheader_then_ok(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /test/badheader HTTP/1.1\r\n\r\nGET /test/ok HTTP/1.1\r\n\r\n')
+    first = await read_response(reader)
+    second = await read_response(reader)
+    writer.close()
+    return first, second
+
+
+def test_send_error_is_answered():
+    (first, second), errors = run(badheader_then_ok)
+    assert first[0] == 'HTTP/1.1 500 Internal Server Error'
+    assert second[0] == 'HTTP/1.1 200 OK'
+    assert second[2] == b'OK-BODY'
+
+
+@route('/test/slowreader', methods=['POST'], stream_body=True)
+async def slowreader(ctx):
+    # Falls behind so reading is paused for longer than body_timeout.
+    await asyncio.sleep(2.5)
+    size = 0
+    async for chunk in ctx.request.stream:
+        size += len(chunk)
+    return str(size).encode()
+
+
+async def slow_reader_post(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'POST /test/slowreader HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+    writer.write(b'c8\r\n' + b'x' * 200 + b'\r\n')
+    await asyncio.sleep(0.2)
+    writer.write(b'c8\r\n' + b'x' * 200 + b'\r\n0\r\n\r\n')
+    response = await read_response(reader)
+    writer.close()
+    return response
+
+
+def test_no_body_timeout_while_reading_paused():
+    before = counters['timeout_body']
+    (status, headers, body), errors = run(slow_reader_post, body_timeout=0.5,
+                                          read_high_water=100, read_low_water=10)
+    assert status == 'HTTP/1.1 200 OK'
+    assert body == b'400'
+    assert counters['timeout_body'] == before
+
+
+@route('/test/form', methods=['POST'])
+def form(ctx, name=None):
+    return b'OK-BODY'
+
+
+async def post_json(port, body):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'POST /test/form HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: ' +
+                 str(len(body)).encode() + b'\r\n\r\n' + body)
+    status = (await read_response(reader))[0]
+    writer.close()
+    return status
+
+
+def test_invalid_json_body_is_400():
+    for body in [b'{"name": ', b'[1, 2]', b'"name"', b'\xff']:
+        status, _ = run(lambda port: post_json(port, body))
+        assert status == 'HTTP/1.1 400 Bad Request', body
+
+    status, _ = run(lambda port: post_json(port, b'{"name": "x"}'))
+    assert status == 'HTTP/1.1 200 OK'
@@ -0,0 +1,123 @@
+"""
+Tests for Range header parsing and byte-range responses.
+
+    python3 -m pytest tests
+"""
+
+import pytest
+
+from servant import ranges
+from servant.requests import Request
+from servant.responses import Response
+from servant.staticfiles import File
+
+
+@pytest.mark.parametrize('header, size, expected', [
+    # One range.
+    ('bytes=0-9',        100, [(0, 10)]),
+    ('bytes=90-',        100, [(90, 100)]),
+    ('bytes=90-200',     100, [(90, 100)]),
+    ('bytes=-10',        100, [(90, 100)]),
+    ('bytes=-200',       100, [(0, 100)]),
+    ('BYTES = 0-9',      100, [(0, 10)]),
+
+    # Overlapping and adjacent ranges are combined, in the order requested.
+    ('bytes=50-59,0-9',          100, [(50, 60), (0, 10)]),
+    ('bytes=0-9,5-14',           100, [(0, 15)]),
+    ('bytes=0-9,10-19',          100, [(0, 20)]),
+    ('bytes=0-10,20-30,5-25',    100, [(0, 31)]),
+    ('bytes=20-30,40-50,25-45',  100, [(20, 51)]),
+    ('bytes=60-,-50',            100, [(50, 100)]),
+    ('bytes=80-89,0-9,85-',      100, [(80, 100), (0, 10)]),
+
+    # Unsatisfiable.
+    ('bytes=100-',       100, []),
+    ('bytes=100-200',    100, []),
+    ('bytes=-0',         100, []),
+    ('bytes=0-9',        0,   []),
+    ('bytes=-10',        0,   []),
+    ('bytes=-10,0-',     0,   []),
+
+    # Ignored.
+    ('items=0-9',        100, None),
+    ('bytes=',           100, None),
+    ('bytes=9-0',        100, None),
+    ('bytes=-',          100, None),
+    ('bytes=a-b',        100, None),
+    ('bytes=0-9;x',      100, None),
+    ('bytes=0--9',       100, None),
+])
+def test_parse(header, size, expected):
+    assert ranges.parse(header, size) == expected
+
+
+def test_too_many_ranges():
+    spans = ','.join('{}-{}'.format(start, start) for start in range(0, 2 * ranges.max_ranges, 2))
+    assert len(ranges.parse('bytes=' + spans, 1000)) == ranges.max_ranges
+
+    spans = ','.join('{}-{}'.format(start, start) for start in range(0, 2 * ranges.max_ranges + 2, 2))
+    assert ranges.parse('bytes=' + spans, 1000) is None
+
+    # They are counted after being combined.
+    spans = ','.join('{}-{}'.format(start, start) for start in range(0, 4 * ranges.max_ranges))
+    assert ranges.parse('bytes=' + spans, 1000) == [(0, 4 * ranges.max_ranges)]
+
+
+class Ctx:
+    def __init__(self, headers):
+        self.request = Request(None, 'GET', '/file.txt', headers, b'')
+        self.response = Response()
+        self.response.headers['content-type'] = 'text/plain'
+
+
+FILE = File('file.txt', 'text/plain', bytes(range(100)))
+
+
+def respond(headers):
+    ctx = Ctx(headers)
+    return ranges.respond(ctx, FILE, None, headers['range']), ctx.response
+
+
+def test_respond_one_range():
+    handled, response = respond({ 'range': 'bytes=10-19' })
+    assert handled
+    assert response.status == 206
+    assert bytes(response.body) == bytes(range(10, 20))
+    assert response.headers['content-range'] == 'bytes 10-19/100'
+    assert response.headers['content-length'] == '10'
+
+
+def test_respond_several_ranges():
+    handled, response = respond({ 'range': 'bytes=50-51,0-1' })
+    assert response.status == 206
+    boundary = response.headers['content-type'].partition('boundary=')[2]
+    assert boundary
+    body = bytes(response.body)
+    assert body.index(b'Content-Range: bytes 50-51/100') < body.index(b'Content-Range: bytes 0-1/100')
+    assert body.endswith('\r\n--{}--\r\n'.format(boundary).encode())
+    assert response.headers['content-length'] == str(len(body))
+
+
+def test_respond_unsatisfiable():
+    handled, response = respond({ 'range': 'bytes=100-' })
+    assert handled
+    assert response.status == 416
+    assert response.headers['content-range'] == 'bytes */100'
+
+
+def test_respond_empty_file():
+    ctx = Ctx({ 'range': 'bytes=-10' })
+    assert ranges.respond(ctx, File('empty.txt', 'text/plain', b''), None, 'bytes=-10')
+    assert ctx.response.status == 416
+    assert ctx.response.headers['content-range'] == 'bytes */0'
+
+
+def test_if_range():
+    handled, response = respond({ 'range': 'bytes=10-19', 'if-range': FILE.etag })
+    assert handled
+    assert response.status == 206
+
+    for if_range in ['"other"', 'W/' + FILE.etag, 'Wed, 21 Oct 2015 07:28:00 GMT']:
+        handled, response = respond({ 'range': 'bytes=10-19', 'if-range': if_range })
+        assert not handled
+        assert response.status is None
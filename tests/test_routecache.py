@@ -0,0 +1,72 @@
+"""
+Tests for RouteCache's admission and eviction.
+
+    python3 -m pytest tests
+"""
+
+from servant.routecache import RouteCache
+
+
+def request(cache, key):
+    # How routing.resolve uses the cache.
+    value = cache.get(key)
+    if value is None:
+        value = 'route for ' + key
+        cache.put(key, value)
+    return value
+
+
+def test_flood_does_not_evict_hot_entries():
+    cache = RouteCache(64)
+    hot = ['/hot/{}'.format(i) for i in range(32)]
+
+    for round in range(3):
+        for key in hot:
+            request(cache, key)
+    assert all(key in cache.entries for key in hot)
+
+    # Unique URLs arriving between the usual traffic are rejected instead of
+    # evicting the URLs requested every round.
+    unique = 0
+    for round in range(200):
+        for key in hot:
+            request(cache, key)
+        for i in range(100):
+            request(cache, '/users/{}'.format(unique))
+            unique += 1
+
+    assert all(key in cache.entries for key in hot)
+    assert len(cache.entries) <= 64
+    assert cache.rejected > unique * 0.9
+
+    hits = cache.hits
+    for key in hot:
+        request(cache, key)
+    assert cache.hits == hits + len(hot)
+
+
+def test_new_hot_entries_are_admitted():
+    cache = RouteCache(64)
+    for i in range(64):
+        request(cache, '/old/{}'.format(i))
+    assert len(cache.entries) == 64
+
+    # URLs requested more often than the least recently used entry replace it.
+    for round in range(4):
+        request(cache, '/new')
+    assert '/new' in cache.entries
+    assert len(cache.entries) == 64
+
+
+def test_resize_to_zero_disables():
+    cache = RouteCache(64)
+    request(cache, '/a')
+    assert cache.get('/a') is not None
+
+    cache.resize(0)
+    assert cache.get('/a') is None
+    for round in range(10):
+        request(cache, '/a')
+    assert cache.get('/a') is None
+    assert not cache.entries
+    assert cache.stats()['capacity'] == 0
@@ -0,0 +1,143 @@
+"""
+Tests for the route tree, its converters and method routing.
+
+    python3 -m pytest tests
+"""
+
+import asyncio
+from uuid import UUID
+
+import pytest
+
+from servant import route, routing
+from test_connection import run, read_response
+
+
+@route('/test/routing/users/me')
+def users_me(ctx):
+    return b'me'
+
+@route('/test/routing/users/{id:int}')
+def users_int(ctx, id):
+    return b'int'
+
+@route('/test/routing/users/{name}')
+def users_name(ctx, name):
+    return b'name'
+
+@route('/test/routing/users/{rest:path}')
+def users_rest(ctx, rest):
+    return b'rest'
+
+@route('/test/routing/items/{id:uuid}')
+def items_uuid(ctx, id):
+    return b'uuid'
+
+@route('/test/routing/items/{slug:re:[a-z]+-[0-9]+}')
+def items_slug(ctx, slug):
+    return b'slug'
+
+@route('/test/routing/items/{id:int}/parts/{part}')
+def items_part(ctx, id, part):
+    return b'part'
+
+
+def found(url, method='GET'):
+    # Returns the pattern of the route for a URL and the values matched.
+    r, values = routing.get(url, method)
+    return (r and r.pattern, values)
+
+
+def test_most_specific_route_wins():
+    assert found('/test/routing/users/me') == ('/test/routing/users/me', ())
+    assert found('/test/routing/users/me/') == ('/test/routing/users/me', ())
+    assert found('/test/routing/users/42') == ('/test/routing/users/{id:int}', (42,))
+    assert found('/test/routing/users/bob') == ('/test/routing/users/{name}', ('bob',))
+    assert found('/test/routing/users/bob/photos/1') == ('/test/routing/users/{rest:path}', ('bob/photos/1',))
+
+
+def test_converters():
+    # Only ASCII digits without signs are ints.
+    for segment in ['-1', '+1', '1_000', ' 1', '١٢']:
+        assert found('/test/routing/users/' + segment)[0] == '/test/routing/users/{name}', segment
+
+    uuid = '12345678-1234-5678-1234-567812345678'
+    assert found('/test/routing/items/' + uuid) == ('/test/routing/items/{id:uuid}', (UUID(uuid),))
+    for segment in ['{' + uuid + '}', 'urn:uuid:' + uuid, uuid.replace('-', '')]:
+        assert found('/test/routing/items/' + segment) == (None, None), segment
+
+    assert found('/test/routing/items/abc-12') == ('/test/routing/items/{slug:re:[a-z]+-[0-9]+}', ('abc-12',))
+    assert found('/test/routing/items/abc-12x') == (None, None)
+
+    assert found('/test/routing/items/7/parts/wheel') == ('/test/routing/items/{id:int}/parts/{part}', (7, 'wheel'))
+    assert found('/test/routing/items/x/parts/wheel') == (None, None)
+
+
+def test_duplicate_routes_are_rejected():
+    with pytest.raises(AssertionError):
+        @route('/test/routing/users/{other}')
+        def users_other(ctx, other):
+            pass
+
+    with pytest.raises(AssertionError):
+        @route('/test/routing/users/me', methods=['GET'])
+        def users_me_again(ctx):
+            pass
+
+    with pytest.raises(AssertionError):
+        @route('/test/routing/users/{a}/{a}')
+        def users_twice(ctx, a):
+            pass
+
+
+@route('/test/routing/things', methods=['GET'])
+def list_things(ctx):
+    return b'list'
+
+@route('/test/routing/things', methods=['POST'])
+def add_thing(ctx):
+    return b'add'
+
+
+def test_routes_by_method():
+    def methods(method):
+        r, values = routing.get('/test/routing/things', method)
+        return r and list(r.methods)
+
+    assert methods('GET') == ['GET']
+    assert methods('HEAD') == ['GET']
+    assert methods('POST') == ['POST']
+    assert methods('DELETE') is None
+
+    r, values, query, allow = routing.resolve('DELETE', '/test/routing/things')
+    assert r is None
+    assert allow == 'GET, HEAD, POST, OPTIONS'
+
+
+async def request(port, method, url):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('{} {} HTTP/1.1\r\n\r\n'.format(method, url).encode())
+    response = await read_response(reader)
+    writer.close()
+    return response
+
+
+def test_405_and_options():
+    (status, headers, body), errors = run(lambda port: request(port, 'DELETE', '/test/routing/things'))
+    assert status == 'HTTP/1.1 405 Method Not Allowed'
+    assert headers['allow'] == 'GET, HEAD, POST, OPTIONS'
+
+    (status, headers, body), errors = run(lambda port: request(port, 'OPTIONS', '/test/routing/things'))
+    assert status == 'HTTP/1.1 204 No Content'
+    assert headers['allow'] == 'GET, HEAD, POST, OPTIONS'
+
+    (status, headers, body), errors = run(lambda port: request(port, 'OPTIONS', '*'))
+    assert status == 'HTTP/1.1 204 No Content'
+    assert headers['allow'] == ', '.join(routing.METHODS)
+
+    (status, headers, body), errors = run(lambda port: request(port, 'OPTIONS', '/test/routing/nothing'))
+    assert status == 'HTTP/1.1 404 Not Found'
+
+    (status, headers, body), errors = run(lambda port: request(port, 'POST', '/test/routing/things'))
+    assert status == 'HTTP/1.1 200 OK'
+    assert body == b'add'
@@ -0,0 +1,60 @@
+"""
+Tests for the static file cache.
+
+    python3 -m pytest tests
+"""
+
+import asyncio
+
+import pytest
+
+from servant import staticfiles
+from servant.errors import HttpError
+from servant.staticfiles import StaticFileRoute, serve_prefix
+
+
+def test_spellings_share_one_entry(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.js').write_text('var a = 1;\n' * 100)
+    (tmp_path.parent / 'outside.js').write_text('var b = 1;\n')
+    serve_prefix('/test/static', str(tmp_path))
+    route = StaticFileRoute('/test/static')
+
+    async def load(relpath):
+        return await route([relpath], None)
+
+    spellings = ['a.js', './a.js', '././a.js', 'sub/../a.js', 'sub//../a.js']
+    entries = [asyncio.run(load(relpath)) for relpath in spellings]
+    assert all(entry is entries[0] for entry in entries)
+    assert [key for key in staticfiles.map_path_to_cache if key[0] == '/test/static'] == [('/test/static', 'a.js')]
+
+    with pytest.raises(HttpError):
+        asyncio.run(load('../outside.js'))
+
+
+def test_file_sent_from_disk(tmp_path, monkeypatch):
+    from test_connection import run, read_response
+
+    monkeypatch.setattr(staticfiles, 'sendfile_threshold', 1000)
+    content = bytes(range(256)) * 20
+    (tmp_path / 'large.png').write_bytes(content)
+    serve_prefix('/test/disk', str(tmp_path))
+
+    async def client(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /test/disk/large.png HTTP/1.1\r\n\r\n'
+                     b'HEAD /test/disk/large.png HTTP/1.1\r\n\r\n'
+                     b'GET /test/disk/large.png HTTP/1.1\r\nRange: bytes=-10\r\n\r\n')
+        whole = await read_response(reader)
+        head = await reader.readuntil(b'\r\n\r\n')
+        part = await read_response(reader)
+        writer.close()
+        return whole, head, part
+
+    (whole, head, part), errors = run(client)
+    assert whole[2] == content
+    assert b'content-length: 5120' in head
+    assert part[0] == 'HTTP/1.1 206 Partial Content'
+    assert part[1]['content-range'] == 'bytes 5110-5119/5120'
+    assert part[2] == content[-10:]
+    assert not errors